@@ -0,0 +1,155 @@
+# Benchmarks of the overhead of CAOSFlaskModule: request parsing and blob
+# storage, task execution, state polling, log reads and result downloads.
+# The module runs a no-op callback (noop_module.py), so the measures only
+# include the cost of the server.
+#
+# Run with: python -m pytest benchmarks/bench_server.py
+# (with pytest-benchmark installed its own fixture and options are used,
+# otherwise conftest.py provides a minimal replacement, pass
+# --benchmark-json=<path> to store the results and compare runs)
+
+import os
+import json
+import time
+import threading
+from os import path
+
+import pytest
+import requests
+
+current_directory = path.dirname(os.path.abspath(__file__))
+resources_directory = path.join(current_directory, '..',
+                                'm_2.2_hw_resource_estimation', 'demo_fpl',
+                                'test_resources')
+
+_MB = 1024 * 1024
+_CONCURRENT_TASKS = 32
+_CONCURRENT_CLIENTS = 8
+
+
+def _submit(session, url, jsonPayload, files=None):
+    requestFiles = dict(files or {})
+    requestFiles["jsonPayload"] = json.dumps(jsonPayload)
+    response = session.post(url + "/submit", files=requestFiles)
+    assert response.status_code == 200, response.text
+    return response.json()["taskId"]
+
+
+def _wait(session, url, taskId):
+    while True:
+        stateData = session.get(url + "/wait/" + taskId + "?timeout=30").json()
+        if stateData["state"] not in ("QUEUED", "RUNNING"):
+            assert stateData["state"] == "COMPLETED", stateData
+            return stateData
+
+
+def _runTask(session, url, jsonPayload, files=None):
+    taskId = _submit(session, url, jsonPayload, files)
+    _wait(session, url, taskId)
+    return taskId
+
+
+@pytest.fixture(scope="module")
+def demo_request():
+    with open(path.join(resources_directory, "caos_request.json")) as jsonFile:
+        jsonPayload = json.load(jsonFile)
+    with open(path.join(resources_directory, "code.tar.gz"), "rb") as code:
+        files = {"code.tar.gz": code.read()}
+    return jsonPayload, files
+
+
+def test_info(benchmark, session, module_url):
+    benchmark(session.get, module_url + "/info")
+
+
+def test_submit_demo_request(benchmark, session, module_url, demo_request):
+    jsonPayload, files = demo_request
+    benchmark(_submit, session, module_url, jsonPayload, files)
+
+
+@pytest.mark.parametrize("size", [1 * _MB, 64 * _MB])
+def test_submit_large_blob(benchmark, session, module_url, size):
+    files = {"large.bin": os.urandom(size)}
+    rates = []
+
+    def submit():
+        start = time.time()
+        _submit(session, module_url, {}, files)
+        rates.append(size / _MB / (time.time() - start))
+
+    benchmark.pedantic(submit, rounds=5, warmup_rounds=1)
+    benchmark.extra_info["MB_per_sec"] = round(max(rates), 1)
+
+
+def test_task_roundtrip(benchmark, session, module_url, demo_request):
+    # submit and wait for the completion, i.e. the latency of a task, the
+    # ops/s of this benchmark is the sequential tasks/sec
+    jsonPayload, files = demo_request
+    benchmark(_runTask, session, module_url, jsonPayload, files)
+
+
+def test_task_throughput(benchmark, module_url):
+    # concurrent clients running a batch of tasks
+
+    rates = []
+
+    def runBatch():
+        start = time.time()
+        remaining = [_CONCURRENT_TASKS]
+        lock = threading.Lock()
+
+        def client():
+            with requests.Session() as clientSession:
+                while True:
+                    with lock:
+                        if remaining[0] == 0:
+                            return
+                        remaining[0] -= 1
+                    _runTask(clientSession, module_url, {})
+
+        threads = [threading.Thread(target=client)
+                   for _ in range(_CONCURRENT_CLIENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rates.append(_CONCURRENT_TASKS / (time.time() - start))
+
+    benchmark.pedantic(runBatch, rounds=3, warmup_rounds=1)
+    benchmark.extra_info["tasks_per_sec"] = round(max(rates), 1)
+
+
+@pytest.fixture(scope="module")
+def completed_task(module_url):
+    with requests.Session() as httpSession:
+        return _runTask(httpSession, module_url,
+                        {"resultSize": 64 * _MB, "logSize": 1 * _MB})
+
+
+def test_state(benchmark, session, module_url, completed_task):
+    benchmark(session.get, module_url + "/state/" + completed_task)
+
+
+def test_log(benchmark, session, module_url, completed_task):
+    benchmark(session.get, module_url + "/log/" + completed_task)
+
+
+def test_result_download(benchmark, session, module_url, completed_task):
+    def download():
+        response = session.get(module_url + "/result/" + completed_task +
+                               "/result.bin", stream=True)
+        for _ in response.iter_content(_MB):
+            pass
+
+    benchmark.pedantic(download, rounds=5, warmup_rounds=1)
+
+
+def test_archive_download(benchmark, session, module_url, completed_task):
+    def download():
+        response = session.get(module_url + "/results/" + completed_task +
+                               ".tar", stream=True,
+                               headers={"Accept-Encoding": "identity"})
+        for _ in response.iter_content(_MB):
+            pass
+
+    benchmark.pedantic(download, rounds=5, warmup_rounds=1)
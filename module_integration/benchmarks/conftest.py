@@ -0,0 +1,174 @@
+import sys
+import os
+import json
+import time
+import socket
+import shutil
+import signal
+import tempfile
+import subprocess
+from os import path
+
+import pytest
+import requests
+
+current_directory = path.dirname(os.path.abspath(__file__))
+
+try:
+    import pytest_benchmark  # noqa: F401
+    _HAS_PYTEST_BENCHMARK = True
+except ImportError:
+    _HAS_PYTEST_BENCHMARK = False
+
+try:
+    import aiohttp  # noqa: F401
+    _SERVERS = ["process", "workerPool", "asyncio"]
+except ImportError:
+    _SERVERS = ["process", "workerPool"]
+
+_STARTUP_TIMEOUT = 30
+_MIN_ROUNDS = 5
+_MAX_ROUNDS = 1000
+_MAX_TIME = 1.0
+
+
+def pytest_addoption(parser):
+    if not _HAS_PYTEST_BENCHMARK:
+        parser.addoption("--benchmark-json", default=None,
+                         help="store the benchmark results in a json file")
+
+
+@pytest.fixture(scope="session", params=_SERVERS)
+def module_url(request):
+    """ Starts noop_module.py on a free port, once with a process per task,
+    once with the worker pool and once with the asyncio server (if aiohttp
+    is installed), and returns its base url """
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    storage = tempfile.mkdtemp(prefix="caos_bench_")
+    env = dict(os.environ)
+    env["CAOS_BENCH_STORAGE"] = path.join(storage, "data")
+    env["CAOS_BENCH_WORKER_POOL"] = "1" if request.param == "workerPool" \
+        else "0"
+    env["CAOS_BENCH_SERVER"] = "asyncio" if request.param == "asyncio" \
+        else "flask"
+    module = subprocess.Popen(
+        [sys.executable, path.join(current_directory, "noop_module.py"),
+         "-H", "localhost", "-P", str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    url = "http://localhost:" + str(port)
+    deadline = time.time() + _STARTUP_TIMEOUT
+    while True:
+        try:
+            requests.get(url + "/info")
+            break
+        except requests.ConnectionError:
+            if module.poll() is not None or time.time() > deadline:
+                shutil.rmtree(storage, ignore_errors=True)
+                pytest.fail("the benchmark module did not start")
+            time.sleep(0.1)
+
+    yield url
+
+    module.send_signal(signal.SIGINT)
+    try:
+        module.wait(10)
+    except subprocess.TimeoutExpired:
+        module.kill()
+        module.wait()
+    shutil.rmtree(storage, ignore_errors=True)
+
+
+@pytest.fixture
+def session():
+    with requests.Session() as httpSession:
+        yield httpSession
+
+
+class _Benchmark(object):
+    """ Minimal stand-in for the pytest-benchmark fixture, used when the
+    plugin is not installed. It supports benchmark(func, *args, **kwargs),
+    benchmark.pedantic(...) and benchmark.extra_info. """
+
+    def __init__(self, name):
+        self.name = name
+        self.extra_info = {}
+        self.times = []
+
+    def __call__(self, func, *args, **kwargs):
+        # calibrate the number of rounds with the run time, as pytest-benchmark
+        result = func(*args, **kwargs)
+        start = time.time()
+        while len(self.times) < _MAX_ROUNDS and (
+                len(self.times) < _MIN_ROUNDS or
+                time.time() - start < _MAX_TIME):
+            roundStart = time.time()
+            result = func(*args, **kwargs)
+            self.times.append(time.time() - roundStart)
+        return result
+
+    def pedantic(self, target, args=(), kwargs=None, setup=None, rounds=1,
+                 warmup_rounds=0, iterations=1):
+        kwargs = kwargs or {}
+        result = None
+        for roundIndex in range(warmup_rounds + rounds):
+            if setup is not None:
+                setup()
+            roundStart = time.time()
+            for _ in range(iterations):
+                result = target(*args, **kwargs)
+            if roundIndex >= warmup_rounds:
+                self.times.append((time.time() - roundStart) / iterations)
+        return result
+
+    def getStats(self):
+        times = sorted(self.times)
+        mean = sum(times) / len(times)
+        return {
+            "name": self.name,
+            "rounds": len(times),
+            "min": times[0],
+            "max": times[-1],
+            "mean": mean,
+            "median": times[len(times) // 2],
+            "p95": times[min(int(len(times) * 0.95), len(times) - 1)],
+            "ops": 1 / mean if mean > 0 else 0,
+            "extra_info": self.extra_info
+        }
+
+
+_results = []
+
+if not _HAS_PYTEST_BENCHMARK:
+    @pytest.fixture
+    def benchmark(request):
+        bench = _Benchmark(request.node.name)
+        yield bench
+        if bench.times:
+            _results.append(bench.getStats())
+
+    def pytest_terminal_summary(terminalreporter, config):
+        if not _results:
+            return
+        terminalreporter.section("benchmark")
+        terminalreporter.write_line(
+            "%-60s %10s %10s %10s %10s %10s" %
+            ("name", "mean (ms)", "p50 (ms)", "p95 (ms)", "ops/s", "rounds"))
+        for stats in _results:
+            terminalreporter.write_line(
+                "%-60s %10.3f %10.3f %10.3f %10.1f %10d" %
+                (stats["name"][:60], stats["mean"] * 1000,
+                 stats["median"] * 1000, stats["p95"] * 1000, stats["ops"],
+                 stats["rounds"]))
+            for key, value in sorted(stats["extra_info"].items()):
+                terminalreporter.write_line("    %s: %s" % (key, value))
+
+        outputPath = config.getoption("--benchmark-json")
+        if outputPath is not None:
+            with open(outputPath, "w") as outputFile:
+                json.dump({"benchmarks": _results}, outputFile,
+                          sort_keys=True, indent=4)
@@ -0,0 +1,49 @@
+# Module with a no-op callback, used by the benchmarks to measure the
+# overhead of CAOSFlaskModule itself.
+#
+# The request json may contain:
+#   - resultSize: size in bytes of the result blob (default 0, no blob)
+#   - logSize: size in bytes of the log (default 0)
+# The server options are read from the environment: CAOS_BENCH_STORAGE,
+# CAOS_BENCH_WORKER_POOL (1 to use the worker pool), CAOS_BENCH_MAX_TASKS,
+# CAOS_BENCH_SERVER (flask or asyncio).
+
+import sys
+import os
+from os import path
+
+current_directory = path.dirname(os.path.abspath(__file__))
+sys.path.append(path.join(current_directory, '..', 'libraries'))
+import CAOSFlaskModule
+
+_CHUNK = b"x" * (1024 * 1024)
+
+
+def _writeBytes(outFile, size):
+    while size > 0:
+        outFile.write(_CHUNK[:size])
+        size -= len(_CHUNK)
+
+
+def runModule(jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
+    with open(outLogPath, "ab") as log:
+        _writeBytes(log, jsonPayload.get("logSize", 0))
+    resultSize = jsonPayload.get("resultSize", 0)
+    if resultSize > 0:
+        with open(path.join(outBlobDir, "result.bin"), "wb") as result:
+            _writeBytes(result, resultSize)
+    return {"blobs": list(blobNames)}
+
+
+CAOSFlaskModule.start(
+    runModule,
+    apiVersion="1.0",
+    moduleName="benchmark",
+    implementationName="noop",
+    storagePath=os.environ.get("CAOS_BENCH_STORAGE",
+                               path.join(current_directory, "data")),
+    threaded=True,
+    maxTasks=int(os.environ.get("CAOS_BENCH_MAX_TASKS", "0")),
+    workerPool=os.environ.get("CAOS_BENCH_WORKER_POOL") == "1",
+    server=os.environ.get("CAOS_BENCH_SERVER", "flask")
+)
@@ -0,0 +1,460 @@
+"""Asynchronous http server of a CAOS module, based on aiohttp
+
+The server exposes the same http APIs of the flask server and it is
+started by CAOSFlaskModule.start when the "asyncio" server is selected,
+it shares the task registry, the blob store and the task APIs with the
+flask server. All the requests are handled by an event loop in a single
+thread:
+- requests waiting for a task (/wait, /events and /log with follow=true)
+  do not hold a thread, they are woken up when the task registry reports
+  a change of state of the task
+- uploaded blobs are streamed to the blob store chunk by chunk while they
+  are received, so a slow upload does not block the other requests
+- the blocking file system operations run in a small thread pool
+- result blobs are sent with sendfile (zero-copy), the compressed copies 
+  too (see CAOSFlaskModule._selectResultFile)
+This module has a dependency on:
+- aiohttp (python 3 only)
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from aiohttp import web
+
+import CAOSFlaskModule
+
+# number of threads running the blocking file system operations
+_IO_THREADS = 16
+
+
+def serve(host, port, app, registry, blobStore, metrics, getInfoData, getMetricsText, submitTask, getTask, \
+    getStateData, cancelTask, getResultDir, getResultPath):
+    """Runs the asynchronous server until the process is interrupted
+
+    Parameters
+    ----------
+    host : string
+        The hostname for the http server
+    port : int
+        The port for the http server
+    app : flask.Flask
+        The flask application of the module, holding its configuration
+    registry, blobStore, metrics :
+        The task registry, the blob store and the metrics of the module
+    getInfoData, getMetricsText, submitTask, getTask, getStateData, cancelTask, getResultDir, getResultPath :
+        The task APIs defined by CAOSFlaskModule.start
+    """
+    server = _AsyncServer(app, registry, blobStore, metrics, getInfoData, getMetricsText, submitTask, getTask, \
+        getStateData, cancelTask, getResultDir, getResultPath)
+    web.run_app(server.createApplication(), host=host, port=port)
+
+
+class _AsyncServer(object):
+
+    def __init__(self, app, registry, blobStore, metrics, getInfoData, getMetricsText, submitTask, getTask, \
+        getStateData, cancelTask, getResultDir, getResultPath):
+        self.app = app
+        self.registry = registry
+        self.blobStore = blobStore
+        self.metrics = metrics
+        self.getInfoData = getInfoData
+        self.getMetricsText = getMetricsText
+        self.submitTask = submitTask
+        self.getTask = getTask
+        self.getStateData = getStateData
+        self.cancelTask = cancelTask
+        self.getResultDir = getResultDir
+        self.getResultPath = getResultPath
+        self.loop = None
+        self.executor = None
+        # futures of the requests waiting for a task, by task id
+        self.waiters = {}
+
+    def createApplication(self):
+        application = web.Application(middlewares=[self.countRequest, self.compressResponse])
+        application.on_startup.append(self.onStartup)
+        application.on_cleanup.append(self.onCleanup)
+        application.router.add_get('/info', self.getInfo)
+        application.router.add_get('/metrics', self.getMetrics)
+        application.router.add_post('/submit', self.postSubmit)
+        application.router.add_route('HEAD', '/blob/{blobHash}', self.headBlob)
+        application.router.add_get('/state/{taskId}', self.getState)
+        application.router.add_get('/wait/{taskId}', self.waitState)
+        application.router.add_get('/events/{taskId}', self.getEvents)
+        application.router.add_get('/kill/{taskId}', self.killTask)
+        application.router.add_get('/log/{taskId}', self.getLog, allow_head=False)
+        application.router.add_get('/result/{taskId}/{filename}', self.getResult, allow_head=False)
+        application.router.add_get('/results/{archiveName}', self.getResults, allow_head=False)
+        return application
+
+    async def onStartup(self, application):
+        self.loop = asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(_IO_THREADS)
+        self.registry.addListener(self.taskChanged)
+
+    async def onCleanup(self, application):
+        self.executor.shutdown(wait=False)
+
+    def run(self, function, *args):
+        """Runs a blocking function in the thread pool"""
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+    @web.middleware
+    async def countRequest(self, request, handler):
+        # same metrics of the flask server (see CAOSFlaskModule.start)
+        start = time.time()
+        code = 500
+        try:
+            response = await handler(request)
+            code = response.status
+            return response
+        except web.HTTPException as e:
+            code = e.status
+            raise
+        finally:
+            resource = request.match_info.route.resource
+            route = CAOSFlaskModule._getRouteLabel(resource.canonical if resource != None else None)
+            self.metrics.inc("caos_http_requests_total", labels=(("route", route), ("code", str(code))))
+            if route == "/submit":
+                self.metrics.observe("caos_submit_duration_seconds", time.time() - start)
+
+    @web.middleware
+    async def compressResponse(self, request, handler):
+        # json responses are compressed if the client accepts it
+        response = await handler(request)
+        if type(response) is not web.Response or response.content_type != "application/json" or \
+            "Content-Encoding" in response.headers:
+            return response
+        response.headers["Vary"] = "Accept-Encoding"
+        encoding = CAOSFlaskModule._negotiateEncoding(request.headers.get("Accept-Encoding"))
+        if encoding != None and len(response.body) >= CAOSFlaskModule._COMPRESS_MIN_SIZE:
+            response.body = CAOSFlaskModule._compressData(response.body, encoding)
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    # ---- task state changes ----
+
+    def taskChanged(self, guid):
+        # called by the registry from any thread, the waiters are woken up
+        # by the event loop (a waiter registered concurrently checks the
+        # registry after being registered, so it cannot miss the change)
+        if guid in self.waiters:
+            self.loop.call_soon_threadsafe(self.wakeUp, guid)
+
+    def wakeUp(self, guid):
+        for future in self.waiters.get(guid, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def waitTask(self, guid, timeout, states=CAOSFlaskModule._PENDING_STATES):
+        """Waits up to timeout seconds for the task to leave the given states
+        (by default until it is completed)"""
+        deadline = self.loop.time() + timeout
+        future = None
+        try:
+            while True:
+                future = self.loop.create_future()
+                self.waiters.setdefault(guid, set()).add(future)
+                task = self.registry.get(guid)
+                # the task can change state more than once before leaving the
+                # given states (QUEUED, RUNNING, completed)
+                remaining = deadline - self.loop.time()
+                if task == None or task["state"] not in states or remaining <= 0:
+                    return task
+                try:
+                    await asyncio.wait_for(future, remaining)
+                except asyncio.TimeoutError:
+                    pass
+                self.waiters[guid].discard(future)
+        finally:
+            waiters = self.waiters[guid]
+            waiters.discard(future)
+            if not waiters:
+                del self.waiters[guid]
+
+    # ---- http APIs ----
+
+    async def getInfo(self, request):
+        return web.json_response(self.getInfoData())
+
+    async def getMetrics(self, request):
+        return web.Response(body=self.getMetricsText().encode("utf-8"), \
+            headers={"Content-Type" : CAOSFlaskModule._METRICS_CONTENT_TYPE})
+
+    async def postSubmit(self, request):
+        maxRequestBytes = self.app.config.get("MAX_CONTENT_LENGTH") or 0
+        if maxRequestBytes > 0 and (request.content_length or 0) > maxRequestBytes:
+            return _sendErrorData("Request too large, the maximum size is " + str(maxRequestBytes) + " bytes", 413)
+
+        jsonData = None
+        fields = {"remoteAddress" : request.remote}
+        blobs = {}
+        limit = _RequestLimit(maxRequestBytes)
+        try:
+            # the fields are read in the order they are sent, only the
+            # first field with a given name is used (as in flask)
+            reader = None
+            if request.content_type.startswith("multipart/"):
+                reader = await request.multipart()
+            while reader != None:
+                part = await reader.next()
+                if part == None:
+                    break
+                if part.name in CAOSFlaskModule._RESERVED_FIELDS[1:]:
+                    if part.name not in fields:
+                        fields[part.name] = await self.readPart(part, limit)
+                elif part.filename == None:
+                    continue
+                elif part.name == "jsonPayload":
+                    if jsonData == None:
+                        jsonData = await self.readPart(part, limit)
+                elif part.name not in blobs:
+                    blobs[part.name] = await self.run(self.blobStore.open, self.app.config["maxBlobBytes"])
+                    await self.receiveBlob(part, blobs[part.name], limit)
+
+            responseData, code = await self.run(self.submitTask, jsonData, blobs, fields)
+        except CAOSFlaskModule._BlobTooLarge as e:
+            responseData, code = CAOSFlaskModule._getErrorData(str(e)), 413
+        finally:
+            # blobs that are not used by a task are removed
+            for writer in blobs.values():
+                await self.run(writer.discard)
+            self.metrics.inc("caos_uploaded_bytes_total", limit.size)
+
+        return web.json_response(responseData, status=code)
+
+    async def readPart(self, part, limit):
+        # reads a small field, within the limits of the request
+        chunks = []
+        while True:
+            data = await part.read_chunk(CAOSFlaskModule._BLOB_CHUNK_SIZE)
+            if not data:
+                return b"".join(chunks)
+            limit.add(len(data))
+            chunks.append(data)
+
+    async def receiveBlob(self, part, writer, limit):
+        while True:
+            data = await part.read_chunk(CAOSFlaskModule._BLOB_CHUNK_SIZE)
+            if not data:
+                break
+            limit.add(len(data))
+            await self.run(writer.write, data)
+
+    async def headBlob(self, request):
+        if not await self.run(self.blobStore.has, request.match_info["blobHash"]):
+            return web.Response(status=404)
+        return web.Response(status=200)
+
+    async def getState(self, request):
+        taskId = request.match_info["taskId"]
+        task = await self.run(self.getTask, taskId)
+        if task == None:
+            return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+
+        return web.json_response(await self.run(self.getStateData, taskId, task))
+
+    async def waitState(self, request):
+        # same as /state, but it waits up to 'timeout' seconds for the task to complete
+        taskId = request.match_info["taskId"]
+        try:
+            timeout = min(float(request.query.get('timeout', CAOSFlaskModule._WAIT_TIMEOUT)), \
+                CAOSFlaskModule._MAX_WAIT_TIMEOUT)
+        except ValueError:
+            return _sendErrorData("invalid timeout: '" + request.query.get('timeout') + "'", 400)
+
+        task = await self.run(self.getTask, taskId)
+        if task == None:
+            return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+        if task["state"] in CAOSFlaskModule._PENDING_STATES:
+            task = await self.waitTask(taskId, timeout)
+            if task == None:
+                return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+
+        return web.json_response(await self.run(self.getStateData, taskId, task))
+
+    async def getEvents(self, request):
+        # server-sent events stream with the state of the task, closed once the task is completed
+        taskId = request.match_info["taskId"]
+        task = await self.run(self.getTask, taskId)
+        if task == None:
+            return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+
+        response = web.StreamResponse(headers={"Content-Type" : "text/event-stream; charset=utf-8", \
+            "Cache-Control" : "no-cache"})
+        await response.prepare(request)
+        stateData = await self.run(self.getStateData, taskId, task)
+        await response.write(CAOSFlaskModule._formatEvent("state", stateData).encode())
+        while task != None and task["state"] in CAOSFlaskModule._PENDING_STATES:
+            state = task["state"]
+            task = await self.waitTask(taskId, CAOSFlaskModule._EVENTS_KEEPALIVE, (state,))
+            if task == None:
+                break
+            if task["state"] == state:
+                await response.write(b": keep-alive\n\n")
+            else:
+                stateData = await self.run(self.getStateData, taskId, task)
+                await response.write(CAOSFlaskModule._formatEvent("state", stateData).encode())
+        await response.write_eof()
+        return response
+
+    async def killTask(self, request):
+        responseData, code = await self.run(self.cancelTask, request.match_info["taskId"])
+        return web.json_response(responseData, status=code)
+
+    async def getLog(self, request):
+        # see the flask implementation of /log
+        taskId = request.match_info["taskId"]
+        self.registry.touch(taskId)
+        logPath = CAOSFlaskModule._getLogTaskPath(taskId, self.app)
+        if not _isName(taskId) or not await self.run(path.isfile, logPath):
+            return _sendErrorData("logs for task with ID: '" + taskId + "' not found", 404)
+        try:
+            start = int(request.query.get('offset', 0))
+        except ValueError:
+            return _sendErrorData("invalid offset: '" + request.query.get('offset') + "'", 400)
+        follow = request.query.get('follow', 'false').lower() == 'true'
+
+        logFile = await self.run(open, logPath, "rb")
+        try:
+            size = os.fstat(logFile.fileno()).st_size
+            end = None
+            status = 200
+            headers = {"Content-Type" : "text/plain; charset=utf-8", "Accept-Ranges" : "bytes"}
+            byteRange = CAOSFlaskModule._parseByteRange(request.headers.get('Range'), size)
+            if byteRange != None:
+                start, end = byteRange
+                if start >= size and not follow:
+                    response = _sendErrorData("requested range not satisfiable", 416)
+                    response.headers["Content-Range"] = "bytes */" + str(size)
+                    return response
+                status = 206
+            await self.run(logFile.seek, start)
+
+            # the log is compressed if the client accepts it, see the flask 
+            # implementation
+            encoding = None
+            if byteRange == None:
+                encoding = CAOSFlaskModule._negotiateEncoding(request.headers.get("Accept-Encoding"))
+            headers["Vary"] = "Accept-Encoding"
+
+            response = web.StreamResponse(status=status, headers=headers)
+            if follow:
+                compressor = None
+                if encoding != None:
+                    compressor = CAOSFlaskModule._StreamCompressor(encoding, True)
+                    response.headers["Content-Encoding"] = encoding
+                await response.prepare(request)
+                running = True
+                while True:
+                    data = await self.run(logFile.read, CAOSFlaskModule._LOG_CHUNK_SIZE)
+                    if data:
+                        await response.write(compressor.compress(data) if compressor != None else data)
+                        continue
+                    if not running:
+                        break
+                    task = await self.waitTask(taskId, CAOSFlaskModule._LOG_FOLLOW_INTERVAL)
+                    running = task != None and task["state"] in CAOSFlaskModule._PENDING_STATES
+                if compressor != None:
+                    await response.write(compressor.finish())
+            else:
+                if end == None:
+                    end = size - 1
+                length = max(end - start + 1, 0)
+                compressor = None
+                if encoding != None and length >= CAOSFlaskModule._COMPRESS_MIN_SIZE:
+                    compressor = CAOSFlaskModule._StreamCompressor(encoding)
+                    response.headers["Content-Encoding"] = encoding
+                else:
+                    response.content_length = length
+                if status == 206:
+                    response.headers["Content-Range"] = "bytes " + str(start) + "-" + str(end) + "/" + str(size)
+                await response.prepare(request)
+                while length > 0:
+                    data = await self.run(logFile.read, min(length, CAOSFlaskModule._LOG_CHUNK_SIZE))
+                    if not data:
+                        break
+                    length -= len(data)
+                    if compressor != None:
+                        data = compressor.compress(data)
+                    if data:
+                        await response.write(data)
+                if compressor != None:
+                    await response.write(compressor.finish())
+            await response.write_eof()
+            return response
+        finally:
+            await self.run(logFile.close)
+
+    async def getResult(self, request):
+        taskId = request.match_info["taskId"]
+        filename = request.match_info["filename"]
+        if not _isName(taskId) or not _isName(filename):
+            return _sendErrorData("task with ID: '" + taskId + "' not found or not completed.", 404)
+        filePath, errorData = await self.run(self.getResultPath, taskId, filename)
+        if filePath == None:
+            return web.json_response(errorData, status=404)
+
+        # FileResponse sends the file with sendfile and handles Range requests
+        sendPath, encoding = await self.run(CAOSFlaskModule._selectResultFile, filePath, \
+            request.headers.get("Accept-Encoding"), request.headers.get("Range"))
+        if encoding == None:
+            return web.FileResponse(filePath, headers={"Vary" : "Accept-Encoding"})
+        return web.FileResponse(sendPath, headers={"Content-Type" : CAOSFlaskModule._guessMimeType(filename), \
+            "Content-Encoding" : encoding, "Vary" : "Accept-Encoding"})
+
+    async def getResults(self, request):
+        # see the flask implementation of /results, the archive is read and
+        # compressed in the thread pool
+        archiveName = request.match_info["archiveName"]
+        taskId, encoding, errorData = CAOSFlaskModule._parseArchiveName(archiveName)
+        if taskId == None or not _isName(taskId):
+            return web.json_response(errorData or CAOSFlaskModule._getErrorData("task with ID: '" + taskId + \
+                "' not found or not completed."), status=404)
+        resultDir, errorData = await self.run(self.getResultDir, taskId)
+        if resultDir == None:
+            return web.json_response(errorData, status=404)
+
+        chunks, headers = await self.run(CAOSFlaskModule._streamArchive, resultDir, archiveName, encoding, \
+            request.headers.get("Accept-Encoding"))
+        try:
+            response = web.StreamResponse(headers=headers)
+            await response.prepare(request)
+            while True:
+                data = await self.run(next, chunks, None)
+                if data == None:
+                    break
+                if data:
+                    await response.write(data)
+            await response.write_eof()
+            return response
+        finally:
+            await self.run(chunks.close)
+
+
+class _RequestLimit(object):
+    """Counts the bytes received by a request (for chunked requests, whose
+    size is not known in advance)"""
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+
+    def add(self, size):
+        self.size += size
+        if self.maxBytes > 0 and self.size > self.maxBytes:
+            raise CAOSFlaskModule._BlobTooLarge("Request too large, the maximum size is " + \
+                str(self.maxBytes) + " bytes")
+
+
+def _sendErrorData(message, code):
+    return web.json_response(CAOSFlaskModule._getErrorData(message), status=code)
+
+def _isName(name):
+    # the path parameters are url-decoded by aiohttp, so they could contain
+    # separators that flask would not accept
+    return name not in ("", ".", "..") and "/" not in name
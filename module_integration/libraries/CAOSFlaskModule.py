@@ -5,11 +5,59 @@ using the "start" method. This module has a dependency on:
 - flask
 
 The module leverages a local file system storage and each compute task
-can be in a RUNNING or COMPLETED state. (we use the atomic file system 
-move to change the task state).
-
-TODO: we still need a background thread in order to remove old files
-from completed tasks.
+can be in a RUNNING or COMPLETED state (or QUEUED, when the admission 
+queue is enabled). (we use the atomic file system 
+move to change the task state). The state of the tasks is also kept in an
+in-memory task registry, updated by the task processes through a queue,
+so that state and capacity queries do not hit the file system; the local
+storage is only used as a fallback for tasks that are not in the registry.
+Clients can wait for the completion of a task either by polling /state, 
+by long-polling /wait or by listening to the /events server-sent events
+stream (the last two require a threaded server to be useful).
+Result blobs, logs and json responses are compressed (gzip, or zstd with 
+the optional zstandard module) when the client accepts it: each result 
+blob is compressed once and the compressed file is kept in the task 
+folder, uncompressed blobs are sent as files (with sendfile, when the 
+server supports it) and with Range support.
+The /state of a completed task includes the time it spent in each phase
+(queue, request storage, process startup, callback, ...) and its peak
+memory, while /metrics exposes counters and histograms of the requests 
+and of the tasks in the Prometheus text format.
+
+Tasks are executed in a new process spawned for each request or, when
+the worker pool is enabled, by a set of pre-forked worker processes that
+are reused across requests.
+
+When all the task slots are busy new requests are rejected, unless the 
+admission queue is enabled: in that case the requests are QUEUED and 
+started as soon as a slot is free, by priority class and sharing the 
+slots fairly among the clients.
+The admission can also depend on memory and cpu budgets: each request 
+declares the memory and the cores it needs, and the actual resident memory
+and cpu usage of the process group of each running task are sampled from 
+/proc. The tasks can be limited to their declared footprint, with cgroups 
+(when a delegated cgroup v2 folder is available) or with setrlimit.
+
+The files of completed tasks are kept, also across restarts of the module,
+unless a retention policy is configured: in that case a background thread
+removes the least recently accessed completed tasks when they get too old
+or when they exceed the configured number of tasks or bytes. Completed 
+tasks and cached results are recorded in an append-only task index, which
+a restarted module reads in the background to re-adopt them (the tasks 
+that were running are FAILED), so the startup time does not depend on the
+size of the storage.
+
+Uploaded blobs are stored once in a content-addressed blob store (keyed by
+their SHA-256) and linked into the work directory of each task, clients 
+can check if a blob is already stored with HEAD /blob/<hash> and reference
+it in the "blobHashes" field of /submit instead of uploading it again. 
+Blobs in the work directory are shared, so they must not be modified by
+the runCallback.
+
+Modules whose runCallback is deterministic can enable the result cache: 
+the result of a successful task is stored under the hash of its request 
+(json payload and blob hashes) and identical requests are completed 
+immediately by linking the cached result, without running the callback.
 """
 
 import flask
@@ -22,10 +70,107 @@ import multiprocessing
 import threading
 import traceback
 import signal
+import atexit
+import resource
+import time
+import hashlib
+import fcntl
+import re
+import collections
+import io
+import sys
+import cProfile
+import pstats
+import zlib
+import mimetypes
+import stat
+import tarfile
 
 from flask import request
 from os import path
 
+try:
+    import queue as _queue
+except ImportError:
+    import Queue as _queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import CAOSjsonTester
+
+# default and maximum number of seconds a /wait request waits for a task
+_WAIT_TIMEOUT = 30
+_MAX_WAIT_TIMEOUT = 300
+# seconds between keep-alive comments of the /events stream
+_EVENTS_KEEPALIVE = 15
+# size of the chunks read from the logs and seconds between two checks for
+# new data when following a log
+_LOG_CHUNK_SIZE = 64 * 1024
+_LOG_FOLLOW_INTERVAL = 0.2
+# number of tasks removed by the retention thread before pausing
+_RETENTION_BATCH = 16
+_RETENTION_PAUSE = 0.05
+# request fields of /submit that are not blobs
+_RESERVED_FIELDS = ("jsonPayload", "blobHashes", "priority", "clientId", "deadline", "profile", "memory", "cpus")
+# states of the tasks that are not completed yet
+_PENDING_STATES = ("QUEUED", "RUNNING")
+# seconds between two checks of the deadlines of the queued tasks
+_QUEUE_EXPIRE_INTERVAL = 0.5
+# seconds between two checks of the task processes that died without 
+# sending their completion
+_REAP_INTERVAL = 1
+# weight of the last completed task in the average run time of the tasks
+_RUN_TIME_WEIGHT = 0.2
+# content type of the /metrics response (Prometheus text format)
+_METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# content codings of the responses (by preference), the suffixes of the 
+# compressed result blobs and the compression levels
+_ENCODINGS = ("zstd", "gzip")
+_ENCODING_SUFFIXES = {"zstd" : ".zst", "gzip" : ".gz"}
+_GZIP_LEVEL = 6
+_ZSTD_LEVEL = 3
+# responses smaller than this size are not compressed
+_COMPRESS_MIN_SIZE = 1024
+# extensions of the result blobs that are already compressed
+_COMPRESSED_EXTENSIONS = (".gz", ".tgz", ".zip", ".zst", ".bz2", ".xz", ".7z", ".png", ".jpg", ".jpeg", ".gif")
+# suffixes of the result archives with their compression and content type
+_ARCHIVE_TYPES = ((".tar", None, "application/x-tar"), (".tar.gz", "gzip", "application/gzip"), \
+    (".tgz", "gzip", "application/gzip"), (".tar.zst", "zstd", "application/zstd"))
+# size of the chunks read when storing a blob
+_BLOB_CHUNK_SIZE = 1024 * 1024
+# size of the uploaded data kept in memory before writing it to a file
+_BLOB_MEMORY_SIZE = 64 * 1024
+# profilers of the runCallback, the name of the result blob with the 
+# profile, the number of functions summarized in the log and the seconds 
+# between two samples of the sampling profiler
+_PROFILERS = {"cprofile" : "profile.prof", "sampling" : "profile.folded"}
+_PROFILE_TOP = 20
+_PROFILE_INTERVAL = 0.01
+# phases of the tasks reported in their timing breakdown and in /metrics
+_TASK_PHASES = (
+    ("queue", "Seconds spent by the tasks in the admission queue"),
+    ("store", "Seconds spent storing the request of the tasks"),
+    ("spawn", "Seconds from the launch of the task process to the start of the callback"),
+    ("callback", "Seconds spent running the callback"),
+    ("move", "Seconds spent storing the response and moving the task to the completed tasks"),
+    ("collect", "Seconds from the end of the task process to the completion of the task")
+)
+# upper bounds of the buckets of the /metrics histograms
+_SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+_BYTES_BUCKETS = tuple(2 ** i * 1024 * 1024 for i in range(4, 17))
+# seconds between two samples of the memory and cpu used by the tasks, the
+# size of the memory pages and the clock ticks per second of /proc/<pid>/stat
+_RESOURCE_INTERVAL = 0.5
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+_CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+# period in microseconds of the cpu bandwidth limit of the task cgroups
+_CGROUP_CPU_PERIOD = 100000
+# linux ioctl to create a copy-on-write clone of a file (reflink)
+_FICLONE = 0x40049409
+
 class Error(Exception):
     """Exception that can be thrown by the runCallback
 
@@ -48,7 +193,11 @@ class KillTask(Exception):
 
 def start(runCallback, apiVersion, moduleName, implementationName, \
     storagePath="./data", threaded=False, maxTasks=0, defaultHost="0.0.0.0", \
-    defaultPort=5000):
+    defaultPort=5000, workerPool=False, workerMaxTasks=0, workerMaxMemory=0, retentionMaxAge=0, \
+    retentionMaxBytes=0, retentionMaxTasks=0, retentionInterval=60, cacheable=False, cacheMaxBytes=0, \
+    cacheMaxEntries=0, requestTemplate=None, server="flask", maxBlobBytes=0, maxRequestBytes=0, \
+    queueMaxLength=0, profile=None, cleanStorage=False, memoryBudget=0, cpuBudget=0, taskMemory=0, taskCpus=1, \
+    enforceLimits=False, cgroupRoot=None):
     """Starts the http server and listen for requests from the CAOS framework.
 
     This method also parses parameters passed via the command line when 
@@ -93,8 +242,127 @@ def start(runCallback, apiVersion, moduleName, implementationName, \
         The default host to use if not specified in the command line argument
     defaultPort : int
         The default port to use if not specified in the command line argument
+    workerPool : bool
+        Whether tasks should be executed by a pool of pre-forked worker 
+        processes instead of spawning a new process for each request. The 
+        pool has maxTasks workers (or one per CPU when maxTasks is 0).
+        (default False)
+    workerMaxTasks : int
+        Number of tasks after which a worker of the pool is replaced by a 
+        fresh process (default 0: never recycle)
+    workerMaxMemory : int
+        Resident memory in MB above which a worker of the pool is replaced 
+        by a fresh process once its current task is completed
+        (default 0: no limits)
+    retentionMaxAge : int
+        Number of seconds since the last access after which the files of a
+        completed task (results and logs), or a stored blob, are removed 
+        (default 0: no limits)
+    retentionMaxBytes : int
+        Maximum size in bytes of the completed tasks files and of the stored
+        blobs, the least recently accessed tasks (and the least recently 
+        used blobs) are removed first (default 0: no limits)
+    retentionMaxTasks : int
+        Maximum number of completed tasks whose files are kept, the least 
+        recently accessed tasks are removed first (default 0: no limits)
+    retentionInterval : int
+        Number of seconds between two sweeps of the retention thread
+        (default 60)
+    cacheable : bool
+        Whether the runCallback always returns the same result for the same
+        json payload and blobs. If true, the results of successful tasks are
+        cached and identical requests are completed without running the 
+        callback (default False)
+    cacheMaxBytes : int
+        Maximum size in bytes of the cached results, the least recently 
+        used results are evicted first (default 0: no limits)
+    cacheMaxEntries : int
+        Maximum number of cached results, the least recently used results 
+        are evicted first (default 0: no limits)
+    requestTemplate : dict or string, optional
+        A CAOSjsonTester validator template (or the path of a json file 
+        containing it) for the request json payload. Requests that do not
+        match the template are rejected with a 400 error before any task
+        data is stored.
+    server : string
+        The http server that handles the requests: "flask" for the flask 
+        development server or "asyncio" for an asynchronous server, based 
+        on aiohttp, that handles all the requests in a single thread, 
+        streams the uploaded blobs to the blob store and sends the results 
+        with sendfile. The "asyncio" server does not depend on the threaded
+        option and ignores the debug command line option. (default "flask")
+    maxBlobBytes : int
+        Maximum size in bytes of each uploaded blob, larger uploads are 
+        rejected with a 413 error (default 0: no limits)
+    maxRequestBytes : int
+        Maximum size in bytes of a /submit request, larger requests are 
+        rejected with a 413 error (default 0: no limits)
+    queueMaxLength : int
+        Maximum number of requests waiting for a free task slot (when 
+        maxTasks tasks are running). Queued requests are in the QUEUED 
+        state and they are started by priority (the optional "priority" 
+        field of /submit, an integer, higher first, default 0), taking 
+        turns among the clients (the optional "clientId" field, by default 
+        the address of the client). A request with the optional "deadline"
+        field (seconds) fails if it is not started within the deadline. 
+        Requests are rejected with a 503 error only when the queue is full.
+        (default 0: no queue, requests are rejected when maxTasks tasks are
+        running)
+    profile : string, optional
+        Profiles the runCallback of every task: "cprofile" (deterministic, 
+        the profile is stored in the profile.prof result blob, readable with
+        pstats) or "sampling" (the stack of the callback is sampled every 
+        10ms, the profile.folded result blob has the collapsed stacks for 
+        flame graphs). The top functions are appended to the task log. 
+        Each request can override it with the optional "profile" field of 
+        /submit ("cprofile", "sampling" or "none"). Profiled requests do 
+        not use the result cache. (default None: no profiling)
+    cleanStorage : bool
+        Whether the tasks, the blobs and the cached results of the previous
+        runs of the module are discarded at startup. The storage is moved 
+        to the trash folder and removed by a background thread, so the 
+        server starts immediately. Otherwise the completed tasks and the 
+        cached results are re-adopted from the task index of the storage 
+        and the tasks that were running (or queued) are FAILED. Without a 
+        retention policy the kept storage grows without limits, a warning 
+        is printed at startup in that case. (default False)
+    memoryBudget : int
+        Memory in MB that the running tasks can use. Each request declares 
+        the memory it needs (the optional "memory" field of /submit, in MB,
+        default taskMemory) and it is started only if its declared memory 
+        fits in the budget and in the memory available on the machine. The
+        resident memory of the process group of each running task is 
+        sampled and a task counts for the larger of its declared and of its
+        actual memory. Requests that do not fit are rejected with a 503 
+        error, or queued when the admission queue is enabled. Requests that
+        declare more than the whole budget are rejected with a 400 error.
+        (default 0: no limits)
+    cpuBudget : float
+        Number of cores that the running tasks can use, each request 
+        declares the cores it needs (the optional "cpus" field of /submit,
+        default taskCpus) and a running task counts for the larger of its
+        declared and of its actual cpu usage, as for memoryBudget.
+        (default 0: no limits)
+    taskMemory : int
+        Memory in MB of the requests that do not declare it (default 0: 
+        only the actual memory of the task is counted)
+    taskCpus : float
+        Number of cores of the requests that do not declare them (default 1)
+    enforceLimits : bool
+        Whether each task is limited to its declared memory and cores. The
+        task runs in its own cgroup when cgroupRoot is given (memory.max and
+        cpu.max), otherwise its address space is limited with setrlimit 
+        (the cores can not be limited without cgroups). (default False)
+    cgroupRoot : string, optional
+        A cgroup v2 folder delegated to the module (writable, without 
+        processes, with the memory and cpu controllers available) where the
+        cgroups of the tasks are created when enforceLimits is set
+        (default None: the limits are enforced with setrlimit)
     """
 
+    if profile != None and profile not in _PROFILERS:
+        raise ValueError("unknown profiler: '" + str(profile) + "'")
+
     # get absolute path
     storagePath = path.abspath(storagePath)
     # Set up the command-line options
@@ -105,6 +373,8 @@ def start(runCallback, apiVersion, moduleName, implementationName, \
     options, _ = parser.parse_args()
 
     app = flask.Flask(moduleName + ': ' + implementationName)
+    # uploaded files are written to the blob store while they are received
+    app.request_class = _BlobRequest
 
     app.config['runCallback'] = runCallback
     app.config['apiVersion'] = apiVersion
@@ -112,83 +382,571 @@ def start(runCallback, apiVersion, moduleName, implementationName, \
     app.config['storagePath'] = storagePath
     app.config['implementationName'] = implementationName
     app.config['maxTasks'] = maxTasks
-
-    capacityLock = threading.Lock()
+    app.config['maxBlobBytes'] = maxBlobBytes
+    if maxRequestBytes > 0:
+        app.config['MAX_CONTENT_LENGTH'] = maxRequestBytes
+
+    requestValidator = None
+    if requestTemplate != None:
+        if not isinstance(requestTemplate, dict):
+            with open(requestTemplate, "rt") as templateFile:
+                requestTemplate = json.load(templateFile)
+        requestValidator = CAOSjsonTester.compile_validator(requestTemplate)
+
+    metrics = _Metrics()
+    metrics.addCounter("caos_http_requests_total", "Http requests by route and status code", labelled=True)
+    metrics.addHistogram("caos_submit_duration_seconds", "Duration of the /submit requests, upload included", \
+        _SECONDS_BUCKETS)
+    metrics.addCounter("caos_uploaded_bytes_total", "Bytes received by the /submit requests")
+    metrics.addCounter("caos_tasks_completed_total", "Completed tasks by state", labelled=True)
+    for phase, description in _TASK_PHASES:
+        metrics.addHistogram("caos_task_" + phase + "_seconds", description, _SECONDS_BUCKETS)
+    metrics.addHistogram("caos_task_peak_rss_bytes", "Peak resident memory of the task processes", _BYTES_BUCKETS)
+
+    # the lock protects the processes of the running tasks and the timings
+    # recorded by the server for the tasks that are not completed yet
     processesMapLock = threading.Lock()
     processesMap = {}
+    taskTimings = {}
+    registry = _TaskRegistry()
+    completionQueue = multiprocessing.Queue()
+
+    pool = None
+    if workerPool:
+        poolSize = maxTasks if maxTasks > 0 else multiprocessing.cpu_count()
+        pool = _WorkerPool(poolSize, runCallback, workerMaxTasks, workerMaxMemory, completionQueue)
+        pool.start()
+        atexit.register(pool.shutdown)
+
+    trash = _initLocalStorage(storagePath, app, cleanStorage)
+    index = _TaskIndex(app.config["INDEX_PATH"])
+    _failOrphanedTasks(app, index)
+    blobStore = _BlobStore(app.config["BLOBS_DIR"])
+    app.config['blobStore'] = blobStore
+
+    resultCache = None
+    if cacheable:
+        resultCache = _ResultCache(app.config["CACHE_DIR"], app.config["TRASH_DIR"], cacheMaxBytes, cacheMaxEntries, \
+            index)
+
+    retention = None
+    if retentionMaxAge > 0 or retentionMaxBytes > 0 or retentionMaxTasks > 0:
+        retention = _RetentionCollector(registry, app, retentionMaxAge, retentionMaxBytes, retentionMaxTasks, \
+            retentionInterval, blobStore)
+        retention.start()
+    elif not cleanStorage:
+        # the storage used to be wiped at every start, now it grows forever
+        # unless a retention policy is set
+        print("WARNING: the storage " + storagePath + " is kept across restarts and no retention policy is set, " + \
+            "the completed tasks and the blobs are never removed (see retentionMaxAge, retentionMaxBytes, " + \
+            "retentionMaxTasks and cleanStorage)")
+
+    def indexTask(guid):
+        # completed and removed tasks are recorded in the task index
+        task = registry.get(guid)
+        if task == None:
+            index.removeTask(guid)
+        elif task["state"] not in _PENDING_STATES:
+            index.addTask(guid, task)
+
+    registry.addListener(indexTask)
+
+    def adoptStoredTasks():
+        # the tasks and the cached results of the previous runs are loaded 
+        # in the background, until then they are found in the local storage
+        # (see getTask)
+        try:
+            tasks, results = index.load()
+            for guid, task in tasks.items():
+                if path.isdir(_getCompletedTaskDir(guid, app)):
+                    task["lastAccess"] = task.get("completionTime") or time.time()
+                    registry.restore(guid, task)
+                else:
+                    index.removeTask(guid)
+            if resultCache != None:
+                resultCache.restore(results)
+        except Exception:
+            traceback.print_exc()
+        _removeTrash(app.config["TRASH_DIR"], trash)
+
+    adopter = threading.Thread(target=adoptStoredTasks)
+    adopter.daemon = True
+    adopter.start()
+
+    # the scheduler lock serializes the admission of the tasks to the queue
+    # and to the task slots
+    queue = None
+    schedulerLock = threading.Lock()
+    if queueMaxLength > 0:
+        queue = _AdmissionQueue(queueMaxLength)
+
+    def resourcesSampled():
+        # the queued tasks may fit in the resources released by the tasks
+        if queue != None:
+            dispatchTasks()
+
+    resources = None
+    if memoryBudget > 0 or cpuBudget > 0 or enforceLimits:
+        resources = _ResourceMonitor(memoryBudget * 1024 * 1024, cpuBudget, \
+            cgroupRoot if enforceLimits else None, resourcesSampled)
+        resources.start()
+
+    def collectCompletion(message):
+        guid = message["guid"]
 
+        processesMapLock.acquire()
+        timings = taskTimings.pop(guid, {})
+        processesMapLock.release()
+        timings, peakRss = _getTaskTimings(registry.get(guid), timings, message.get("timings"))
 
-    _initLocalStorage(storagePath, app)
+        # store the result before the completion is visible to clients
+        if resultCache != None:
+            try:
+                resultCache.taskCompleted(guid, _getCompletedTaskDir(guid, app), message["response"], \
+                    message["stackTrace"] == None)
+            except Exception:
+                traceback.print_exc()
+
+        # the resources of the task are free once it is completed, so they 
+        # are released before its completion is visible to clients as well
+        if resources != None:
+            resources.release(guid)
+
+        completed = registry.complete(guid, message["response"], message["blobs"], message["stackTrace"], \
+            timings, peakRss)
+        if completed:
+            taskCompleted(message["stackTrace"] == None, timings, peakRss)
+
+        # the process of a completed task must not be reachable anymore 
+        # from the /kill API (pool workers are going to be reused)
+        processesMapLock.acquire()
+        process = processesMap.pop(guid, None)
+        processesMapLock.release()
 
-    # ---- http APIs ----
+        if "workerPid" in message:
+            pool.workerDone(message["workerPid"], message["recycle"])
+        elif process != None:
+            process.join()
 
-    @app.route('/info', methods=['GET'])
-    def getInfo():
-        return flask.jsonify(
-            {
-                'apiVersion' : app.config['apiVersion'],
-                'moduleName' : app.config['moduleName'],
-                'implementationName' : app.config['implementationName'],
-                'runningTasks' : _getNumRunningTasks(app.config["RUNNING_DIR"]),
-                'maxTasks' : app.config['maxTasks']
-            }
-        )
+        # a task completed by /kill has already released its slot
+        if completed:
+            taskFinished(guid)
 
-    @app.route('/submit', methods=['POST'])
-    def postSubmit():
+    def failDeadTask(guid, process):
+        # completes the task of a process that exited without sending its 
+        # completion, unless the task has been completed by /kill meanwhile
+        processesMapLock.acquire()
+        try:
+            if processesMap.get(guid) is not process:
+                return
+            del processesMap[guid]
+            taskTimings.pop(guid, None)
+        finally:
+            processesMapLock.release()
+
+        if process.exitcode < 0:
+            message = "The task process was killed by signal " + str(-process.exitcode)
+        else:
+            message = "The task process exited with code " + str(process.exitcode) + " before completing the task"
+        taskDir = _getRunningTaskDir(guid, app)
+        completedTaskDir = _getCompletedTaskDir(guid, app)
+        if path.isdir(taskDir):
+            with open(path.join(taskDir, "error"), "wt") as errorFile:
+                errorFile.write(message)
+            with open(path.join(taskDir, "responseJsonPayload"), "wt") as resultJsonFile:
+                resultJsonFile.write(json.dumps({"message" : message}))
+            shutil.move(taskDir, completedTaskDir)
 
-        # get list of files send by the client
-        uploadedFiles = request.files
+        # the process may have died after storing its result
+        task = _loadTaskFromStorage(guid, app)
+        if task == None or task["state"] not in ("COMPLETED", "FAILED"):
+            task = {"response" : {"message" : message}, "blobs" : [], "stackTrace" : message}
+        success = task["stackTrace"] == None
+
+        if resultCache != None:
+            resultCache.taskCompleted(guid, completedTaskDir, task["response"], success)
+        if resources != None:
+            resources.release(guid)
+
+        completed = registry.complete(guid, task["response"], task["blobs"], task["stackTrace"])
+        if completed:
+            taskCompleted(success)
+
+        if pool != None:
+            pool.discard(process)
+        else:
+            process.join()
+
+        if completed:
+            taskFinished(guid)
+
+    def reapDeadTasks():
+        # the tasks whose process died without sending its completion (e.g.
+        # killed by the OOM killer, or unable to store its result) are 
+        # failed. A process sends its completion before exiting, so the 
+        # completions still in the queue are collected first.
+        processesMapLock.acquire()
+        dead = [(guid, process) for guid, process in processesMap.items() if not process.is_alive()]
+        processesMapLock.release()
+        if len(dead) == 0:
+            return
+        while True:
+            try:
+                message = completionQueue.get(False)
+            except _queue.Empty:
+                break
+            collectCompletion(message)
+        for guid, process in dead:
+            failDeadTask(guid, process)
+
+    def collectCompletedTasks():
+        lastReap = time.time()
+        while True:
+            try:
+                try:
+                    collectCompletion(completionQueue.get(timeout=_REAP_INTERVAL))
+                except _queue.Empty:
+                    pass
+                if time.time() - lastReap >= _REAP_INTERVAL:
+                    lastReap = time.time()
+                    reapDeadTasks()
+            except Exception:
+                traceback.print_exc()
+
+    collector = threading.Thread(target=collectCompletedTasks)
+    collector.daemon = True
+    collector.start()
+
+    def expireQueuedTasks():
+        while True:
+            time.sleep(_QUEUE_EXPIRE_INTERVAL)
+            schedulerLock.acquire()
+            try:
+                expired = queue.expire(time.time())
+            finally:
+                schedulerLock.release()
+            for guid in expired:
+                message = "Deadline expired while the task was queued"
+                failQueuedTask(guid, {"message" : message}, message)
+
+    if queue != None:
+        expirer = threading.Thread(target=expireQueuedTasks)
+        expirer.daemon = True
+        expirer.start()
+
+    def taskCompleted(success, timings={}, peakRss=None):
+        metrics.inc("caos_tasks_completed_total", labels=(("state", "COMPLETED" if success else "FAILED"),))
+        for phase, _ in _TASK_PHASES:
+            if phase in timings:
+                metrics.observe("caos_task_" + phase + "_seconds", timings[phase])
+        if peakRss != None:
+            metrics.observe("caos_task_peak_rss_bytes", peakRss)
+
+    # ---- task scheduling ----
+
+    def launchTask(guid, taskArgs):
+        # run the task in a new process (or in an idle worker of the pool)
+        processesMapLock.acquire()
+        try:
+            taskTimings.setdefault(guid, {})["launchTime"] = time.time()
+            if pool != None:
+                process = pool.submit(guid, taskArgs)
+            else:
+                process = multiprocessing.Process(target=_runWrapper, args=taskArgs + \
+                    (app.config["runCallback"], guid, completionQueue))
+                process.start()
+            processesMap[guid] = process
+        finally:
+            processesMapLock.release()
+        # the task process (or the worker) leads the process group of the task
+        if resources != None:
+            resources.taskStarted(guid, process.pid)
+
+    def dispatchTasks():
+        # starts the queued tasks while there are free task slots
+        while True:
+            schedulerLock.acquire()
+            try:
+                if maxTasks > 0 and registry.getNumRunning() >= maxTasks:
+                    return
+                entry = queue.pop(resources.reserve if resources != None else None)
+                if entry == None:
+                    return
+                registry.start(entry["guid"])
+            finally:
+                schedulerLock.release()
+            launchTask(entry["guid"], entry["taskArgs"])
+
+    def taskFinished(guid):
+        # a task slot is free, the next queued task can start
+        if resources != None:
+            resources.release(guid)
+        if queue == None:
+            return
+        task = registry.get(guid)
+        runTime = None
+        if task != None and task.get("startTime") != None and task.get("completionTime") != None:
+            runTime = task["completionTime"] - task["startTime"]
+        schedulerLock.acquire()
+        try:
+            queue.taskDone(guid, runTime)
+        finally:
+            schedulerLock.release()
+        dispatchTasks()
+
+    def failQueuedTask(guid, response, message):
+        # completes a task that has been removed from the queue
+        taskDir = _getRunningTaskDir(guid, app)
+        with open(path.join(taskDir, "error"), "wt") as errorFile:
+            errorFile.write(message)
+        with open(path.join(taskDir, "responseJsonPayload"), "wt") as resultJsonFile:
+            resultJsonFile.write(json.dumps(response))
+        shutil.move(taskDir, _getCompletedTaskDir(guid, app))
+        processesMapLock.acquire()
+        taskTimings.pop(guid, None)
+        processesMapLock.release()
+        if registry.complete(guid, response, [], message):
+            taskCompleted(False)
+        if resultCache != None:
+            resultCache.taskCompleted(guid, None, None, False)
+        if resources != None:
+            resources.release(guid)
+
+    # ---- task APIs, shared by the http servers ----
+
+    def getInfoData():
+        info = {
+            'apiVersion' : app.config['apiVersion'],
+            'moduleName' : app.config['moduleName'],
+            'implementationName' : app.config['implementationName'],
+            'runningTasks' : registry.getNumRunning(),
+            'maxTasks' : app.config['maxTasks']
+        }
+        if retention != None:
+            info['retention'] = retention.getCounters()
+        if resultCache != None:
+            info['cache'] = resultCache.getStats()
+        if queue != None:
+            schedulerLock.acquire()
+            try:
+                length = queue.getLength()
+                info['queue'] = {
+                    'length' : length,
+                    'maxLength' : queueMaxLength,
+                    'estimatedWait' : queue.estimateWait(length + 1, maxTasks)
+                }
+            finally:
+                schedulerLock.release()
+        if resources != None:
+            info['resources'] = resources.getStats()
+        return info
+
+    def getMetricsText():
+        gauges = [
+            ("caos_running_tasks", "Tasks running", registry.getNumRunning()),
+            ("caos_max_tasks", "Maximum number of running tasks (0: no limit)", maxTasks)
+        ]
+        if queue != None:
+            schedulerLock.acquire()
+            try:
+                gauges.append(("caos_queued_tasks", "Tasks waiting in the admission queue", queue.getLength()))
+            finally:
+                schedulerLock.release()
+        if resources != None:
+            stats = resources.getStats()
+            gauges.extend([
+                ("caos_task_memory_bytes", "Memory counted for the running tasks (the larger of declared and resident)",
+                    stats["usedMemory"]),
+                ("caos_task_memory_budget_bytes", "Memory that the running tasks can use (0: no limit)",
+                    stats["memoryBudget"]),
+                ("caos_task_cpus", "Cores counted for the running tasks (the larger of declared and used)",
+                    stats["usedCpus"]),
+                ("caos_task_cpu_budget", "Cores that the running tasks can use (0: no limit)", stats["cpuBudget"])
+            ])
+        return metrics.render(gauges)
+
+    def getStateData(taskId, task):
+        stateData = _getStateData(task)
+        if task["state"] == "QUEUED" and queue != None:
+            schedulerLock.acquire()
+            try:
+                position = queue.getPosition(taskId)
+                if position != None:
+                    stateData["position"] = position
+                    stateData["estimatedWait"] = queue.estimateWait(position, maxTasks)
+            finally:
+                schedulerLock.release()
+        return stateData
+
+    def storeBlob(blob, pinnedBlobs):
+        # blobs are either streams or _BlobWriter objects already holding 
+        # the uploaded data
+        if isinstance(blob, _BlobWriter):
+            blobHash = blob.commit(True)
+        else:
+            blobHash = blobStore.store(blob, True)
+        pinnedBlobs.append(blobHash)
+        return blobHash
+
+    def submitTask(jsonData, blobs, fields):
+        """Creates a task, returns the response data and the http code
+
+        'jsonData' is the content of the jsonPayload field (None if it is 
+        missing), 'blobs' maps the names of the uploaded blobs to their 
+        streams (or to _BlobWriter objects) and 'fields' maps the names of 
+        the other optional fields (see _RESERVED_FIELDS) to their content, 
+        plus "remoteAddress" to the address of the client.
+        """
+
+        # the blobs of the task are pinned in the store until they are 
+        # linked into its work dir, so that the retention can't remove them
+        pinnedBlobs = []
+        try:
+            return createTask(jsonData, blobs, fields, pinnedBlobs)
+        finally:
+            blobStore.unpin(pinnedBlobs)
+
+    def createTask(jsonData, blobs, fields, pinnedBlobs):
 
         # check and parse json_payload file
-        if "jsonPayload" not in uploadedFiles:
-            return _sendErrorData("'jsonPayload' file not found within the POST request", 400)
+        if jsonData == None:
+            return _getErrorData("'jsonPayload' file not found within the POST request"), 400
         try:
-            data = uploadedFiles['jsonPayload'].read()
-            jsonPayload = json.loads(data.decode("utf-8"))
+            jsonPayload = json.loads(jsonData.decode("utf-8"))
+
+        except Exception as e:
+            return _getErrorData("Unable to parse JSON from request field. Error: " + str(e)), 400
+
+        # validate the request before doing any work for the task
+        if requestValidator != None:
+            validationError = requestValidator.find_error(jsonPayload)
+            if validationError != None:
+                return _getErrorData("Invalid JSON request: " + str(validationError)), 400
 
+        # read the scheduling options
+        if queue != None:
+            try:
+                priority, clientId, deadline = _readQueueFields(fields)
+            except Exception as e:
+                return _getErrorData("Unable to parse the scheduling fields of the request. Error: " + str(e)), 400
+
+        # read the declared footprint of the task
+        if resources != None:
+            try:
+                memory, cpus = _readResourceFields(fields, taskMemory, taskCpus)
+            except Exception as e:
+                return _getErrorData("Unable to parse the resource fields of the request. Error: " + str(e)), 400
+            resourceError = resources.check(memory, cpus)
+            if resourceError != None:
+                return _getErrorData(resourceError), 400
+
+        # profile the callback if requested (by the request or globally)
+        try:
+            profiler = _readProfiler(fields.get("profile"), profile)
         except Exception as e:
-            return _sendErrorData("Unable to parse JSON from request field. Error: " + str(e), 400)
+            return _getErrorData("Unable to parse 'profile' from request field. Error: " + str(e)), 400
+
+        # check the blobs that are already stored by the module
+        try:
+            storedBlobs = _readBlobHashes(fields.get("blobHashes"))
+        except Exception as e:
+            return _getErrorData("Unable to parse 'blobHashes' from request field. Error: " + str(e)), 400
+        for blobName in list(storedBlobs.keys()) + list(blobs.keys()):
+            if not _isBlobName(blobName):
+                return _getErrorData("invalid blob name: '" + blobName + "', a file name is expected"), 400
+        for blobName, blobHash in storedBlobs.items():
+            if not blobStore.has(blobHash, True):
+                return _getErrorData("blob '" + blobName + "' with hash: '" + str(blobHash) + \
+                    "' not found, it must be uploaded"), 400
+            pinnedBlobs.append(blobHash)
 
         # generate task id
         guid = _genNewGuid()
         taskDir = _getRunningTaskDir(guid, app)
 
-        # check if we have enough capacity to handle the request
-        if app.config['maxTasks'] > 0:
+        blobHashes = dict(storedBlobs)
+
+        # complete the task with the cached result if available, the blobs
+        # must be stored in advance in order to compute the request hash
+        # (the profile of a task must come from its own execution)
+        cacheKey = None
+        if resultCache != None and profiler == None:
+            try:
+                for blobName in blobs:
+                    blobHashes[blobName] = storeBlob(blobs[blobName], pinnedBlobs)
+            except Exception as e:
+                return _getErrorData("Failed to store request data. Error: " + str(e)), 500
+            blobs = {}
+
+            cacheKey = _ResultCache.getKey(jsonPayload, blobHashes)
+            cached = resultCache.materialize(cacheKey, _getCompletedTaskDir(guid, app))
+            if cached != None:
+                response, resultBlobs = cached
+                with open(_getLogTaskPath(guid, app), "wt") as logFile:
+                    logFile.write("Result retrieved from the cache of the module\n")
+                registry.addCompleted(guid, response, resultBlobs)
+                taskCompleted(True)
+                return {"taskId" : guid}, 200
+
+        # check if we have enough capacity to handle the request (after this
+        # the task is considered to be running, or queued)
+        if resources != None:
+            resources.declare(guid, memory, cpus)
+        if queue == None:
+            if resources != None and not resources.reserve(guid):
+                resources.release(guid)
+                return _getErrorData("Resource limit exceeded: " + resources.describe() + ", retry later."), 503
+            running = registry.add(guid, app.config['maxTasks'])
+            if running < 0:
+                if resources != None:
+                    resources.release(guid)
+                return _getErrorData("Capacity limit exceeded: " + str(registry.getNumRunning()) + "/" + \
+                    str(app.config['maxTasks']) + " running tasks, retry later."), 503
+        else:
+            schedulerLock.acquire()
             try:
-                capacityLock.acquire()
-                running = _getNumRunningTasks(app.config["RUNNING_DIR"])
-                if running >= app.config['maxTasks']:
-                    return _sendErrorData("Capacity limit exceeded: " + str(running) + "/" + \
-                        str(app.config['maxTasks']) + " running tasks, retry later.", 503)
-                # create task folder (after this the task is considered to be running)
-                os.mkdir(taskDir)
+                freeSlots = max(maxTasks - registry.getNumRunning(), 0)
+                if (maxTasks > 0 or resources != None) and queue.isFull(freeSlots):
+                    if resources != None:
+                        resources.release(guid)
+                    return _getErrorData("Capacity limit exceeded: " + str(registry.getNumRunning()) + "/" + \
+                        str(app.config['maxTasks']) + " running tasks and " + str(queue.getLength()) + "/" + \
+                        str(queueMaxLength) + " queued tasks, retry later."), 503
+                registry.addQueued(guid)
+                queue.push(guid, priority, clientId, deadline)
             finally:
-                capacityLock.release()
-
-        blobs = {name : uploadedFiles[name].stream for name in uploadedFiles if name != "jsonPayload" }
+                schedulerLock.release()
+        admissionTime = time.time()
 
         # store task data
         try:
+            os.mkdir(taskDir)
             resultFolder = path.join(taskDir, "result")
             os.mkdir(resultFolder)
             workDir = path.join(taskDir, "wd")
             os.mkdir(workDir)
 
-            # store blobs
+            # store blobs (and link them into the work dir)
             for blobName in blobs:
-                with open(path.join(workDir, blobName), "wb") as blobFile:
-                    shutil.copyfileobj(blobs[blobName], blobFile)
+                blobHashes[blobName] = storeBlob(blobs[blobName], pinnedBlobs)
+            for blobName, blobHash in blobHashes.items():
+                blobStore.link(blobHash, path.join(workDir, blobName))
 
             # store json payload for debugging purposes
             with open(path.join(taskDir, "requestJsonPayload"), "wt") as jsonPayloadFile:
                 jsonPayloadFile.write(json.dumps(jsonPayload))
 
         except Exception as e:
-            if path.is_dir(taskDir):
+            registry.remove(guid)
+            if queue != None:
+                schedulerLock.acquire()
+                queue.remove(guid)
+                schedulerLock.release()
+            if resources != None:
+                resources.release(guid)
+            if path.isdir(taskDir):
                 _removePath(taskDir)
-            return _sendErrorData("Failed to store request data. Error: " + str(e), 500)
+            return _getErrorData("Failed to store request data. Error: " + str(e)), 500
 
         # run module
         # TODO: make this call async
@@ -196,71 +954,57 @@ def start(runCallback, apiVersion, moduleName, implementationName, \
         with open(logPath, "wt") as logFile:
             pass
 
-        # run the task in a new thread
-        completedTaskDir = _getCompletedTaskDir(guid, app)
-        process = multiprocessing.Process(target=_runWrapper, args=(jsonPayload, workDir, list(blobs.keys()), logPath, \
-            resultFolder, taskDir, completedTaskDir, app.config["runCallback"], guid))
+        if cacheKey != None:
+            resultCache.taskSubmitted(guid, cacheKey)
 
         processesMapLock.acquire()
-        processesMap[guid] = process
+        taskTimings[guid] = {"store" : time.time() - admissionTime}
         processesMapLock.release()
 
-        process.start()
+        completedTaskDir = _getCompletedTaskDir(guid, app)
+        limits = None
+        if enforceLimits:
+            limits = resources.getLimits(guid)
+        taskArgs = (jsonPayload, workDir, list(blobHashes.keys()), logPath, resultFolder, taskDir, completedTaskDir, \
+            profiler, limits)
+
+        if queue == None:
+            launchTask(guid, taskArgs)
+        else:
+            # the task can now be started by the scheduler
+            schedulerLock.acquire()
+            try:
+                queue.setReady(guid, taskArgs)
+            finally:
+                schedulerLock.release()
+            dispatchTasks()
 
         # return ID for further reference
-        return _sendJson({"taskId" : guid})
-
-    @app.route('/state/<taskId>', methods=['GET'])
-    def getState(taskId):
-        
-        runningTaskDir = _getRunningTaskDir(taskId, app)
-        if path.isdir(runningTaskDir):
-            return _sendJson({"state" : "RUNNING"})
-
-        completedTaskDir = _getCompletedTaskDir(taskId, app)
-        jsonResponsePath = path.join(completedTaskDir, "responseJsonPayload")
-        if path.isfile(jsonResponsePath):
-
-            # decode returned json payload
-            with open(jsonResponsePath, "rt") as jsonResponseFile:
-                jsonResponseRaw = jsonResponseFile.read()
+        return {"taskId" : guid}, 200
+
+    def getTask(taskId):
+        registry.touch(taskId)
+        task = registry.get(taskId)
+        if task == None:
+            # the task is not known in memory, fall back to the local storage
+            task = _loadTaskFromStorage(taskId, app)
+            if task != None and task["state"] in ("COMPLETED", "FAILED"):
+                registry.restore(taskId, task)
+        return task
+
+    def cancelTask(taskId):
+        """Kills a running (or queued) task, returns the response data and 
+        the http code"""
+        if queue != None:
+            schedulerLock.acquire()
             try:
-                jsonResponse = json.loads(jsonResponseRaw)
-            except Exception as e:
-                return _sendJson(
-                    {
-                        "state" : "SERVER_ERROR",
-                        "message" : "Failed to decode json response: " + str(e)
-                    }
-                )
-
-            # check for error file
-            errorFilePath = path.join(completedTaskDir, "error")
-            if path.isfile(errorFilePath):
-                with open(errorFilePath, "rt") as errorFile:
-                    stackTrace = errorFile.read()
-                jsonResponse["state"] = "FAILED"
-                jsonResponse["stackTrace"] = stackTrace
-                
-                return _sendJson(jsonResponse)
-
-            # get generated list of files
-            resultDir = path.join(completedTaskDir, "result")
-            blobs = os.listdir(resultDir)
-
-            return _sendJson(
-                {
-                    "state" : "COMPLETED",
-                    "blobs" : blobs,
-                    "response" : jsonResponse
-                }
-            )
-
-        return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+                cancelled = queue.cancel(taskId)
+            finally:
+                schedulerLock.release()
+            if cancelled:
+                failQueuedTask(taskId, {}, "Task cancelled by user")
+                return {}, 200
 
-    @app.route('/kill/<taskId>', methods=['GET'])
-    def killTask(taskId):
-        
         process = None
         processesMapLock.acquire()
         if taskId in processesMap:
@@ -268,23 +1012,29 @@ def start(runCallback, apiVersion, moduleName, implementationName, \
         processesMapLock.release()
 
         if process == None:
-            return _sendErrorData("task with ID: '" + taskId + "' not found or already completed", 404) 
+            return _getErrorData("task with ID: '" + taskId + "' not found or already completed"), 404
 
         # kill the process
         try:
             os.killpg(os.getpgid(process.pid), signal.SIGTERM)
         except:
-            return _sendErrorData("unable to find the process for ID: '" + taskId + "'", 404) 
+            return _getErrorData("unable to find the process for ID: '" + taskId + "'"), 404
 
         processesMapLock.acquire()
         if taskId in processesMap:
             del processesMap[taskId]
+        taskTimings.pop(taskId, None)
         processesMapLock.release()
 
         # wait for process to exit
         process.join()
 
+        # a killed worker is replaced by a fresh one
+        if pool != None:
+            pool.discard(process)
+
         taskDir = _getRunningTaskDir(taskId, app)
+        completedTaskDir = _getCompletedTaskDir(taskId, app)
 
         if path.isdir(taskDir):
             with open(path.join(taskDir, "error"), "wt") as errorFile:
@@ -294,68 +1044,581 @@ def start(runCallback, apiVersion, moduleName, implementationName, \
             with open(path.join(taskDir, "responseJsonPayload"), "wt") as resultJsonFile:
                 resultJsonFile.write(json.dumps(result))
 
-            completedTaskDir = _getCompletedTaskDir(taskId, app)
-
             # move task to completed
             shutil.move(taskDir, completedTaskDir)
 
-        return _sendJson({})
+            cancelled = True
+            task = {"state" : "FAILED", "response" : result, "blobs" : [], "stackTrace" : "Task cancelled by user"}
+        else:
+            # the task stored its result before being killed, but its 
+            # completion message may have been lost with the process
+            cancelled = False
+            task = _loadTaskFromStorage(taskId, app)
 
-    @app.route('/log/<taskId>', methods=['GET'])
-    def getLog(taskId):
-        offset = request.args.get('offset')
-        logPath = _getLogTaskPath(taskId, app)
-        if not path.isfile(logPath):
-            return _sendErrorData("logs for task with ID: '" + taskId + "' not found", 404)
+        # the bookkeeping is done by whoever completes the task, the 
+        # collector may have received the completion in the meantime
+        if task == None or task["state"] not in ("COMPLETED", "FAILED") or \
+            not registry.complete(taskId, task["response"], task["blobs"], task["stackTrace"]):
+            return _getErrorData("task with ID: '" + taskId + "' not found or already completed"), 404
 
-        with open(logPath, "rb") as logFile:
-            if(offset != None):
-                logFile.seek(int(offset))
-            data = logFile.read()
+        success = task["stackTrace"] == None
+        taskCompleted(success)
 
-        return flask.make_response(data)
+        if resultCache != None:
+            resultCache.taskCompleted(taskId, completedTaskDir, task["response"], success)
 
-    @app.route('/result/<taskId>/<filename>', methods=['GET'])
-    def getResult(taskId, filename):
+        taskFinished(taskId)
+
+        if not cancelled:
+            return _getErrorData("task with ID: '" + taskId + "' not found or already completed"), 404
+
+        return {}, 200
+
+    def getResultDir(taskId):
+        """Returns the result folder of a task and None, or None and the 
+        error data if the task is not completed"""
+        registry.touch(taskId)
         taskDir = _getCompletedTaskDir(taskId, app)
         if not path.isdir(taskDir):
-            return _sendErrorData("task with ID: '" + taskId + "' not found or not completed.", 404)
-        resultDir = path.join(taskDir, "result")
+            return None, _getErrorData("task with ID: '" + taskId + "' not found or not completed.")
+        return path.join(taskDir, "result"), None
+
+    def getResultPath(taskId, filename):
+        """Returns the path of a result blob and None, or None and the 
+        error data if the blob is not available"""
+        resultDir, errorData = getResultDir(taskId)
+        if resultDir == None:
+            return None, errorData
         filePath = path.join(resultDir, filename)
         if not path.isfile(filePath):
-            return _sendErrorData("unable to find result file: '" + filename + "' for task with ID: '" + taskId + "'", 404)
+            return None, _getErrorData("unable to find result file: '" + filename + "' for task with ID: '" + \
+                taskId + "'")
+        return filePath, None
+
+    # ---- http APIs ----
+
+    @app.before_request
+    def startRequest():
+        flask.g.requestStart = time.time()
+
+    @app.after_request
+    def countRequest(response):
+        route = _getRouteLabel(request.url_rule.rule if request.url_rule != None else None)
+        metrics.inc("caos_http_requests_total", labels=(("route", route), ("code", str(response.status_code))))
+        if route == "/submit":
+            metrics.observe("caos_submit_duration_seconds", time.time() - flask.g.requestStart)
+        return response
+
+    @app.after_request
+    def compressResponse(response):
+        # json responses are compressed if the client accepts it
+        if response.mimetype != "application/json" or response.direct_passthrough or \
+            "Content-Encoding" in response.headers:
+            return response
+        response.headers["Vary"] = "Accept-Encoding"
+        data = response.get_data()
+        encoding = _negotiateEncoding(request.headers.get("Accept-Encoding"))
+        if encoding != None and len(data) >= _COMPRESS_MIN_SIZE:
+            response.set_data(_compressData(data, encoding))
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    @app.route('/info', methods=['GET'])
+    def getInfo():
+        return flask.jsonify(getInfoData())
+
+    @app.route('/metrics', methods=['GET'])
+    def getMetrics():
+        return flask.Response(getMetricsText(), content_type=_METRICS_CONTENT_TYPE)
+
+    @app.route('/submit', methods=['POST'])
+    def postSubmit():
+        try:
+            # get list of files send by the client (each file is stored in
+            # the blob store by _BlobRequest while the request is parsed)
+            try:
+                uploadedFiles = request.files
+            except _BlobTooLarge as e:
+                return _sendErrorData(str(e), 413)
+
+            jsonData = None
+            if "jsonPayload" in uploadedFiles:
+                jsonData = uploadedFiles['jsonPayload'].read()
+            fields = {"remoteAddress" : request.remote_addr}
+            for name in _RESERVED_FIELDS[1:]:
+                if name in uploadedFiles:
+                    fields[name] = uploadedFiles[name].read()
+                elif name in request.form:
+                    fields[name] = request.form[name]
+            blobs = {name : uploadedFiles[name].stream for name in uploadedFiles if name not in _RESERVED_FIELDS}
+
+            responseData, code = submitTask(jsonData, blobs, fields)
+            return _sendJson(responseData, code)
+        finally:
+            # uploaded data that is not used by the task is removed
+            for writer in request.blobWriters:
+                writer.discard()
+            metrics.inc("caos_uploaded_bytes_total", sum(writer.size for writer in request.blobWriters))
+
+    @app.errorhandler(413)
+    def requestTooLarge(error):
+        message = "Request too large"
+        if maxRequestBytes > 0:
+            message += ", the maximum size is " + str(maxRequestBytes) + " bytes"
+        return _sendErrorData(message, 413)
+
+    @app.route('/blob/<blobHash>', methods=['HEAD'])
+    def headBlob(blobHash):
+        if not blobStore.has(blobHash):
+            return flask.make_response("", 404)
+        return flask.make_response("", 200)
 
-        return flask.send_from_directory(resultDir, filename)
+    @app.route('/state/<taskId>', methods=['GET'])
+    def getState(taskId):
+        task = getTask(taskId)
+        if task == None:
+            return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+
+        return _sendJson(getStateData(taskId, task))
+
+    @app.route('/wait/<taskId>', methods=['GET'])
+    def waitState(taskId):
+        # same as /state, but it waits up to 'timeout' seconds for the task to complete
+        try:
+            timeout = min(float(request.args.get('timeout', _WAIT_TIMEOUT)), _MAX_WAIT_TIMEOUT)
+        except ValueError:
+            return _sendErrorData("invalid timeout: '" + request.args.get('timeout') + "'", 400)
+
+        task = getTask(taskId)
+        if task == None:
+            return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+        if task["state"] in _PENDING_STATES:
+            task = registry.wait(taskId, timeout)
+            if task == None:
+                return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+
+        return _sendJson(getStateData(taskId, task))
+
+    @app.route('/events/<taskId>', methods=['GET'])
+    def getEvents(taskId):
+        # server-sent events stream with the state of the task, closed once the task is completed
+        task = getTask(taskId)
+        if task == None:
+            return _sendErrorData("task with ID: '" + taskId + "' not found.", 404)
+
+        def generateEvents(task):
+            # an event is sent on each change of state (QUEUED, RUNNING, completed)
+            yield _formatEvent("state", getStateData(taskId, task))
+            while task != None and task["state"] in _PENDING_STATES:
+                state = task["state"]
+                task = registry.wait(taskId, _EVENTS_KEEPALIVE, (state,))
+                if task == None:
+                    return
+                if task["state"] == state:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield _formatEvent("state", getStateData(taskId, task))
+
+        response = flask.Response(generateEvents(task), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    @app.route('/kill/<taskId>', methods=['GET'])
+    def killTask(taskId):
+        responseData, code = cancelTask(taskId)
+        return _sendJson(responseData, code)
+
+    @app.route('/log/<taskId>', methods=['GET'])
+    def getLog(taskId):
+        # the log is streamed starting from 'offset' (or from the standard
+        # http Range header), with follow=true the stream is kept open and 
+        # the new lines are sent as soon as they are written by the task
+        registry.touch(taskId)
+        logPath = _getLogTaskPath(taskId, app)
+        if not path.isfile(logPath):
+            return _sendErrorData("logs for task with ID: '" + taskId + "' not found", 404)
+        try:
+            start = int(request.args.get('offset', 0))
+        except ValueError:
+            return _sendErrorData("invalid offset: '" + request.args.get('offset') + "'", 400)
+        follow = request.args.get('follow', 'false').lower() == 'true'
+
+        logFile = open(logPath, "rb")
+        size = os.fstat(logFile.fileno()).st_size
+        end = None
+        status = 200
+        byteRange = _parseByteRange(request.headers.get('Range'), size)
+        if byteRange != None:
+            start, end = byteRange
+            if start >= size and not follow:
+                logFile.close()
+                response = _sendErrorData("requested range not satisfiable", 416)
+                response.headers["Content-Range"] = "bytes */" + str(size)
+                return response
+            status = 206
+        logFile.seek(start)
+
+        # the log is compressed if the client accepts it (byte ranges refer
+        # to the uncompressed log)
+        encoding = None
+        if byteRange == None:
+            encoding = _negotiateEncoding(request.headers.get("Accept-Encoding"))
+
+        if follow:
+            chunks = _followLog(logFile, taskId, registry)
+            length = None
+        else:
+            if end == None:
+                end = size - 1
+            length = max(end - start + 1, 0)
+            chunks = _readLog(logFile, length)
+        if encoding != None and (length == None or length >= _COMPRESS_MIN_SIZE):
+            # followed logs are flushed at each chunk, so the client gets 
+            # the new lines as soon as they are written
+            response = flask.Response(_compressChunks(chunks, encoding, follow), mimetype="text/plain")
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response = flask.Response(chunks, mimetype="text/plain")
+            if length != None:
+                response.headers["Content-Length"] = str(length)
+        if status == 206:
+            response.headers["Content-Range"] = "bytes " + str(start) + "-" + str(end) + "/" + str(size)
+        response.status_code = status
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    @app.route('/result/<taskId>/<filename>', methods=['GET'])
+    def getResult(taskId, filename):
+        filePath, errorData = getResultPath(taskId, filename)
+        if filePath == None:
+            return _sendJson(errorData, 404)
+
+        sendPath, encoding = _selectResultFile(filePath, request.headers.get("Accept-Encoding"), \
+            request.headers.get("Range"))
+        if encoding == None:
+            response = flask.send_from_directory(path.dirname(filePath), filename)
+        else:
+            response = flask.send_file(sendPath, mimetype=_guessMimeType(filename))
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    @app.route('/results/<archiveName>', methods=['GET'])
+    def getResults(archiveName):
+        # all the result blobs of a task as a single tar archive, generated
+        # while it is sent (<taskId>.tar, .tar.gz or .tar.zst)
+        taskId, encoding, errorData = _parseArchiveName(archiveName)
+        if taskId == None:
+            return _sendJson(errorData, 404)
+        resultDir, errorData = getResultDir(taskId)
+        if resultDir == None:
+            return _sendJson(errorData, 404)
+        chunks, headers = _streamArchive(resultDir, archiveName, encoding, request.headers.get("Accept-Encoding"))
+        return flask.Response(chunks, headers=headers)
 
     # ---- END http APIs ----
 
+    if server == "asyncio":
+        import CAOSAsyncServer
+        CAOSAsyncServer.serve(options.host, int(options.port), app, registry, blobStore, metrics, getInfoData, \
+            getMetricsText, submitTask, getTask, getStateData, cancelTask, getResultDir, getResultPath)
+        return
+
     app.run(debug=options.debug, host=options.host, port=int(options.port), threaded=threaded)
 
 
 # ---- private methods ----
 
 def _sendJson(responseData, code=200):
-    headers = {}
-    headers["Content-Type"] = ["application/json; charset=utf-8"]
     response = flask.jsonify(responseData)
-    response.headers = headers
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
     response.status_code = code
     return response
 
 def _sendErrorData(message, code):
-    responseData = { 'message' : message }
-    return _sendJson(responseData, code)
+    return _sendJson(_getErrorData(message), code)
+
+def _getErrorData(message):
+    return { 'message' : message }
 
-def _runWrapper(jsonPayload, workDir, blobNames, outLogPath, outBlobDir, taskDir, completedTaskDir, callback, guid):
+def _parseByteRange(rangeHeader, size):
+    # returns the (start, end) positions of a single "bytes=" range, other 
+    # kinds of ranges are ignored and the whole content is sent
+    if rangeHeader == None or not rangeHeader.startswith("bytes=") or "," in rangeHeader:
+        return None
+    try:
+        first, last = rangeHeader[len("bytes="):].strip().split("-")
+        if first == "":
+            return max(size - int(last), 0), size - 1
+        if last == "":
+            return int(first), size - 1
+        if int(last) < int(first):
+            return None
+        return int(first), min(int(last), size - 1)
+    except ValueError:
+        return None
+
+def _readLog(logFile, length):
+    try:
+        while length > 0:
+            data = logFile.read(min(length, _LOG_CHUNK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        logFile.close()
+
+def _followLog(logFile, taskId, registry):
+    # keep sending new data until the task is completed and the whole log
+    # has been sent
+    try:
+        running = True
+        while True:
+            data = logFile.read(_LOG_CHUNK_SIZE)
+            if data:
+                yield data
+                continue
+            if not running:
+                break
+            task = registry.wait(taskId, _LOG_FOLLOW_INTERVAL)
+            running = task != None and task["state"] in _PENDING_STATES
+    finally:
+        logFile.close()
+
+def _formatEvent(event, data):
+    return "event: " + event + "\ndata: " + json.dumps(data) + "\n\n"
+
+def _negotiateEncoding(acceptEncoding):
+    # returns the preferred content coding accepted by the client, None for
+    # the identity (the codings are weighted by their "q" parameter)
+    if not acceptEncoding:
+        return None
+    qualities = {}
+    for item in acceptEncoding.split(","):
+        params = item.split(";")
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[params[0].strip().lower()] = quality
+
+    best = None
+    for encoding in _ENCODINGS:
+        if encoding == "zstd" and zstandard == None:
+            continue
+        quality = qualities.get(encoding, qualities.get("*", 0))
+        if quality > 0 and (best == None or quality > qualities.get(best, qualities.get("*", 0))):
+            best = encoding
+    return best
+
+class _StreamCompressor(object):
+    """Incremental gzip or zstd compression of a response body, with 
+    'syncFlush' the compressed data is flushed at each chunk"""
+
+    def __init__(self, encoding, syncFlush=False):
+        if encoding == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compressobj()
+            self.flushMode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self.compressor = zlib.compressobj(_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.flushMode = zlib.Z_SYNC_FLUSH
+        self.syncFlush = syncFlush
+
+    def compress(self, data):
+        compressed = self.compressor.compress(data)
+        if self.syncFlush:
+            compressed += self.compressor.flush(self.flushMode)
+        return compressed
+
+    def finish(self):
+        return self.compressor.flush()
+
+def _compressData(data, encoding):
+    compressor = _StreamCompressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+def _compressChunks(chunks, encoding, syncFlush=False):
+    compressor = _StreamCompressor(encoding, syncFlush)
+    try:
+        for data in chunks:
+            compressed = compressor.compress(data)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    finally:
+        chunks.close()
+
+def _selectResultFile(filePath, acceptEncoding, rangeHeader):
+    # returns the file to send for a result blob and its content coding: the
+    # blob is compressed the first time it is requested and the compressed 
+    # file is kept in the "encoded" folder of the task. Range requests and 
+    # small or already compressed blobs are sent as they are.
+    encoding = _negotiateEncoding(acceptEncoding)
+    if encoding == None or rangeHeader != None or filePath.lower().endswith(_COMPRESSED_EXTENSIONS):
+        return filePath, None
+    try:
+        size = os.stat(filePath).st_size
+        if size < _COMPRESS_MIN_SIZE:
+            return filePath, None
+        encodedDir = path.join(path.dirname(path.dirname(filePath)), "encoded")
+        encodedPath = path.join(encodedDir, path.basename(filePath) + _ENCODING_SUFFIXES[encoding])
+        if not path.isfile(encodedPath):
+            _compressFile(filePath, encodedDir, encodedPath, encoding)
+        # blobs that do not compress are sent as they are
+        if os.stat(encodedPath).st_size >= size:
+            return filePath, None
+    except (IOError, OSError):
+        return filePath, None
+    return encodedPath, encoding
+
+def _compressFile(filePath, encodedDir, encodedPath, encoding):
+    # the blob is compressed to a temporary file renamed once completed, so
+    # concurrent requests never send a partial file
+    try:
+        os.mkdir(encodedDir)
+    except OSError:
+        if not path.isdir(encodedDir):
+            raise
+    tmpPath = encodedPath + "." + str(uuid.uuid4()) + ".tmp"
+    compressor = _StreamCompressor(encoding)
+    try:
+        with open(filePath, "rb") as blobFile:
+            with open(tmpPath, "wb") as encodedFile:
+                while True:
+                    data = blobFile.read(_BLOB_CHUNK_SIZE)
+                    if not data:
+                        break
+                    encodedFile.write(compressor.compress(data))
+                encodedFile.write(compressor.finish())
+        os.rename(tmpPath, encodedPath)
+    finally:
+        if path.isfile(tmpPath):
+            os.unlink(tmpPath)
+
+def _guessMimeType(filename):
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+def _parseArchiveName(archiveName):
+    # returns the task id and the compression of a result archive, or None 
+    # and the error data if the archive type is not supported
+    for suffix, encoding, _ in _ARCHIVE_TYPES:
+        if archiveName.endswith(suffix) and len(archiveName) > len(suffix):
+            if encoding == "zstd" and zstandard == None:
+                break
+            return archiveName[:-len(suffix)], encoding, None
+    return None, None, _getErrorData("unsupported result archive: '" + archiveName + "'")
+
+def _streamArchive(resultDir, archiveName, encoding, acceptEncoding):
+    # returns the chunks and the http headers of the tar archive of a result
+    # folder: a .tar.gz or .tar.zst archive is compressed with 'encoding',
+    # a plain .tar archive is sent with the content coding accepted by the
+    # client (or with its length, when it is not compressed)
+    archive = _ResultArchive(resultDir)
+    contentType = [item[2] for item in _ARCHIVE_TYPES if archiveName.endswith(item[0])][0]
+    headers = {"Content-Type" : contentType, \
+        "Content-Disposition" : "attachment; filename=\"" + archiveName + "\""}
+    chunks = archive.read()
+    if encoding == None:
+        headers["Vary"] = "Accept-Encoding"
+        contentEncoding = _negotiateEncoding(acceptEncoding)
+        if contentEncoding != None and archive.size >= _COMPRESS_MIN_SIZE:
+            chunks = _compressChunks(chunks, contentEncoding)
+            headers["Content-Encoding"] = contentEncoding
+        else:
+            headers["Content-Length"] = str(archive.size)
+    else:
+        chunks = _compressChunks(chunks, encoding)
+    return chunks, headers
+
+class _ResultArchive(object):
+    """Tar archive of the result folder of a task, generated on the fly: 
+    the tar headers are built in advance, so that the size of the archive
+    is known before sending it, while the files are read chunk by chunk 
+    when the archive is sent (symbolic links and special files are not 
+    archived)"""
+
+    def __init__(self, resultDir):
+        # list of (tar header, file path, file size)
+        self.entries = []
+        self.size = 0
+        for dirPath, dirNames, fileNames in os.walk(resultDir):
+            dirNames.sort()
+            for name in dirNames + sorted(fileNames):
+                filePath = path.join(dirPath, name)
+                try:
+                    fileStat = os.lstat(filePath)
+                except OSError:
+                    continue
+                info = tarfile.TarInfo(path.relpath(filePath, resultDir).replace(os.sep, "/"))
+                info.mode = stat.S_IMODE(fileStat.st_mode)
+                info.mtime = int(fileStat.st_mtime)
+                if stat.S_ISDIR(fileStat.st_mode):
+                    info.type = tarfile.DIRTYPE
+                elif stat.S_ISREG(fileStat.st_mode):
+                    info.size = fileStat.st_size
+                else:
+                    continue
+                header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "strict")
+                self.entries.append((header, filePath if info.isfile() else None, info.size))
+                self.size += len(header) + info.size + _getTarPadding(info.size)
+        # the archive ends with two empty blocks and it is padded to a 
+        # multiple of the record size, as done by tarfile
+        self.trailer = tarfile.BLOCKSIZE * 2
+        self.trailer += -(self.size + self.trailer) % tarfile.RECORDSIZE
+        self.size += self.trailer
+
+    def read(self):
+        """Generates the chunks of the archive"""
+        for header, filePath, size in self.entries:
+            yield header
+            if filePath == None:
+                continue
+            with open(filePath, "rb") as blobFile:
+                remaining = size
+                while remaining > 0:
+                    data = blobFile.read(min(remaining, _BLOB_CHUNK_SIZE))
+                    if not data:
+                        raise IOError("result file truncated while archiving: " + filePath)
+                    remaining -= len(data)
+                    yield data
+            if _getTarPadding(size) > 0:
+                yield b"\0" * _getTarPadding(size)
+        yield b"\0" * self.trailer
+
+def _getTarPadding(size):
+    return -size % tarfile.BLOCKSIZE
+
+def _runWrapper(jsonPayload, workDir, blobNames, outLogPath, outBlobDir, taskDir, completedTaskDir, profiler, \
+    limits, callback, guid, completionQueue=None, newSession=True):
     success = True
     errorMsg = ""
 
     # set new session id for the process, this is useful when we need
     # to kill the task and all the childreen processes spawn by the task
-    os.setsid()
-
+    # (workers of the pool already own a session)
+    if newSession:
+        os.setsid()
+        _resetSignals()
+
+    # the task can not use more than its declared footprint (the limits of
+    # a worker of the pool are restored once the callback returns)
+    savedLimits = _applyTaskLimits(limits)
+
+    # timestamps of the task process, the server computes the timing
+    # breakdown of the task from them
+    _resetPeakMemory()
+    timings = {"callbackStart" : time.time()}
     try:
-        result = callback(jsonPayload, workDir, blobNames, outLogPath, outBlobDir)
+        if profiler != None:
+            result = _runProfiled(profiler, callback, jsonPayload, workDir, blobNames, outLogPath, outBlobDir)
+        else:
+            result = callback(jsonPayload, workDir, blobNames, outLogPath, outBlobDir)
     except Error as e:
         success = False
         errorMsg = traceback.format_exc()
@@ -364,7 +1627,13 @@ def _runWrapper(jsonPayload, workDir, blobNames, outLogPath, outBlobDir, taskDir
         success = False
         errorMsg = traceback.format_exc()
         result = {'message' : str(e)}
-    
+    timings["callbackEnd"] = time.time()
+    taskCgroup = None
+    if savedLimits != None and savedLimits[0] == "cgroup":
+        taskCgroup = limits["cgroup"]
+    timings["peakRss"] = _getPeakMemory(taskCgroup, newSession)
+    _restoreTaskLimits(savedLimits)
+
     if not success:
         with open(path.join(taskDir, "error"), "wt") as errorFile:
             errorFile.write(errorMsg)
@@ -374,29 +1643,252 @@ def _runWrapper(jsonPayload, workDir, blobNames, outLogPath, outBlobDir, taskDir
 
     # move task to completed
     shutil.move(taskDir, completedTaskDir)
+    blobs = os.listdir(path.join(completedTaskDir, "result"))
+    timings["moveEnd"] = time.time()
+
+    # notify the server about the completion of the task
+    message = {
+        "guid" : guid,
+        "response" : result,
+        "blobs" : blobs,
+        "stackTrace" : None if success else errorMsg,
+        "timings" : timings
+    }
+    if completionQueue != None:
+        completionQueue.put(message)
+    return message
+
+def _applyTaskLimits(limits):
+    # moves the task process to its cgroup or limits its address space to 
+    # the current one plus the declared memory, returns what is needed to 
+    # restore the limits (see _ResourceMonitor.getLimits)
+    if limits == None:
+        return None
+    if limits["cgroup"] != None:
+        try:
+            _writeCgroupFile(limits["cgroup"], "cgroup.procs", str(os.getpid()))
+            return ("cgroup", limits["idleCgroup"])
+        except (IOError, OSError):
+            traceback.print_exc()
+    if limits["memory"] > 0:
+        try:
+            softLimit, hardLimit = resource.getrlimit(resource.RLIMIT_AS)
+            limit = _getVirtualMemory() + limits["memory"]
+            if hardLimit != resource.RLIM_INFINITY:
+                limit = min(limit, hardLimit)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hardLimit))
+            return ("rlimit", softLimit)
+        except (ValueError, OSError):
+            traceback.print_exc()
+    return None
+
+def _restoreTaskLimits(savedLimits):
+    if savedLimits == None:
+        return
+    kind, value = savedLimits
+    try:
+        if kind == "cgroup":
+            _writeCgroupFile(value, "cgroup.procs", str(os.getpid()))
+        else:
+            resource.setrlimit(resource.RLIMIT_AS, (value, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    except (ValueError, IOError, OSError):
+        traceback.print_exc()
+
+def _runProfiled(profiler, callback, jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
+    # runs the callback with the given profiler, the profile is stored as a
+    # result blob and its top functions are appended to the log (also when
+    # the callback fails)
+    profilePath = path.join(outBlobDir, _PROFILERS[profiler])
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+    else:
+        profile = _SamplingProfiler(_runProfiled.__code__)
+        profile.start()
+    try:
+        if profiler == "cprofile":
+            return profile.runcall(callback, jsonPayload, workDir, blobNames, outLogPath, outBlobDir)
+        return callback(jsonPayload, workDir, blobNames, outLogPath, outBlobDir)
+    finally:
+        try:
+            with open(outLogPath, "at") as logFile:
+                logFile.write("\n# profile of the task (" + profiler + "), stored in " + _PROFILERS[profiler] + "\n")
+                if profiler == "cprofile":
+                    profile.dump_stats(profilePath)
+                    pstats.Stats(profile, stream=logFile).sort_stats("cumulative").print_stats(_PROFILE_TOP)
+                else:
+                    profile.stop()
+                    profile.dumpStacks(profilePath)
+                    profile.printStats(logFile, _PROFILE_TOP)
+        except Exception:
+            # a failure of the profiler must not hide the result of the task
+            traceback.print_exc()
+
+def _readProfiler(data, default):
+    # optional "profile" field of a request, overrides the profiler of the
+    # module ("none" disables it)
+    if data == None:
+        return default
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    data = data.strip()
+    if data == "none":
+        return None
+    if data not in _PROFILERS:
+        raise Exception("unknown profiler: '" + data + "', expected one of: " + ", ".join(sorted(_PROFILERS)) + \
+            " or none")
+    return data
+
+def _initLocalStorage(storagePath, app, cleanStorage=False):
+    # the storage of the previous runs is kept, unless cleanStorage is set:
+    # in that case it is moved to the trash folder. Returns the names of 
+    # the files in the trash, to be removed in the background.
+    trashDir = path.join(storagePath, "trash")
+    for dirPath in (storagePath, trashDir):
+        if not path.isdir(dirPath):
+            os.mkdir(dirPath)
+    app.config["TRASH_DIR"] = trashDir
+    if cleanStorage:
+        previousDir = path.join(trashDir, "storage_" + str(uuid.uuid4()))
+        os.mkdir(previousDir)
+        for name in os.listdir(storagePath):
+            if name != "trash":
+                os.rename(path.join(storagePath, name), path.join(previousDir, name))
+
+    for name, key in (("logs", "LOG_DIR"), ("running", "RUNNING_DIR"), ("completed", "COMPLETED_DIR"), \
+        ("blobs", "BLOBS_DIR"), ("cache", "CACHE_DIR")):
+        dirPath = path.join(storagePath, name)
+        if not path.isdir(dirPath):
+            os.mkdir(dirPath)
+        app.config[key] = dirPath
+    app.config["INDEX_PATH"] = path.join(storagePath, "index.journal")
+
+    # blobs that were being uploaded are discarded
+    blobsTmpDir = path.join(app.config["BLOBS_DIR"], "tmp")
+    if path.isdir(blobsTmpDir):
+        os.rename(blobsTmpDir, path.join(trashDir, "blobs_" + str(uuid.uuid4())))
+    return os.listdir(trashDir)
+
+def _failOrphanedTasks(app, index):
+    # the tasks left in the running folder by the previous run (running or
+    # queued when the module was stopped) are completed as FAILED
+    message = "The module was restarted before the task was completed"
+    for guid in os.listdir(app.config["RUNNING_DIR"]):
+        taskDir = _getRunningTaskDir(guid, app)
+        try:
+            with open(path.join(taskDir, "error"), "wt") as errorFile:
+                errorFile.write(message)
+            response = {"message" : message}
+            with open(path.join(taskDir, "responseJsonPayload"), "wt") as resultJsonFile:
+                resultJsonFile.write(json.dumps(response))
+            resultDir = path.join(taskDir, "result")
+            blobs = os.listdir(resultDir) if path.isdir(resultDir) else []
+            os.rename(taskDir, _getCompletedTaskDir(guid, app))
+        except (IOError, OSError):
+            traceback.print_exc()
+            continue
+        index.addTask(guid, {"state" : "FAILED", "completionTime" : time.time(), "response" : response, \
+            "blobs" : blobs, "stackTrace" : message})
+
+def _removeTrash(trashDir, names):
+    for name in names:
+        trashPath = path.join(trashDir, name)
+        if path.isdir(trashPath):
+            _removePath(trashPath, True)
+        elif path.isfile(trashPath):
+            os.unlink(trashPath)
+
+def _getStateData(task):
+    if task["state"] in _PENDING_STATES:
+        return {"state" : task["state"]}
+
+    if task["state"] == "SERVER_ERROR":
+        return {"state" : "SERVER_ERROR", "message" : task["message"]}
+
+    # server side timestamps (seconds since the epoch) of the task
+    timestamps = {"submitted" : task.get("submitTime"), "started" : task.get("startTime"), \
+        "completed" : task.get("completionTime")}
+
+    if task["state"] == "FAILED":
+        stateData = dict(task["response"])
+        stateData["state"] = "FAILED"
+        stateData["stackTrace"] = task["stackTrace"]
+        stateData["timestamps"] = timestamps
+    else:
+        stateData = {
+            "state" : "COMPLETED",
+            "blobs" : task["blobs"],
+            "response" : task["response"],
+            "timestamps" : timestamps
+        }
+
+    # seconds spent in each phase and peak memory of the task process
+    if task.get("timings") != None:
+        stateData["timings"] = task["timings"]
+    if task.get("peakRss") != None:
+        stateData["peakRssBytes"] = task["peakRss"]
+    return stateData
+
+def _getTaskTimings(task, serverTimings, processTimings):
+    # returns the timing breakdown of a task (see _TASK_PHASES) and the peak
+    # memory of its process, from the timestamps of the registry, of the 
+    # server and of the task process
+    timings = {}
+    store = serverTimings.get("store")
+    if store != None:
+        timings["store"] = store
+    if task != None and task.get("startTime") != None and task.get("submitTime") != None:
+        # the request of a queued task is stored while it is queued
+        timings["queue"] = max(task["startTime"] - task["submitTime"] - (store or 0), 0)
+    if processTimings == None:
+        return timings, None
+
+    if "launchTime" in serverTimings:
+        timings["spawn"] = max(processTimings["callbackStart"] - serverTimings["launchTime"], 0)
+    timings["callback"] = processTimings["callbackEnd"] - processTimings["callbackStart"]
+    timings["move"] = processTimings["moveEnd"] - processTimings["callbackEnd"]
+    timings["collect"] = max(time.time() - processTimings["moveEnd"], 0)
+    return timings, processTimings.get("peakRss")
+
+def _getRouteLabel(rule):
+    # the first segment of the route identifies the API in /metrics (task
+    # ids and file names would create a time series for each request)
+    if rule == None:
+        return "unknown"
+    return "/" + rule.split("/")[1]
+
+def _loadTaskFromStorage(guid, app):
+    if path.isdir(_getRunningTaskDir(guid, app)):
+        return {"state" : "RUNNING"}
+
+    completedTaskDir = _getCompletedTaskDir(guid, app)
+    jsonResponsePath = path.join(completedTaskDir, "responseJsonPayload")
+    if not path.isfile(jsonResponsePath):
+        return None
+
+    # decode returned json payload
+    with open(jsonResponsePath, "rt") as jsonResponseFile:
+        jsonResponseRaw = jsonResponseFile.read()
+    try:
+        jsonResponse = json.loads(jsonResponseRaw)
+    except Exception as e:
+        return {"state" : "SERVER_ERROR", "message" : "Failed to decode json response: " + str(e)}
+
+    # check for error file
+    stackTrace = None
+    errorFilePath = path.join(completedTaskDir, "error")
+    if path.isfile(errorFilePath):
+        with open(errorFilePath, "rt") as errorFile:
+            stackTrace = errorFile.read()
 
-def _initLocalStorage(storagePath, app):
-    # remove previous storage path
-    if(path.isdir(storagePath)):
-        _removePath(storagePath, True)
-
-    # create storage
-    os.mkdir(storagePath)
-
-    logDir = path.join(storagePath, "logs")
-    os.mkdir(logDir)
-    app.config["LOG_DIR"] = logDir
-    runningDir = path.join(storagePath, "running")
-    os.mkdir(runningDir)
-    app.config["RUNNING_DIR"] = runningDir
-    completedDir = path.join(storagePath, "completed")
-    os.mkdir(completedDir)
-    app.config["COMPLETED_DIR"] = completedDir
-
-def _getNumRunningTasks(runningDir):
-    dirs = os.listdir(runningDir)
-    tasksDirs = [d for d in dirs if d.startswith("t_")]
-    return len(tasksDirs)
+    # get generated list of files
+    blobs = os.listdir(path.join(completedTaskDir, "result"))
+
+    return {
+        "state" : "FAILED" if stackTrace != None else "COMPLETED",
+        "response" : jsonResponse,
+        "blobs" : blobs,
+        "stackTrace" : stackTrace
+    }
 
 def _getRunningTaskDir(guid, app):
     return path.join(app.config["RUNNING_DIR"], guid)
@@ -428,3 +1920,1585 @@ def _removePath(dirPath, log=False):
     if log:
         print("deleting " + dirPath)
 
+
+class _WorkerPool(object):
+    """Pool of pre-forked processes that execute the tasks of the module
+
+    Each worker owns a session and runs one task at a time, hence while a 
+    task is running the whole process group of the worker belongs to the 
+    task and it can be killed by the /kill API. Killed or dead workers (and
+    workers that must be recycled) are replaced by fresh processes.
+    """
+
+    def __init__(self, size, callback, maxTasksPerWorker, maxMemory, completionQueue):
+        self.size = size
+        self.callback = callback
+        self.maxTasksPerWorker = maxTasksPerWorker
+        self.maxMemory = maxMemory
+        self.completionQueue = completionQueue
+        self.lock = threading.Lock()
+        self.idleWorkers = []
+        self.busyWorkers = {}
+
+    def start(self):
+        for _ in range(self.size):
+            self.idleWorkers.append(self._spawn())
+
+    def submit(self, guid, taskArgs):
+        """Sends the task to an idle worker and returns the worker process"""
+        self.lock.acquire()
+        try:
+            worker = None
+            while len(self.idleWorkers) > 0 and worker == None:
+                worker = self.idleWorkers.pop()
+                if not worker["process"].is_alive():
+                    _disposeWorker(worker)
+                    worker = None
+            if worker == None:
+                worker = self._spawn()
+            worker["conn"].send((guid, taskArgs))
+            self.busyWorkers[worker["process"].pid] = worker
+        finally:
+            self.lock.release()
+
+        return worker["process"]
+
+    def discard(self, process):
+        """Replaces a (killed) worker process with a new one"""
+        self.lock.acquire()
+        try:
+            worker = self.busyWorkers.pop(process.pid, None)
+        finally:
+            self.lock.release()
+
+        if worker != None:
+            _disposeWorker(worker)
+            self._addIdle(self._spawn())
+
+    def shutdown(self):
+        self.lock.acquire()
+        try:
+            workers = self.idleWorkers + list(self.busyWorkers.values())
+            self.idleWorkers = []
+            self.busyWorkers = {}
+        finally:
+            self.lock.release()
+
+        for worker in workers:
+            if worker["process"].is_alive():
+                try:
+                    os.killpg(worker["process"].pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            _disposeWorker(worker)
+
+    def _spawn(self):
+        parentConn, childConn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_workerLoop, args=(childConn, self.completionQueue, self.callback, \
+            self.maxTasksPerWorker, self.maxMemory))
+        process.start()
+        childConn.close()
+        return {"process" : process, "conn" : parentConn}
+
+    def _addIdle(self, worker):
+        self.lock.acquire()
+        self.idleWorkers.append(worker)
+        self.lock.release()
+
+    def workerDone(self, pid, recycle):
+        """Makes a worker available again once its task is completed"""
+        self.lock.acquire()
+        try:
+            worker = self.busyWorkers.pop(pid, None)
+            if worker != None and not recycle:
+                self.idleWorkers.append(worker)
+        finally:
+            self.lock.release()
+
+        if worker != None and recycle:
+            worker["process"].join()
+            _disposeWorker(worker)
+            self._addIdle(self._spawn())
+
+def _workerLoop(conn, completionQueue, callback, maxTasksPerWorker, maxMemory):
+    # the worker owns a session that is reused by all the tasks it executes
+    os.setsid()
+    _resetSignals()
+    parentPid = os.getppid()
+
+    executedTasks = 0
+    while True:
+        # other workers may hold a copy of our pipe, so the server exit is 
+        # detected by checking the parent process
+        while not conn.poll(1):
+            if os.getppid() != parentPid:
+                return
+        try:
+            guid, taskArgs = conn.recv()
+        except EOFError:
+            break
+
+        message = _runWrapper(*(taskArgs + (callback, guid)), newSession=False)
+        executedTasks += 1
+
+        recycle = (maxTasksPerWorker > 0 and executedTasks >= maxTasksPerWorker) or \
+            (maxMemory > 0 and _getProcessMemory() > maxMemory * 1024 * 1024)
+        message["workerPid"] = os.getpid()
+        message["recycle"] = recycle
+        completionQueue.put(message)
+        if recycle:
+            break
+
+def _resetSignals():
+    # a process forked by the asyncio server inherits the signal handlers 
+    # and the wakeup fd of its event loop, the signals received by the 
+    # task (e.g. from /kill) must not be forwarded to the server
+    try:
+        signal.set_wakeup_fd(-1)
+    except (ValueError, AttributeError):
+        pass
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+def _disposeWorker(worker):
+    worker["conn"].close()
+    if not worker["process"].is_alive():
+        worker["process"].join()
+
+def _getVirtualMemory():
+    # current size in bytes of the address space of the process
+    with open("/proc/self/statm", "rt") as statmFile:
+        return int(statmFile.read().split()[0]) * _PAGE_SIZE
+
+def _getProcessMemory():
+    # current resident set size in bytes
+    try:
+        with open("/proc/self/statm", "rt") as statmFile:
+            residentPages = int(statmFile.read().split()[1])
+        return residentPages * _PAGE_SIZE
+    except (IOError, OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _resetPeakMemory():
+    # the peak memory of a process is reset before each task, so that the
+    # workers of the pool report the peak of the current task (linux only)
+    try:
+        with open("/proc/self/clear_refs", "wt") as clearRefsFile:
+            clearRefsFile.write("5")
+    except (IOError, OSError):
+        pass
+
+def _getPeakMemory(cgroup, dedicatedProcess):
+    # peak memory in bytes of the current task: the peak of its cgroup (if
+    # any, the children of the task included), or the peak resident set 
+    # size of the process since _resetPeakMemory. The peak of the terminated
+    # children is added only for a process dedicated to the task, since for
+    # the workers of the pool it accumulates over all their tasks.
+    if cgroup != None:
+        try:
+            with open(path.join(cgroup, "memory.peak"), "rt") as peakFile:
+                return int(peakFile.read())
+        except (IOError, OSError, ValueError):
+            pass
+    try:
+        peak = 0
+        with open("/proc/self/status", "rt") as statusFile:
+            for line in statusFile:
+                if line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if dedicatedProcess:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+    return peak
+
+class _SamplingProfiler(object):
+    """Wall-clock sampling profiler of the current thread
+
+    A background thread records the stack of the profiled thread every 
+    _PROFILE_INTERVAL seconds, so the overhead does not depend on the 
+    number of function calls and the time spent waiting (e.g. for a child
+    process) is profiled too. The stacks are recorded up to the frame of 
+    'rootCode' (excluded).
+    """
+
+    def __init__(self, rootCode):
+        self.rootCode = rootCode
+        self.threadId = None
+        self.stacks = {}
+        self.numSamples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.threadId = threading.current_thread().ident
+        self.running = True
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _sample(self):
+        while True:
+            time.sleep(_PROFILE_INTERVAL)
+            if not self.running:
+                break
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame != None and frame.f_code is not self.rootCode:
+                code = frame.f_code
+                stack.append(code.co_name + " (" + code.co_filename + ":" + str(code.co_firstlineno) + ")")
+                frame = frame.f_back
+            if frame == None or len(stack) == 0:
+                # the thread is not running the profiled code
+                continue
+            stack = tuple(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.numSamples += 1
+
+    def dumpStacks(self, profilePath):
+        """Writes the collapsed stacks ("caller;callee count" lines)"""
+        with open(profilePath, "wt") as profileFile:
+            for stack, count in sorted(self.stacks.items()):
+                profileFile.write(";".join(stack) + " " + str(count) + "\n")
+
+    def printStats(self, output, top):
+        """Writes the functions with the most samples to the output file"""
+        total = {}
+        own = {}
+        for stack, count in self.stacks.items():
+            for function in set(stack):
+                total[function] = total.get(function, 0) + count
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+        output.write(str(self.numSamples) + " samples, one every " + str(int(_PROFILE_INTERVAL * 1000)) + "ms\n")
+        output.write("%8s %8s  %s\n" % ("total", "self", "function"))
+        functions = sorted(total, key=lambda function: (-total[function], function))[:top]
+        for function in functions:
+            output.write("%7.1f%% %7.1f%%  %s\n" % (100.0 * total[function] / self.numSamples, \
+                100.0 * own.get(function, 0) / self.numSamples, function))
+
+class _TaskRegistry(object):
+    """Thread-safe in-memory table of the tasks handled by the module
+
+    Each task is a dictionary with the task state, the submission, start and 
+    completion timestamps and, once completed, the parsed json response,
+    the list of result blobs and the optional stack trace of the error.
+    """
+
+    def __init__(self):
+        # the condition is notified every time a task is started, completed 
+        # or removed
+        self.lock = threading.Condition()
+        self.tasks = {}
+        self.numRunning = 0
+        self.listeners = []
+
+    def addListener(self, listener):
+        """Registers a function called with the task id every time a task is
+        started, completed or removed (outside of the registry lock)"""
+        self.listeners.append(listener)
+
+    def _notify(self, guid):
+        for listener in self.listeners:
+            listener(guid)
+
+    def add(self, guid, maxTasks=0):
+        """Adds a RUNNING task, returns -1 if maxTasks tasks are already running"""
+        self.lock.acquire()
+        try:
+            if maxTasks > 0 and self.numRunning >= maxTasks:
+                return -1
+            now = time.time()
+            self.tasks[guid] = {"state" : "RUNNING", "submitTime" : now, "startTime" : now, "completionTime" : None}
+            self.numRunning += 1
+            return self.numRunning
+        finally:
+            self.lock.release()
+
+    def addQueued(self, guid):
+        """Adds a QUEUED task, it does not use a task slot until it is started"""
+        self.lock.acquire()
+        try:
+            self.tasks[guid] = {"state" : "QUEUED", "submitTime" : time.time(), "startTime" : None, \
+                "completionTime" : None}
+        finally:
+            self.lock.release()
+
+    def start(self, guid):
+        """Moves a QUEUED task to the RUNNING state"""
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            if task == None or task["state"] != "QUEUED":
+                return
+            task["state"] = "RUNNING"
+            task["startTime"] = time.time()
+            self.numRunning += 1
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+        self._notify(guid)
+
+    def complete(self, guid, response, blobs, stackTrace=None, timings=None, peakRss=None):
+        """Completes a task, returns False if it is unknown or already completed"""
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            if task == None or task["state"] not in _PENDING_STATES:
+                return False
+            if task["state"] == "RUNNING":
+                self.numRunning -= 1
+            task["state"] = "FAILED" if stackTrace != None else "COMPLETED"
+            task["completionTime"] = time.time()
+            task["response"] = response
+            task["blobs"] = blobs
+            task["stackTrace"] = stackTrace
+            task["timings"] = timings
+            task["peakRss"] = peakRss
+            task["lastAccess"] = task["completionTime"]
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+        self._notify(guid)
+        return True
+
+    def addCompleted(self, guid, response, blobs):
+        """Adds a task that is already completed"""
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.tasks[guid] = {"state" : "COMPLETED", "submitTime" : now, "startTime" : now, "completionTime" : now, \
+                "lastAccess" : now, "response" : response, "blobs" : blobs, "stackTrace" : None}
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+        self._notify(guid)
+
+    def restore(self, guid, task):
+        """Adds a completed task loaded from the local storage"""
+        self.lock.acquire()
+        try:
+            if guid not in self.tasks:
+                task = dict(task)
+                task.setdefault("submitTime", None)
+                task.setdefault("startTime", None)
+                task.setdefault("completionTime", None)
+                task.setdefault("lastAccess", time.time())
+                self.tasks[guid] = task
+        finally:
+            self.lock.release()
+
+    def remove(self, guid):
+        self.lock.acquire()
+        try:
+            task = self.tasks.pop(guid, None)
+            if task != None and task["state"] == "RUNNING":
+                self.numRunning -= 1
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+        self._notify(guid)
+
+    def get(self, guid):
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            return dict(task) if task != None else None
+        finally:
+            self.lock.release()
+
+    def wait(self, guid, timeout, states=_PENDING_STATES):
+        """Waits up to timeout seconds for the task to leave the given states
+        (by default until it is completed)"""
+        deadline = time.time() + timeout
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            while task != None and task["state"] in states:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+                task = self.tasks.get(guid)
+            return dict(task) if task != None else None
+        finally:
+            self.lock.release()
+
+    def getNumRunning(self):
+        return self.numRunning
+
+    def touch(self, guid):
+        """Updates the last access time of a task"""
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            if task != None:
+                task["lastAccess"] = time.time()
+        finally:
+            self.lock.release()
+
+    def getCompletedTasks(self):
+        """Returns a list of (lastAccess, guid, size) of the completed tasks"""
+        self.lock.acquire()
+        try:
+            return [(task["lastAccess"], guid, task.get("size")) for guid, task in self.tasks.items() \
+                if task["state"] not in _PENDING_STATES]
+        finally:
+            self.lock.release()
+
+    def setSize(self, guid, size):
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            if task != None:
+                task["size"] = size
+        finally:
+            self.lock.release()
+
+class _TaskIndex(object):
+    """Persistent index of the completed tasks and of the cached results
+
+    The index is an append-only journal in the local storage, each line is
+    a json record: a completed task (state, response, result blobs and 
+    timestamps), a removed task, a cached result or an evicted result. A 
+    restarted module reads the journal in the background, instead of 
+    scanning the storage, and replaces it with a compacted copy. A line 
+    left incomplete by a crash is ignored.
+    """
+
+    def __init__(self, journalPath):
+        self.journalPath = journalPath
+        self.lock = threading.Lock()
+        self.journal = open(journalPath, "ab")
+        # records appended after an incomplete line must start on a new line
+        if self.journal.tell() > 0:
+            with open(journalPath, "rb") as journalFile:
+                journalFile.seek(-1, os.SEEK_END)
+                if journalFile.read(1) != b"\n":
+                    self._write(b"\n")
+
+    def addTask(self, guid, task):
+        record = {"task" : guid}
+        for key in ("state", "submitTime", "startTime", "completionTime", "response", "blobs", "stackTrace", \
+            "timings", "peakRss"):
+            if task.get(key) != None:
+                record[key] = task[key]
+        self._append(record)
+
+    def removeTask(self, guid):
+        self._append({"removedTask" : guid})
+
+    def addResult(self, key, entry):
+        self._append({"result" : key, "entry" : entry})
+
+    def removeResult(self, key):
+        self._append({"removedResult" : key})
+
+    def load(self):
+        """Reads and compacts the journal, returns the completed tasks (by 
+        id) and the cached results (in least recently used order)"""
+        tasks = collections.OrderedDict()
+        results = collections.OrderedDict()
+        with open(self.journalPath, "rb") as journalFile:
+            offset = _replayJournal(journalFile, tasks, results)
+
+        # the records appended in the meantime are read under the lock, then
+        # the journal is replaced by the records of the current tasks
+        self.lock.acquire()
+        try:
+            with open(self.journalPath, "rb") as journalFile:
+                journalFile.seek(offset)
+                _replayJournal(journalFile, tasks, results)
+            tmpPath = self.journalPath + ".tmp"
+            with open(tmpPath, "wb") as compactedFile:
+                for guid, task in tasks.items():
+                    record = {"task" : guid}
+                    record.update(task)
+                    compactedFile.write(_formatRecord(record))
+                for key, entry in results.items():
+                    compactedFile.write(_formatRecord({"result" : key, "entry" : entry}))
+            os.rename(tmpPath, self.journalPath)
+            self.journal.close()
+            self.journal = open(self.journalPath, "ab")
+        finally:
+            self.lock.release()
+        return tasks, results
+
+    def _append(self, record):
+        self._write(_formatRecord(record))
+
+    def _write(self, data):
+        self.lock.acquire()
+        try:
+            self.journal.write(data)
+            self.journal.flush()
+        finally:
+            self.lock.release()
+
+def _formatRecord(record):
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+def _replayJournal(journalFile, tasks, results):
+    # applies the records of the journal, returns the offset of the first 
+    # incomplete line (the end of the journal if there are none)
+    offset = journalFile.tell()
+    for line in journalFile:
+        if not line.endswith(b"\n"):
+            break
+        offset += len(line)
+        try:
+            record = json.loads(line.decode("utf-8"))
+        except ValueError:
+            continue
+        if "task" in record:
+            tasks[record.pop("task")] = record
+        elif "removedTask" in record:
+            tasks.pop(record["removedTask"], None)
+        elif "result" in record:
+            results.pop(record["result"], None)
+            results[record["result"]] = record["entry"]
+        elif "removedResult" in record:
+            results.pop(record["removedResult"], None)
+    return offset
+
+class _AdmissionQueue(object):
+    """Queue of the tasks waiting for a free task slot
+
+    The queued tasks are grouped by priority class (the higher class is 
+    served first) and, within a class, by client: the next task is taken 
+    from the client with the fewest running tasks (the least recently 
+    served one on ties), so a large batch of a client does not starve the 
+    requests of the others. A task can be started only once its request 
+    has been stored (setReady). The queue is not thread-safe, the calls 
+    are serialized by the caller.
+    """
+
+    def __init__(self, maxLength):
+        self.maxLength = maxLength
+        # priority -> OrderedDict of clientId -> list of queued entries
+        self.classes = {}
+        self.entries = {}
+        # number of running tasks of each client and client of each task
+        self.running = {}
+        self.runningClients = {}
+        # order in which the clients have been served
+        self.lastServed = {}
+        self.numServed = 0
+        # moving average of the run time of the tasks
+        self.runTime = None
+
+    def isFull(self, freeSlots=0):
+        """Returns True if a new task can not be queued, the tasks that are 
+        going to use one of the 'freeSlots' are not counted"""
+        return len(self.entries) >= self.maxLength + freeSlots
+
+    def getLength(self):
+        return len(self.entries)
+
+    def push(self, guid, priority, clientId, deadline=0):
+        """Adds a task, 'deadline' is the maximum number of seconds the task
+        can wait in the queue (0: no limit)"""
+        entry = {"guid" : guid, "priority" : priority, "clientId" : clientId, "taskArgs" : None, \
+            "expireTime" : time.time() + deadline if deadline > 0 else None}
+        self.entries[guid] = entry
+        clients = self.classes.setdefault(priority, collections.OrderedDict())
+        clients.setdefault(clientId, []).append(entry)
+
+    def setReady(self, guid, taskArgs):
+        entry = self.entries.get(guid)
+        if entry != None:
+            entry["taskArgs"] = taskArgs
+
+    def remove(self, guid):
+        entry = self.entries.pop(guid, None)
+        if entry == None:
+            return None
+        clients = self.classes[entry["priority"]]
+        clients[entry["clientId"]].remove(entry)
+        if len(clients[entry["clientId"]]) == 0:
+            del clients[entry["clientId"]]
+            self._forgetClient(entry["clientId"])
+        if len(clients) == 0:
+            del self.classes[entry["priority"]]
+        return entry
+
+    def cancel(self, guid):
+        """Removes a task that is ready to start, returns False otherwise"""
+        entry = self.entries.get(guid)
+        if entry == None or entry["taskArgs"] == None:
+            return False
+        self.remove(guid)
+        return True
+
+    def pop(self, canStart=None):
+        """Removes and returns the next task to start (None if there are no 
+        tasks ready to start, or if 'canStart' returns False for the id of
+        the next task), the task is counted as running"""
+        for priority in sorted(self.classes, reverse=True):
+            clients = self.classes[priority]
+            ready = [clientId for clientId in clients if clients[clientId][0]["taskArgs"] != None]
+            if len(ready) == 0:
+                continue
+            clientId = min(ready, key=self._getClientRank)
+            if canStart != None and not canStart(clients[clientId][0]["guid"]):
+                return None
+            entry = self.remove(clients[clientId][0]["guid"])
+            self.running[clientId] = self.running.get(clientId, 0) + 1
+            self.runningClients[entry["guid"]] = clientId
+            self.numServed += 1
+            self.lastServed[clientId] = self.numServed
+            return entry
+        return None
+
+    def taskDone(self, guid, runTime=None):
+        """Releases the task slot of a task started by the queue"""
+        clientId = self.runningClients.pop(guid, None)
+        if clientId == None:
+            return
+        self.running[clientId] -= 1
+        if self.running[clientId] == 0:
+            del self.running[clientId]
+            self._forgetClient(clientId)
+        if runTime != None:
+            if self.runTime == None:
+                self.runTime = runTime
+            else:
+                self.runTime += _RUN_TIME_WEIGHT * (runTime - self.runTime)
+
+    def expire(self, now):
+        """Removes and returns the ids of the tasks past their deadline"""
+        expired = [guid for guid, entry in self.entries.items() if entry["taskArgs"] != None and \
+            entry["expireTime"] != None and entry["expireTime"] <= now]
+        for guid in expired:
+            self.remove(guid)
+        return expired
+
+    def getPosition(self, guid):
+        """Returns the estimated position (starting from 1) of a task in the 
+        order in which the queued tasks will be started"""
+        entry = self.entries.get(guid)
+        if entry == None:
+            return None
+        ahead = 0
+        for priority, clients in self.classes.items():
+            if priority > entry["priority"]:
+                ahead += sum(len(entries) for entries in clients.values())
+        # the clients of the same class are served in turn
+        clients = self.classes[entry["priority"]]
+        index = clients[entry["clientId"]].index(entry)
+        rank = self._getClientRank(entry["clientId"])
+        for clientId, entries in clients.items():
+            if clientId == entry["clientId"]:
+                ahead += index
+            elif self._getClientRank(clientId) < rank:
+                ahead += min(len(entries), index + 1)
+            else:
+                ahead += min(len(entries), index)
+        return ahead + 1
+
+    def estimateWait(self, position, maxTasks):
+        """Estimated number of seconds before the task at the given position
+        is started (None until a task has been completed)"""
+        if self.runTime == None or maxTasks <= 0:
+            return None
+        return round(float(position) / maxTasks * self.runTime, 3)
+
+    def _getClientRank(self, clientId):
+        return (self.running.get(clientId, 0), self.lastServed.get(clientId, 0))
+
+    def _forgetClient(self, clientId):
+        # the history of the clients without tasks is not kept
+        if clientId in self.running:
+            return
+        for clients in self.classes.values():
+            if clientId in clients:
+                return
+        self.lastServed.pop(clientId, None)
+
+class _Metrics(object):
+    """Thread-safe counters and histograms of the module, exposed by 
+    /metrics in the Prometheus text format
+
+    The metrics are declared once by addCounter and addHistogram, counters 
+    can be split by labels while histograms have no labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = collections.OrderedDict()
+
+    def addCounter(self, name, description, labelled=False):
+        values = collections.OrderedDict()
+        if not labelled:
+            values[()] = 0
+        self.metrics[name] = {"type" : "counter", "help" : description, "values" : values}
+
+    def addHistogram(self, name, description, buckets):
+        self.metrics[name] = {"type" : "histogram", "help" : description, "buckets" : buckets, \
+            "counts" : [0] * len(buckets), "sum" : 0, "count" : 0}
+
+    def inc(self, name, value=1, labels=()):
+        """Increments a counter, 'labels' is a tuple of (name, value) pairs"""
+        self.lock.acquire()
+        try:
+            values = self.metrics[name]["values"]
+            values[labels] = values.get(labels, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value):
+        """Adds a value to a histogram"""
+        self.lock.acquire()
+        try:
+            metric = self.metrics[name]
+            for i, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    metric["counts"][i] += 1
+                    break
+            metric["sum"] += value
+            metric["count"] += 1
+        finally:
+            self.lock.release()
+
+    def render(self, gauges=()):
+        """Returns the metrics in the Prometheus text format, 'gauges' is a
+        list of (name, description, value) of the current values to add"""
+        lines = []
+        self.lock.acquire()
+        try:
+            for name, metric in self.metrics.items():
+                lines.append("# HELP " + name + " " + metric["help"])
+                lines.append("# TYPE " + name + " " + metric["type"])
+                if metric["type"] == "counter":
+                    for labels, value in metric["values"].items():
+                        lines.append(name + _formatLabels(labels) + " " + _formatNumber(value))
+                    continue
+                # the counts of the buckets are stored separately and 
+                # reported cumulatively
+                count = 0
+                for bound, bucketCount in zip(metric["buckets"], metric["counts"]):
+                    count += bucketCount
+                    lines.append(name + "_bucket" + _formatLabels((("le", _formatNumber(bound)),)) + " " + str(count))
+                lines.append(name + '_bucket{le="+Inf"} ' + str(metric["count"]))
+                lines.append(name + "_sum " + _formatNumber(metric["sum"]))
+                lines.append(name + "_count " + str(metric["count"]))
+        finally:
+            self.lock.release()
+
+        for name, description, value in gauges:
+            lines.append("# HELP " + name + " " + description)
+            lines.append("# TYPE " + name + " gauge")
+            lines.append(name + " " + _formatNumber(value))
+        return "\n".join(lines) + "\n"
+
+def _formatLabels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(name + '="' + _escapeLabel(value) + '"' for name, value in labels) + "}"
+
+def _escapeLabel(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _formatNumber(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class _RetentionCollector(object):
+    """Background thread that removes the files of old completed tasks
+
+    Completed tasks are evicted, least recently accessed first, when they 
+    have not been accessed for maxAge seconds or while the completed tasks
+    exceed maxTasks or maxBytes. Stored blobs are evicted as well, least 
+    recently used first, when they have not been used for maxAge seconds or
+    while the completed tasks and the blobs exceed maxBytes. Evictions are 
+    performed in small batches: the task files are atomically moved to the
+    trash folder and then removed by this thread, so request threads are 
+    never stalled.
+    """
+
+    def __init__(self, registry, app, maxAge, maxBytes, maxTasks, interval, blobStore):
+        self.registry = registry
+        self.blobStore = blobStore
+        self.app = app
+        self.maxAge = maxAge
+        self.maxBytes = maxBytes
+        self.maxTasks = maxTasks
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counters = {"sweeps" : 0, "evictedTasks" : 0, "evictedBytes" : 0, "evictedBlobs" : 0}
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def getCounters(self):
+        self.lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self.lock.release()
+
+    def sweep(self):
+        tasks = []
+        for lastAccess, guid, size in self.registry.getCompletedTasks():
+            if size == None:
+                size = _getTaskSize(guid, self.app)
+                self.registry.setSize(guid, size)
+            tasks.append((lastAccess, guid, size))
+
+        # select the tasks to evict, least recently accessed first
+        tasks.sort()
+        now = time.time()
+        numTasks = len(tasks)
+        totalBytes = sum(size for _, _, size in tasks)
+        evicted = []
+        for lastAccess, guid, size in tasks:
+            if not ((self.maxAge > 0 and now - lastAccess > self.maxAge) or \
+                (self.maxTasks > 0 and numTasks > self.maxTasks) or \
+                (self.maxBytes > 0 and totalBytes > self.maxBytes)):
+                break
+            evicted.append((guid, size))
+            numTasks -= 1
+            totalBytes -= size
+
+        # a task that can not be evicted must not stop the other evictions
+        for i in range(0, len(evicted), _RETENTION_BATCH):
+            for guid, size in evicted[i:i + _RETENTION_BATCH]:
+                try:
+                    self._evict(guid, size)
+                except Exception:
+                    traceback.print_exc()
+            time.sleep(_RETENTION_PAUSE)
+
+        # tasks keep their own link to the blobs, so blobs can be removed 
+        # from the store unless a task being created is about to link them
+        evictedBlobs = 0
+        if self.maxAge > 0 or self.maxBytes > 0:
+            blobs = sorted((lastUse, blobHash, size) for blobHash, lastUse, size in self.blobStore.list())
+            blobBytes = sum(size for _, _, size in blobs)
+            for lastUse, blobHash, size in blobs:
+                if not ((self.maxAge > 0 and now - lastUse > self.maxAge) or \
+                    (self.maxBytes > 0 and totalBytes + blobBytes > self.maxBytes)):
+                    break
+                if self.blobStore.removeUnused(blobHash, lastUse):
+                    evictedBlobs += 1
+                    blobBytes -= size
+
+        self.lock.acquire()
+        self.counters["sweeps"] += 1
+        self.counters["evictedBlobs"] += evictedBlobs
+        self.lock.release()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                traceback.print_exc()
+
+    def _evict(self, guid, size):
+        # move the files out of the storage first, so the task disappears 
+        # atomically (a previous attempt may have left its own trash folder)
+        trashDir = path.join(self.app.config["TRASH_DIR"], guid + "_" + str(uuid.uuid4()))
+        os.mkdir(trashDir)
+        completedTaskDir = _getCompletedTaskDir(guid, self.app)
+        if path.isdir(completedTaskDir):
+            os.rename(completedTaskDir, path.join(trashDir, "task"))
+        logPath = _getLogTaskPath(guid, self.app)
+        if path.isfile(logPath):
+            os.rename(logPath, path.join(trashDir, "log.txt"))
+        self.registry.remove(guid)
+
+        shutil.rmtree(trashDir, ignore_errors=True)
+
+        self.lock.acquire()
+        self.counters["evictedTasks"] += 1
+        self.counters["evictedBytes"] += size
+        self.lock.release()
+
+def _getTaskSize(guid, app):
+    size = 0
+    logPath = _getLogTaskPath(guid, app)
+    if path.isfile(logPath):
+        size += path.getsize(logPath)
+    return size + _getTreeSize(_getCompletedTaskDir(guid, app))
+
+def _getTreeSize(dirPath):
+    size = 0
+    for subDirPath, _, fileNames in os.walk(dirPath):
+        for fileName in fileNames:
+            try:
+                size += os.lstat(path.join(subDirPath, fileName)).st_size
+            except OSError:
+                pass
+    return size
+
+class _BlobStore(object):
+    """Content-addressed storage of the uploaded blobs
+
+    Blobs are stored once in the blobs folder, named after the SHA-256 of 
+    their content and read-only. Tasks get a copy-on-write clone (reflink) 
+    of the blob when the file system supports it, or a hard link otherwise.
+    The modification time of a blob is its last use. A blob can be pinned 
+    while a task is being created, pinned blobs are not removed until they
+    are unpinned.
+    """
+
+    def __init__(self, blobsDir):
+        self.blobsDir = blobsDir
+        self.tmpDir = path.join(blobsDir, "tmp")
+        os.mkdir(self.tmpDir)
+        self.lock = threading.Lock()
+        self.pins = {}
+
+    def has(self, blobHash, pin=False):
+        """Returns True if the blob is stored, and marks it as used (and 
+        pinned if 'pin')"""
+        if not _isBlobHash(blobHash):
+            return False
+        self.lock.acquire()
+        try:
+            os.utime(path.join(self.blobsDir, blobHash), None)
+        except OSError:
+            return False
+        else:
+            if pin:
+                self.pins[blobHash] = self.pins.get(blobHash, 0) + 1
+            return True
+        finally:
+            self.lock.release()
+
+    def unpin(self, blobHashes):
+        self.lock.acquire()
+        try:
+            for blobHash in blobHashes:
+                self.pins[blobHash] -= 1
+                if self.pins[blobHash] == 0:
+                    del self.pins[blobHash]
+        finally:
+            self.lock.release()
+
+    def store(self, stream, pin=False):
+        """Stores the content of the stream while hashing it, returns the hash"""
+        writer = self.open()
+        try:
+            while True:
+                data = stream.read(_BLOB_CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+            return writer.commit(pin)
+        finally:
+            writer.discard()
+
+    def open(self, maxBytes=0):
+        """Returns a _BlobWriter to store a blob received in chunks, writing
+        more than maxBytes (if not 0) raises a _BlobTooLarge exception"""
+        return _BlobWriter(self, path.join(self.tmpDir, str(uuid.uuid4())), maxBytes)
+
+    def _add(self, tmpPath, blobHash, pin=False):
+        self.lock.acquire()
+        try:
+            blobPath = path.join(self.blobsDir, blobHash)
+            if path.isfile(blobPath):
+                os.unlink(tmpPath)
+                os.utime(blobPath, None)
+            else:
+                os.chmod(tmpPath, 0o444)
+                os.rename(tmpPath, blobPath)
+            if pin:
+                self.pins[blobHash] = self.pins.get(blobHash, 0) + 1
+        finally:
+            self.lock.release()
+
+    def link(self, blobHash, destPath):
+        blobPath = path.join(self.blobsDir, blobHash)
+        try:
+            with open(blobPath, "rb") as blobFile:
+                with open(destPath, "wb") as destFile:
+                    fcntl.ioctl(destFile.fileno(), _FICLONE, blobFile.fileno())
+            return
+        except (IOError, OSError):
+            if path.isfile(destPath):
+                os.unlink(destPath)
+        try:
+            os.link(blobPath, destPath)
+        except OSError:
+            shutil.copyfile(blobPath, destPath)
+
+    def list(self):
+        """Returns a list of (hash, lastUse, size) of the stored blobs"""
+        blobs = []
+        for blobHash in os.listdir(self.blobsDir):
+            if _isBlobHash(blobHash):
+                try:
+                    blobStat = os.stat(path.join(self.blobsDir, blobHash))
+                    blobs.append((blobHash, blobStat.st_mtime, blobStat.st_size))
+                except OSError:
+                    pass
+        return blobs
+
+    def removeUnused(self, blobHash, lastUse):
+        """Removes the blob if it is not pinned and not used after lastUse 
+        (as returned by list), returns True if removed"""
+        self.lock.acquire()
+        try:
+            if blobHash in self.pins:
+                return False
+            blobPath = path.join(self.blobsDir, blobHash)
+            if os.stat(blobPath).st_mtime > lastUse:
+                return False
+            os.unlink(blobPath)
+            return True
+        except OSError:
+            return False
+        finally:
+            self.lock.release()
+
+class _BlobWriter(object):
+    """Blob being written to a temporary file of the blob store, the blob is
+    added to the store by commit (which returns its hash) and the temporary
+    file is removed by discard if the blob is not committed. The content
+    can be read back before the commit (e.g. for the jsonPayload field).
+    Small blobs are kept in memory and they are written to a file only when
+    committed, if not already stored."""
+
+    def __init__(self, blobStore, tmpPath, maxBytes=0):
+        self.blobStore = blobStore
+        self.tmpPath = tmpPath
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.blobHash = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.maxBytes > 0 and self.size > self.maxBytes:
+            raise _BlobTooLarge("Blob too large, the maximum size is " + str(self.maxBytes) + " bytes")
+        self.sha256.update(data)
+        if self.file == None and self.size > _BLOB_MEMORY_SIZE:
+            self._openFile()
+        (self.file or self.buffer).write(data)
+
+    def seek(self, offset, whence=0):
+        return (self.file or self.buffer).seek(offset, whence)
+
+    def read(self, size=-1):
+        return (self.file or self.buffer).read(size)
+
+    def commit(self, pin=False):
+        if self.blobHash == None:
+            blobHash = self.sha256.hexdigest()
+            if self.file == None and not self.blobStore.has(blobHash, pin):
+                self._openFile()
+            if self.file != None:
+                self.file.close()
+                self.blobStore._add(self.tmpPath, blobHash, pin)
+            self.blobHash = blobHash
+        return self.blobHash
+
+    def discard(self):
+        if self.blobHash == None and self.file != None:
+            self.file.close()
+            if path.isfile(self.tmpPath):
+                os.unlink(self.tmpPath)
+
+    def _openFile(self):
+        self.file = open(self.tmpPath, "w+b")
+        self.file.write(self.buffer.getvalue())
+        self.file.seek(self.buffer.tell())
+        self.buffer = None
+
+class _BlobTooLarge(Exception):
+    pass
+
+class _BlobRequest(flask.Request):
+    """Flask request that parses the uploaded files directly into the blob 
+    store, the files are hashed while they are received and they are never
+    held in memory or copied to other temporary files"""
+
+    def __init__(self, *args, **kwargs):
+        super(_BlobRequest, self).__init__(*args, **kwargs)
+        self.blobWriters = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        config = flask.current_app.config
+        writer = config["blobStore"].open(config["maxBlobBytes"])
+        self.blobWriters.append(writer)
+        return writer
+
+def _isBlobHash(blobHash):
+    try:
+        return re.match("^[0-9a-f]{64}$", blobHash) != None
+    except TypeError:
+        return False
+
+def _isBlobName(blobName):
+    # blobs are linked into the work dir of the task under their name, so
+    # the name must not point elsewhere
+    return blobName not in ("", ".", "..") and path.basename(blobName) == blobName
+
+def _readBlobHashes(data):
+    # optional json dictionary with the name and the hash of the blobs that
+    # are not uploaded because they are already stored by the module
+    if data == None:
+        return {}
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    blobHashes = json.loads(data)
+    if type(blobHashes) is not dict:
+        raise Exception("a dictionary of blob names and hashes is expected")
+    return blobHashes
+
+def _readQueueFields(fields):
+    # optional scheduling fields of a request: the priority class (default 
+    # 0, higher first), the id of the client that shares the task slots 
+    # with the others (default: the address of the client) and the maximum
+    # number of seconds the task can wait in the queue (default: no limit)
+    values = {}
+    for name in ("priority", "clientId", "deadline"):
+        value = fields.get(name)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        values[name] = value.strip() if value != None else ""
+
+    priority = int(values["priority"]) if values["priority"] != "" else 0
+    clientId = values["clientId"] or fields.get("remoteAddress") or ""
+    deadline = float(values["deadline"]) if values["deadline"] != "" else 0
+    if deadline < 0:
+        raise Exception("the deadline must be a positive number of seconds")
+    return priority, clientId, deadline
+
+def _readResourceFields(fields, defaultMemory, defaultCpus):
+    # optional footprint of a request: the memory in MB and the number of
+    # cores that the task needs, returns the memory in bytes and the cores
+    values = {}
+    for name in ("memory", "cpus"):
+        value = fields.get(name)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        values[name] = value.strip() if value != None else ""
+
+    memory = float(values["memory"]) if values["memory"] != "" else defaultMemory
+    cpus = float(values["cpus"]) if values["cpus"] != "" else defaultCpus
+    if memory < 0 or cpus < 0:
+        raise Exception("the memory and the cpus must be positive numbers")
+    return int(memory * 1024 * 1024), cpus
+
+class _ResourceMonitor(object):
+    """Memory and cpu budgets of the running tasks
+
+    Each task declares its footprint (memory in bytes and cores) and it can 
+    start only if the footprint fits in what the running tasks leave of the
+    budgets and in the memory available on the machine. A background thread
+    samples the resident memory and the cpu usage of the process group of 
+    each running task (from /proc), a running task counts for the larger of
+    its declared and of its actual usage. When a cgroup v2 folder is given,
+    each task gets its own cgroup limited to its footprint, the workers of 
+    the pool go back to the "idle" cgroup between two tasks.
+    """
+
+    def __init__(self, memoryBudget, cpuBudget, cgroupRoot, listener):
+        self.memoryBudget = memoryBudget
+        self.cpuBudget = cpuBudget
+        self.listener = listener
+        self.lock = threading.Lock()
+        # guid -> footprint and usage of the declared tasks
+        self.tasks = {}
+        self.cgroupRoot = _initCgroupRoot(cgroupRoot) if cgroupRoot != None else None
+        # cgroups that could not be removed yet (processes still exiting)
+        self.staleCgroups = []
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def check(self, memory, cpus):
+        """Returns an error message if a footprint exceeds the budgets"""
+        if self.memoryBudget > 0 and memory > self.memoryBudget:
+            return "The task needs " + _formatMegabytes(memory) + " MB of memory, more than the budget of the " + \
+                "module: " + _formatMegabytes(self.memoryBudget) + " MB"
+        if self.cpuBudget > 0 and cpus > self.cpuBudget:
+            return "The task needs " + _formatNumber(cpus) + " cores, more than the budget of the module: " + \
+                _formatNumber(self.cpuBudget) + " cores"
+        return None
+
+    def declare(self, guid, memory, cpus):
+        self.lock.acquire()
+        try:
+            self.tasks[guid] = {"memory" : memory, "cpus" : cpus, "running" : False, "pgid" : None, "rss" : 0, \
+                "cpuRate" : 0, "cpuTime" : None, "sampleTime" : None, "cgroup" : None}
+        finally:
+            self.lock.release()
+
+    def reserve(self, guid):
+        """Counts a declared task as running if its footprint fits in the 
+        budgets and in the available memory, returns False otherwise"""
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            if task == None:
+                return True
+            usedMemory, usedCpus, reservedMemory = self._getUsage()
+            if self.memoryBudget > 0 and usedMemory + task["memory"] > self.memoryBudget:
+                return False
+            if self.cpuBudget > 0 and usedCpus + task["cpus"] > self.cpuBudget:
+                return False
+            # the memory declared by the running tasks, and not used yet, is
+            # still counted as available by the system
+            if task["memory"] > 0:
+                availableMemory = _getAvailableMemory()
+                if availableMemory != None and availableMemory - reservedMemory < task["memory"]:
+                    return False
+            task["running"] = True
+            return True
+        finally:
+            self.lock.release()
+
+    def taskStarted(self, guid, pgid):
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(guid)
+            if task != None:
+                task["running"] = True
+                task["pgid"] = pgid
+        finally:
+            self.lock.release()
+
+    def release(self, guid):
+        """Forgets a completed (or rejected) task"""
+        self.lock.acquire()
+        try:
+            task = self.tasks.pop(guid, None)
+        finally:
+            self.lock.release()
+        if task != None and task["cgroup"] != None:
+            self._removeCgroup(task["cgroup"])
+
+    def getLimits(self, guid):
+        """Returns the limits that the process of a task applies to itself 
+        (see _applyTaskLimits), the cgroup of the task is created here"""
+        self.lock.acquire()
+        try:
+            task = self.tasks[guid]
+            memory, cpus = task["memory"], task["cpus"]
+        finally:
+            self.lock.release()
+
+        limits = {"memory" : memory, "cgroup" : None, "idleCgroup" : None}
+        if self.cgroupRoot != None:
+            cgroup = path.join(self.cgroupRoot, guid)
+            try:
+                os.mkdir(cgroup)
+                if memory > 0:
+                    _writeCgroupFile(cgroup, "memory.max", str(memory))
+                if cpus > 0:
+                    _writeCgroupFile(cgroup, "cpu.max", str(int(cpus * _CGROUP_CPU_PERIOD)) + " " + \
+                        str(_CGROUP_CPU_PERIOD))
+                limits["cgroup"] = cgroup
+                limits["idleCgroup"] = path.join(self.cgroupRoot, "idle")
+            except (IOError, OSError):
+                traceback.print_exc()
+                self._removeCgroup(cgroup)
+                return limits
+
+            self.lock.acquire()
+            try:
+                if guid in self.tasks:
+                    self.tasks[guid]["cgroup"] = cgroup
+            finally:
+                self.lock.release()
+        return limits
+
+    def getStats(self):
+        self.lock.acquire()
+        try:
+            usedMemory, usedCpus, _ = self._getUsage()
+            return {
+                "memoryBudget" : self.memoryBudget,
+                "cpuBudget" : self.cpuBudget,
+                "usedMemory" : usedMemory,
+                "usedCpus" : round(usedCpus, 3),
+                "residentMemory" : sum(task["rss"] for task in self.tasks.values() if task["running"]),
+                "cgroups" : self.cgroupRoot != None
+            }
+        finally:
+            self.lock.release()
+
+    def describe(self):
+        """Returns the usage of the budgets as a message"""
+        stats = self.getStats()
+        message = []
+        if self.memoryBudget > 0:
+            message.append(_formatMegabytes(stats["usedMemory"]) + "/" + _formatMegabytes(self.memoryBudget) + \
+                " MB of memory")
+        if self.cpuBudget > 0:
+            message.append(_formatNumber(stats["usedCpus"]) + "/" + _formatNumber(self.cpuBudget) + " cores")
+        return " and ".join(message) or "not enough available memory"
+
+    def sample(self):
+        self.lock.acquire()
+        try:
+            pgids = dict((task["pgid"], guid) for guid, task in self.tasks.items() if task["pgid"] != None)
+        finally:
+            self.lock.release()
+
+        # /proc is read without holding the lock
+        usage = _readProcessGroups(pgids) if len(pgids) > 0 else {}
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for pgid, (rss, cpuTime) in usage.items():
+                task = self.tasks.get(pgids[pgid])
+                if task == None or task["pgid"] != pgid:
+                    continue
+                if task["cpuTime"] != None and now > task["sampleTime"]:
+                    task["cpuRate"] = max(cpuTime - task["cpuTime"], 0) / (now - task["sampleTime"])
+                task["rss"] = rss
+                task["cpuTime"] = cpuTime
+                task["sampleTime"] = now
+            staleCgroups = self.staleCgroups
+            self.staleCgroups = []
+        finally:
+            self.lock.release()
+
+        for cgroup in staleCgroups:
+            self._removeCgroup(cgroup)
+
+    def _getUsage(self):
+        # memory and cores counted for the running tasks, and the declared
+        # memory that they do not use yet (the lock must be held)
+        usedMemory = 0
+        usedCpus = 0
+        reservedMemory = 0
+        for task in self.tasks.values():
+            if task["running"]:
+                usedMemory += max(task["memory"], task["rss"])
+                usedCpus += max(task["cpus"], task["cpuRate"])
+                reservedMemory += max(task["memory"] - task["rss"], 0)
+        return usedMemory, usedCpus, reservedMemory
+
+    def _removeCgroup(self, cgroup):
+        # a cgroup can be removed only once its processes have exited
+        try:
+            os.rmdir(cgroup)
+        except OSError:
+            if path.isdir(cgroup):
+                self.lock.acquire()
+                self.staleCgroups.append(cgroup)
+                self.lock.release()
+
+    def _run(self):
+        while True:
+            time.sleep(_RESOURCE_INTERVAL)
+            try:
+                self.sample()
+                self.listener()
+            except Exception:
+                traceback.print_exc()
+
+def _readProcessGroups(pgids):
+    # resident memory (bytes) and cpu time (seconds, terminated children 
+    # included) of the processes of the given process groups
+    usage = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/" + name + "/stat", "rt") as statFile:
+                statLine = statFile.read()
+        except (IOError, OSError):
+            continue
+        # the command name can contain spaces and parentheses
+        values = statLine[statLine.rfind(")") + 2:].split()
+        try:
+            pgid = int(values[2])
+            if pgid not in pgids:
+                continue
+            cpuTime = sum(int(value) for value in values[11:15]) / _CLOCK_TICKS
+            rss = int(values[21]) * _PAGE_SIZE
+        except (ValueError, IndexError):
+            continue
+        groupRss, groupCpuTime = usage.get(pgid, (0, 0))
+        usage[pgid] = (groupRss + rss, groupCpuTime + cpuTime)
+    return usage
+
+def _getAvailableMemory():
+    # memory in bytes available for new processes without swapping (None 
+    # if unknown)
+    try:
+        with open("/proc/meminfo", "rt") as meminfoFile:
+            for line in meminfoFile:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _initCgroupRoot(cgroupRoot):
+    # enables the memory and cpu controllers for the cgroups of the tasks,
+    # returns None if the cgroups can not be used (limits with setrlimit)
+    try:
+        with open(path.join(cgroupRoot, "cgroup.controllers"), "rt") as controllersFile:
+            controllers = controllersFile.read().split()
+        missing = [name for name in ("memory", "cpu") if name not in controllers]
+        if len(missing) > 0:
+            raise IOError("controllers not available: " + ", ".join(missing))
+        _writeCgroupFile(cgroupRoot, "cgroup.subtree_control", "+memory +cpu")
+        idleCgroup = path.join(cgroupRoot, "idle")
+        if not path.isdir(idleCgroup):
+            os.mkdir(idleCgroup)
+        return cgroupRoot
+    except (IOError, OSError) as e:
+        print("Unable to use the cgroup " + cgroupRoot + ", the tasks are limited with setrlimit: " + str(e))
+        return None
+
+def _writeCgroupFile(cgroup, name, value):
+    with open(path.join(cgroup, name), "wt") as cgroupFile:
+        cgroupFile.write(value)
+
+def _formatMegabytes(size):
+    return _formatNumber(round(size / (1024.0 * 1024), 1))
+
+class _ResultCache(object):
+    """Cache of the results of successful tasks, keyed by their request
+
+    Each entry is a folder named after the request hash that contains the 
+    json response and the result blobs, completed tasks get hard links to
+    the cached blobs. Entries are evicted in least recently used order when
+    the cache exceeds maxBytes or maxEntries. The entries are recorded in 
+    the task index, so they survive a restart of the module.
+    """
+
+    def __init__(self, cacheDir, trashDir, maxBytes, maxEntries, index):
+        self.cacheDir = cacheDir
+        self.trashDir = trashDir
+        self.index = index
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        # key -> {"response", "blobs", "size"} in least recently used order
+        self.entries = collections.OrderedDict()
+        self.pendingTasks = {}
+        self.totalBytes = 0
+        self.stats = {"hits" : 0, "misses" : 0, "evictions" : 0}
+
+    @staticmethod
+    def getKey(jsonPayload, blobHashes):
+        key = hashlib.sha256()
+        key.update(json.dumps(jsonPayload, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+        for blobName in sorted(blobHashes):
+            key.update(("\n" + blobName + ":" + blobHashes[blobName]).encode("utf-8"))
+        return key.hexdigest()
+
+    def materialize(self, key, completedTaskDir):
+        """Creates a completed task from the cached result
+
+        Returns the (response, blobs) of the cached result, or None if the
+        result is not cached.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry != None:
+                try:
+                    _linkTree(path.join(self.cacheDir, key), completedTaskDir)
+                except OSError:
+                    traceback.print_exc()
+                    shutil.rmtree(completedTaskDir, ignore_errors=True)
+                    entry = None
+            if entry == None:
+                self.stats["misses"] += 1
+                return None
+
+            self.stats["hits"] += 1
+            self.entries.pop(key)
+            self.entries[key] = entry
+            return entry["response"], entry["blobs"]
+        finally:
+            self.lock.release()
+
+    def taskSubmitted(self, guid, key):
+        self.lock.acquire()
+        self.pendingTasks[guid] = key
+        self.lock.release()
+
+    def taskCompleted(self, guid, completedTaskDir, response, success):
+        self.lock.acquire()
+        try:
+            key = self.pendingTasks.pop(guid, None)
+            if key == None or not success or key in self.entries:
+                return
+            entryDir = path.join(self.cacheDir, key)
+            if path.isdir(entryDir):
+                # left by a previous run that did not record it in the index
+                shutil.rmtree(entryDir, ignore_errors=True)
+            _linkTree(completedTaskDir, entryDir, ("responseJsonPayload", "result"))
+            entry = {
+                "response" : response,
+                "blobs" : os.listdir(path.join(entryDir, "result")),
+                "size" : _getTreeSize(entryDir)
+            }
+            self.entries[key] = entry
+            self.totalBytes += entry["size"]
+            self.index.addResult(key, entry)
+
+            evicted = []
+            while len(self.entries) > 1 and ((self.maxBytes > 0 and self.totalBytes > self.maxBytes) or \
+                (self.maxEntries > 0 and len(self.entries) > self.maxEntries)):
+                evictedKey, evictedEntry = self.entries.popitem(last=False)
+                self.totalBytes -= evictedEntry["size"]
+                self.stats["evictions"] += 1
+                evictedDir = path.join(self.trashDir, "cache_" + evictedKey)
+                os.rename(path.join(self.cacheDir, evictedKey), evictedDir)
+                self.index.removeResult(evictedKey)
+                evicted.append(evictedDir)
+        finally:
+            self.lock.release()
+
+        for evictedDir in evicted:
+            shutil.rmtree(evictedDir, ignore_errors=True)
+
+    def restore(self, entries):
+        """Adds the entries of the previous runs, read from the task index 
+        (in least recently used order), before the current entries"""
+        self.lock.acquire()
+        try:
+            restored = collections.OrderedDict()
+            for key, entry in entries.items():
+                if key not in self.entries and path.isdir(path.join(self.cacheDir, key)):
+                    restored[key] = entry
+                    self.totalBytes += entry["size"]
+            restored.update(self.entries)
+            self.entries = restored
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        try:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.totalBytes
+            return stats
+        finally:
+            self.lock.release()
+
+def _linkTree(srcDir, destDir, names=None):
+    # recreates the folder structure with hard links to the files
+    os.mkdir(destDir)
+    for name in (names if names != None else os.listdir(srcDir)):
+        srcPath = path.join(srcDir, name)
+        if path.isdir(srcPath):
+            _linkTree(srcPath, path.join(destDir, name))
+        else:
+            os.link(srcPath, path.join(destDir, name))
@@ -0,0 +1,374 @@
+"""Client of the http APIs of a CAOS module
+
+The ModuleClient keeps a pool of keep-alive connections to the module, so
+it can be reused to drive many tasks (and, with one client per module, many
+modules) without opening a new connection for each request. Result blobs
+are downloaded concurrently and streamed to disk, interrupted downloads
+are resumed with http Range requests. Compressed responses (gzip, or zstd
+when supported by urllib3) are decompressed while they are streamed.
+All the result blobs of a task can also be downloaded as a single tar
+archive, extracted while it is received.
+
+This module has a dependency on:
+- requests
+
+You can easily install the dependencies via pip.
+"""
+
+import os
+import json
+import time
+import tarfile
+import threading
+from os import path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# number of seconds the module is asked to wait for a task before answering
+_WAIT_TIMEOUT = 30
+# number of seconds between two /state requests to modules without /wait
+_POLL_INTERVAL = 1
+# size of the chunks written to disk while downloading a blob
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# suffix of the blobs being downloaded
+_PARTIAL_SUFFIX = ".part"
+# states of the tasks that are not completed yet
+_PENDING_STATES = ("QUEUED", "RUNNING")
+
+
+class RequestError(Exception):
+    """Raised when the module answers with an unexpected status code
+
+    'statusCode' is the http status code (None if the module could not be
+    reached) and 'response' is the json response of the module, if any
+    """
+    def __init__(self, message, statusCode=None, response=None):
+        super(RequestError, self).__init__(message)
+        self.statusCode = statusCode
+        self.response = response
+
+
+class ModuleClient(object):
+    """ Client of a CAOS module.
+    Parameters:
+    -----------
+    'hostname' and 'port' identify the module
+    'poolSize' is the maximum number of connections kept open to the module
+    'downloadThreads' is the number of blobs downloaded concurrently
+    'maxRetries' is the number of times an interrupted download is resumed
+    'timeout' is the timeout in seconds of the connections (None: no
+        timeout)
+    The client can be shared by multiple threads.
+    """
+
+    def __init__(self, hostname="localhost", port=5000, poolSize=10,
+                 downloadThreads=4, maxRetries=3, timeout=None):
+        self.baseUrl = 'http://' + hostname + ':' + str(port)
+        self.downloadThreads = downloadThreads
+        self.maxRetries = maxRetries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+        self.session.mount('http://', adapter)
+        # modules without the /wait API are polled on /state
+        self.waitSupported = True
+
+    def close(self):
+        """Closes the connections to the module"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, route, **kwargs):
+        return self.session.get(self.baseUrl + route, timeout=self.timeout,
+                                **kwargs)
+
+    def head(self, route, **kwargs):
+        return self.session.head(self.baseUrl + route, timeout=self.timeout,
+                                 **kwargs)
+
+    def post(self, route, **kwargs):
+        return self.session.post(self.baseUrl + route, timeout=self.timeout,
+                                 **kwargs)
+
+    def getInfo(self):
+        """Returns the /info json of the module"""
+        return _readJson(self.get('/info'), "Failed to get module info.")
+
+    def submit(self, jsonPayload, files={}, blobHashes=None, priority=None,
+               clientId=None, deadline=None, profile=None, memory=None,
+               cpus=None):
+        """ Submits a task and returns its id.
+        'files' maps the blob names to their content (bytes or file objects)
+        'blobHashes' maps the names of the blobs already stored by the
+            module to their SHA-256
+        'priority', 'clientId' and 'deadline' are the optional scheduling
+            options of modules with an admission queue (the priority class,
+            the id of the client sharing the task slots and the maximum
+            number of seconds the task can wait in the queue)
+        'profile' selects the profiler of the task ("cprofile", "sampling"
+            or "none"), the profile is a result blob of the task
+        'memory' (MB) and 'cpus' declare the footprint of the task to
+            modules with resource budgets
+        """
+        requestFiles = dict(files)
+        requestFiles["jsonPayload"] = json.dumps(jsonPayload)
+        if blobHashes:
+            requestFiles["blobHashes"] = json.dumps(blobHashes)
+        fields = {}
+        for name, value in (("priority", priority), ("clientId", clientId),
+                            ("deadline", deadline), ("profile", profile),
+                            ("memory", memory), ("cpus", cpus)):
+            if value is not None:
+                fields[name] = str(value)
+        response = self.post('/submit', data=fields, files=requestFiles)
+        return _readJson(response, "Failed to submit request.")["taskId"]
+
+    def getState(self, taskId):
+        """Returns the /state json of a task"""
+        return _readJson(self.get('/state/' + taskId),
+                         "Failed to get task state.")
+
+    def wait(self, taskId, timeout=None):
+        """ Waits for a task to be completed and returns its state json, or
+        the QUEUED/RUNNING state once 'timeout' seconds are elapsed (None:
+        wait until the task is completed)
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = _WAIT_TIMEOUT
+            if deadline is not None:
+                remaining = max(min(deadline - time.time(), _WAIT_TIMEOUT), 0)
+
+            # the module answers as soon as the task is completed
+            if self.waitSupported:
+                response = self.get('/wait/' + taskId + '?timeout=' +
+                                    str(remaining))
+                if _isMissingApi(response):
+                    self.waitSupported = False
+            if not self.waitSupported:
+                response = self.get('/state/' + taskId)
+            state = _readJson(response, "Failed to get task state.")
+
+            if state["state"] not in _PENDING_STATES:
+                return state
+            if deadline is not None and time.time() >= deadline:
+                return state
+            if not self.waitSupported:
+                time.sleep(_POLL_INTERVAL if deadline is None else
+                           min(_POLL_INTERVAL, remaining))
+
+    def kill(self, taskId):
+        """Kills a running (or queued) task"""
+        _readJson(self.get('/kill/' + taskId), "Failed to kill task.")
+
+    def streamLog(self, taskId, output, offset=0, follow=True):
+        """ Writes the log of a task, starting from 'offset', to the 'output'
+        callback (called with each chunk of bytes) and returns the number of
+        received bytes. With 'follow' the log is streamed until the task is
+        completed (modules without the follow mode send the available log).
+        """
+        url = '/log/' + taskId + '?offset=' + str(offset)
+        if follow:
+            url += '&follow=true'
+        response = self.get(url, stream=True)
+        try:
+            if response.status_code != 200:
+                raise RequestError("Failed to get task logs.",
+                                   response.status_code)
+            received = 0
+            for chunk in response.iter_content(chunk_size=None):
+                received += len(chunk)
+                output(chunk)
+            return received
+        finally:
+            response.close()
+
+    def download(self, taskId, blobs, resultFolder):
+        """ Downloads the given result blobs of a task to resultFolder, up
+        to downloadThreads blobs at a time, and returns the paths of the
+        downloaded files. A blob is written to <blob>.part and renamed once
+        completed, a .part file left by an interrupted download is resumed.
+        """
+        if not path.isdir(resultFolder):
+            os.makedirs(resultFolder)
+
+        pending = list(blobs)
+        errors = []
+        lock = threading.Lock()
+
+        def downloadBlobs():
+            while True:
+                with lock:
+                    if not pending or errors:
+                        return
+                    blob = pending.pop(0)
+                try:
+                    self.downloadBlob(taskId, blob, path.join(resultFolder,
+                                                              blob))
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=downloadBlobs)
+                   for _ in range(min(self.downloadThreads, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        return [path.join(resultFolder, blob) for blob in blobs]
+
+    def downloadArchive(self, taskId, resultFolder):
+        """ Downloads all the result blobs of a task with a single request
+        (the /results/<taskId>.tar archive), extracts them to resultFolder
+        while the archive is received and returns the paths of the
+        extracted files. A file is written to <file>.part and renamed once
+        completed, an interrupted download must be restarted.
+        """
+        if not path.isdir(resultFolder):
+            os.makedirs(resultFolder)
+
+        response = self.get('/results/' + taskId + '.tar', stream=True)
+        try:
+            if response.status_code != 200:
+                _readJson(response, "Failed to download task results.")
+            paths = []
+            archive = tarfile.open(fileobj=_ChunkReader(
+                response.iter_content(_DOWNLOAD_CHUNK_SIZE)), mode="r|")
+            for member in archive:
+                memberPath = _getMemberPath(resultFolder, member.name)
+                if member.isdir():
+                    if not path.isdir(memberPath):
+                        os.makedirs(memberPath)
+                    continue
+                if not member.isfile():
+                    continue
+                if not path.isdir(path.dirname(memberPath)):
+                    os.makedirs(path.dirname(memberPath))
+                memberFile = archive.extractfile(member)
+                with open(memberPath + _PARTIAL_SUFFIX, "wb") as blobFile:
+                    while True:
+                        data = memberFile.read(_DOWNLOAD_CHUNK_SIZE)
+                        if not data:
+                            break
+                        blobFile.write(data)
+                os.rename(memberPath + _PARTIAL_SUFFIX, memberPath)
+                paths.append(memberPath)
+            return paths
+        finally:
+            response.close()
+
+    def downloadBlob(self, taskId, blob, blobPath):
+        """Downloads a single result blob, see download"""
+        partialPath = blobPath + _PARTIAL_SUFFIX
+        retries = 0
+        while True:
+            try:
+                if self._downloadPart(taskId, blob, partialPath):
+                    break
+            except requests.exceptions.RequestException:
+                if retries >= self.maxRetries:
+                    raise
+                retries += 1
+        os.rename(partialPath, blobPath)
+
+    def _downloadPart(self, taskId, blob, partialPath):
+        # downloads the rest of the blob, returns False if the download
+        # must be restarted from the beginning
+        offset = 0
+        if path.isfile(partialPath):
+            offset = os.stat(partialPath).st_size
+        # the blob is downloaded compressed (if the module supports it) and
+        # decompressed while it is written, a resumed download asks for the
+        # uncompressed blob since the offset refers to the decompressed data
+        headers = {}
+        if offset > 0:
+            headers["Range"] = "bytes=" + str(offset) + "-"
+            headers["Accept-Encoding"] = "identity"
+
+        response = self.get('/result/' + taskId + '/' + blob,
+                            headers=headers, stream=True)
+        try:
+            if response.status_code == 416:
+                # the partial file is either complete or larger than the blob
+                contentRange = response.headers.get("Content-Range", "")
+                if contentRange == "bytes */" + str(offset):
+                    return True
+                os.unlink(partialPath)
+                return False
+            if response.status_code not in (200, 206):
+                raise RequestError("failed to download blob: " + blob,
+                                   response.status_code)
+
+            # a module ignoring the Range header sends the whole blob
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(partialPath, mode) as blobFile:
+                for chunk in response.iter_content(_DOWNLOAD_CHUNK_SIZE):
+                    blobFile.write(chunk)
+            return True
+        finally:
+            response.close()
+
+
+def _readJson(response, message):
+    try:
+        data = json.loads(response.text)
+    except ValueError:
+        data = None
+    if response.status_code != 200:
+        if isinstance(data, dict) and "message" in data:
+            message += " " + data["message"]
+        raise RequestError(message, response.status_code, data)
+    return data
+
+
+class _ChunkReader(object):
+    """File-like object reading the chunks of a streamed response"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        data = []
+        length = 0
+        while size < 0 or length < size:
+            if self.offset >= len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.offset = 0
+                if self.chunk is None:
+                    self.chunk = b""
+                    break
+                continue
+            end = len(self.chunk)
+            if size >= 0:
+                end = min(end, self.offset + size - length)
+            data.append(self.chunk[self.offset:end])
+            length += end - self.offset
+            self.offset = end
+        return b"".join(data)
+
+
+def _getMemberPath(resultFolder, name):
+    # the archive members must be extracted inside resultFolder
+    parts = name.split("/")
+    if name.startswith("/") or ".." in parts:
+        raise RequestError("invalid file in the result archive: " + name)
+    return path.join(resultFolder, *[part for part in parts if part])
+
+
+def _isMissingApi(response):
+    # unknown routes are answered with a non-json 404 page, while unknown
+    # tasks are reported with a json message
+    return response.status_code == 404 and \
+        not response.headers.get("Content-Type", "").startswith(
+            "application/json")
@@ -0,0 +1,381 @@
+"""Load-balancing gateway in front of several instances of a CAOS module
+
+The gateway exposes the same http APIs of a module (see CAOSFlaskModule)
+and forwards the requests to a set of instances of the module, e.g. the
+same module started on different ports of the machine:
+- /submit is sent to the healthy instance with the most free task slots,
+  according to the runningTasks and maxTasks (and queue length) reported
+  by its /info, a request rejected with a 503 error (or that cannot reach
+  the instance) is sent again to the next instance
+- the APIs of a task (/state, /wait, /events, /kill, /log, /result and
+  /results) are sent to the instance that runs the task, tasks that are
+  unknown to the gateway (e.g. after a restart of the gateway) are looked
+  up on all the instances
+- /info reports the task slots of all the healthy instances and the state
+  of each instance, HEAD /blob reports a blob as stored only if all the
+  healthy instances store it
+The instances are health checked by a background thread, which polls
+their /info. Responses are streamed as they are received, so logs, events
+and results are never buffered by the gateway (submitted requests are,
+since they may be sent to more than one instance).
+
+The gateway can be started from the command line:
+    python CAOSModuleGateway.py -P 5000 -B localhost:5001,localhost:5002
+
+This module has a dependency on:
+- flask
+- requests
+"""
+
+import flask
+import optparse
+import threading
+import time
+import collections
+import tempfile
+import io
+
+from flask import request
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+import requests
+
+import CAOSModuleClient
+
+# number of seconds after which an instance that does not answer its
+# health check (or a task lookup) is considered down
+_HEALTH_TIMEOUT = 2
+# number of seconds to connect to an instance when forwarding a request
+_CONNECT_TIMEOUT = 5
+# maximum number of task routes kept by the gateway (the least recently
+# used routes are forgotten and looked up again when needed)
+_MAX_ROUTES = 100000
+# submitted requests up to this size are kept in memory, larger requests
+# are spooled to a temporary file
+_SUBMIT_MEMORY_SIZE = 1024 * 1024
+_CHUNK_SIZE = 64 * 1024
+# headers forwarded to the instances and back to the clients
+_REQUEST_HEADERS = ("Accept-Encoding", "Range")
+_RESPONSE_HEADERS = ("Content-Type", "Content-Length", "Content-Encoding", "Content-Range", "Accept-Ranges", \
+    "Content-Disposition", "Cache-Control", "Vary", "Last-Modified", "ETag")
+
+
+def start(backends=[], defaultHost="0.0.0.0", defaultPort=5000, healthInterval=1, poolSize=10):
+    """Starts the gateway and forwards the requests to the module instances.
+
+    This method also parses parameters passed via the command line when
+    launching the python script. The supported command line parameters are:
+    -H (--host): the hostname for the http server
+    -P (--port): the post for the http server
+    -D (--debug): if debugging should be enabled
+    -B (--backends): the comma separated host:port addresses of the module
+        instances (replacing the backends argument)
+
+    Parameters
+    ----------
+    backends : list of strings
+        The host:port addresses of the instances of the module
+    defaultHost : string, optional (default is 0.0.0.0)
+        The default host to use if not specified in the command line argument
+    defaultPort : int
+        The default port to use if not specified in the command line argument
+    healthInterval : float
+        Number of seconds between two health checks of the instances
+        (default 1)
+    poolSize : int
+        Maximum number of connections kept open to each instance, requests
+        waiting for a task (/wait, /events and followed logs) hold a
+        connection (default 10)
+    """
+
+    parser = optparse.OptionParser()
+    parser.add_option("-H", "--host", help="Hostname of the gateway [default %s]" % defaultHost, default=defaultHost)
+    parser.add_option("-P", "--port", help="Port for the gateway [default %s]" % defaultPort, default=defaultPort)
+    parser.add_option("-D", "--debug", dest="debug", help="Enable debugging with -D=true")
+    parser.add_option("-B", "--backends", help="Comma separated host:port addresses of the module instances", \
+        default=",".join(backends))
+    options, _ = parser.parse_args()
+
+    addresses = [address.strip() for address in options.backends.split(",") if address.strip()]
+    if not addresses:
+        parser.error("no module instances, pass their addresses with -B host:port,host:port")
+    backends = [_Backend(address, poolSize) for address in addresses]
+
+    app = flask.Flask("CAOS module gateway")
+
+    # backend of each task, in least recently used order
+    routesLock = threading.Lock()
+    routes = collections.OrderedDict()
+
+    def checkBackends():
+        while True:
+            time.sleep(healthInterval)
+            for backend in backends:
+                backend.check()
+
+    # the instances are checked before accepting requests
+    for backend in backends:
+        backend.check()
+    checker = threading.Thread(target=checkBackends)
+    checker.daemon = True
+    checker.start()
+
+    def setRoute(taskId, backend):
+        routesLock.acquire()
+        try:
+            routes.pop(taskId, None)
+            routes[taskId] = backend
+            while len(routes) > _MAX_ROUTES:
+                routes.popitem(last=False)
+        finally:
+            routesLock.release()
+
+    def findBackend(taskId):
+        # returns the instance of a task, None if no instance knows the task
+        routesLock.acquire()
+        try:
+            backend = routes.pop(taskId, None)
+            if backend != None:
+                routes[taskId] = backend
+                return backend
+        finally:
+            routesLock.release()
+
+        for backend in backends:
+            try:
+                response = backend.healthClient.get('/state/' + quote(taskId))
+            except requests.exceptions.RequestException:
+                continue
+            if response.status_code == 200:
+                setRoute(taskId, backend)
+                return backend
+        return None
+
+    def selectBackends():
+        # the healthy instances, the one with the most free task slots first
+        # (instances without a limit come first, by number of running tasks)
+        candidates = []
+        for backend in backends:
+            freeSlots, usedSlots = backend.getLoad()
+            if freeSlots != None or usedSlots != None:
+                candidates.append((freeSlots != None, -(freeSlots or 0), usedSlots, backend.address, backend))
+        candidates.sort(key=lambda candidate: candidate[:4])
+        return [candidate[-1] for candidate in candidates]
+
+    def forward(backend):
+        # forwards the current request to an instance and streams back its
+        # response
+        route = quote(request.path)
+        if request.query_string:
+            route += "?" + request.query_string.decode("utf-8")
+        headers = dict((name, request.headers[name]) for name in _REQUEST_HEADERS if name in request.headers)
+        # the response is passed through as is, so it must not be encoded 
+        # unless the client accepts it (the session asks for gzip otherwise)
+        headers["Accept-Encoding"] = request.headers.get("Accept-Encoding", "identity")
+        try:
+            response = backend.client.get(route, headers=headers, stream=True)
+        except requests.exceptions.RequestException as e:
+            return _sendErrorData("module instance " + backend.address + " is not reachable: " + str(e), 502)
+        return _streamResponse(response)
+
+    # ---- http APIs ----
+
+    @app.route('/info', methods=['GET'])
+    def getInfo():
+        # the task slots and the running tasks of the healthy instances, as
+        # reported by their last health check
+        info = None
+        runningTasks = 0
+        maxTasks = 0
+        unlimited = False
+        instances = []
+        for backend in backends:
+            backendInfo = backend.getInfo()
+            instances.append({
+                "address" : backend.address,
+                "healthy" : backendInfo != None,
+                "runningTasks" : backendInfo["runningTasks"] if backendInfo != None else None,
+                "maxTasks" : backendInfo["maxTasks"] if backendInfo != None else None
+            })
+            if backendInfo == None:
+                continue
+            info = info or backendInfo
+            runningTasks += backendInfo["runningTasks"]
+            maxTasks += backendInfo["maxTasks"]
+            unlimited = unlimited or backendInfo["maxTasks"] <= 0
+        if info == None:
+            return _sendErrorData("no module instance is available", 503)
+
+        return flask.jsonify({
+            'apiVersion' : info['apiVersion'],
+            'moduleName' : info['moduleName'],
+            'implementationName' : info['implementationName'],
+            'runningTasks' : runningTasks,
+            'maxTasks' : 0 if unlimited else maxTasks,
+            'instances' : instances
+        })
+
+    @app.route('/submit', methods=['POST'])
+    def postSubmit():
+        # the request is kept until an instance accepts it
+        if request.content_length != None and request.content_length <= _SUBMIT_MEMORY_SIZE:
+            body = io.BytesIO(request.get_data())
+        else:
+            body = tempfile.TemporaryFile()
+            while True:
+                data = request.stream.read(_CHUNK_SIZE)
+                if not data:
+                    break
+                body.write(data)
+        headers = {"Content-Type" : request.headers.get("Content-Type", "")}
+
+        try:
+            response = None
+            for backend in selectBackends():
+                body.seek(0)
+                try:
+                    backendResponse = backend.client.post('/submit', data=body, headers=headers)
+                except requests.exceptions.RequestException:
+                    backend.setDown()
+                    continue
+                response = backendResponse
+                if response.status_code != 503:
+                    break
+        finally:
+            body.close()
+        if response == None:
+            return _sendErrorData("no module instance is available", 503)
+
+        if response.status_code == 200:
+            setRoute(response.json()["taskId"], backend)
+            backend.taskSubmitted()
+        return flask.Response(response.content, status=response.status_code, \
+            content_type=response.headers.get("Content-Type"))
+
+    @app.route('/blob/<blobHash>', methods=['HEAD'])
+    def headBlob(blobHash):
+        # a stored blob can be referenced by a request only if it is stored
+        # by every instance that may receive the request
+        stored = False
+        for backend in selectBackends():
+            try:
+                response = backend.healthClient.head('/blob/' + quote(blobHash))
+            except requests.exceptions.RequestException:
+                return flask.Response(status=404)
+            if response.status_code != 200:
+                return flask.Response(status=404)
+            stored = True
+        return flask.Response(status=200 if stored else 404)
+
+    @app.route('/state/<taskId>', methods=['GET'])
+    @app.route('/wait/<taskId>', methods=['GET'])
+    @app.route('/events/<taskId>', methods=['GET'])
+    @app.route('/kill/<taskId>', methods=['GET'])
+    @app.route('/log/<taskId>', methods=['GET'])
+    @app.route('/result/<taskId>/<filename>', methods=['GET'])
+    def forwardTask(taskId, filename=None):
+        backend = findBackend(taskId)
+        if backend == None:
+            return _sendErrorData("task with ID: '" + taskId + "' not found", 404)
+        return forward(backend)
+
+    @app.route('/results/<archiveName>', methods=['GET'])
+    def forwardResults(archiveName):
+        # the archive is named after the task (<taskId>.tar, .tar.gz, ...)
+        return forwardTask(archiveName.split(".")[0])
+
+    # ---- END http APIs ----
+
+    app.run(debug=options.debug, host=options.host, port=int(options.port), threaded=True)
+
+
+# ---- private methods ----
+
+def _sendErrorData(message, code):
+    response = flask.jsonify({"message" : message})
+    response.status_code = code
+    return response
+
+def _streamResponse(response):
+    # sends the response of an instance as it is received, without decoding
+    # its content (chunked responses, e.g. events and followed logs, are
+    # sent chunk by chunk)
+    def generate():
+        try:
+            for data in response.raw.stream(None if response.raw.chunked else _CHUNK_SIZE, decode_content=False):
+                yield data
+        finally:
+            response.close()
+
+    headers = [(name, response.headers[name]) for name in _RESPONSE_HEADERS if name in response.headers]
+    return flask.Response(generate(), status=response.status_code, headers=headers)
+
+
+class _Backend(object):
+    """Instance of the module behind the gateway, with the /info reported by
+    its last health check (None if the instance is down)"""
+
+    def __init__(self, address, poolSize):
+        hostname, _, port = address.rpartition(":")
+        self.address = address
+        # forwarded requests may wait for a task for a long time, only the
+        # connection has a timeout
+        self.client = CAOSModuleClient.ModuleClient(hostname, int(port), poolSize, \
+            timeout=(_CONNECT_TIMEOUT, None))
+        self.healthClient = CAOSModuleClient.ModuleClient(hostname, int(port), 1, timeout=_HEALTH_TIMEOUT)
+        self.lock = threading.Lock()
+        self.info = None
+        # tasks submitted since the last health check
+        self.submitted = 0
+
+    def check(self):
+        try:
+            info = self.healthClient.getInfo()
+        except Exception:
+            info = None
+        self.lock.acquire()
+        self.info = info
+        self.submitted = 0
+        self.lock.release()
+
+    def setDown(self):
+        """Marks the instance as down until the next health check"""
+        self.lock.acquire()
+        self.info = None
+        self.lock.release()
+
+    def taskSubmitted(self):
+        self.lock.acquire()
+        self.submitted += 1
+        self.lock.release()
+
+    def getInfo(self):
+        self.lock.acquire()
+        try:
+            return self.info
+        finally:
+            self.lock.release()
+
+    def getLoad(self):
+        """Returns the number of free task slots (None if the instance has
+        no limit) and the number of used task slots, (None, None) if the
+        instance is down. Queued tasks and the tasks submitted since the
+        last health check use a task slot."""
+        self.lock.acquire()
+        try:
+            if self.info == None:
+                return None, None
+            usedSlots = self.info.get("runningTasks", 0) + self.info.get("queue", {}).get("length", 0) + \
+                self.submitted
+            maxTasks = self.info.get("maxTasks", 0)
+            return (maxTasks - usedSlots if maxTasks > 0 else None), usedSlots
+        finally:
+            self.lock.release()
+
+
+if __name__ == "__main__":
+    start()
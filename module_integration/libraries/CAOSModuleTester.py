@@ -8,13 +8,17 @@ You can easily install the dependencies via pip.
 
 import os
 import sys
+import math
 import optparse
 import requests
 import json
 import time
-from os import path
+import codecs
+import random
+import threading
 import subprocess
 import CAOSjsonTester
+import CAOSModuleClient
 
 
 def test(jsonPayload, module_path=None, handle_implementation=True,
@@ -58,29 +62,12 @@ def test(jsonPayload, module_path=None, handle_implementation=True,
             mod = _start_module(implementation_path, hostname, port, work_dir)
             # sleep to allow module to start
             time.sleep(wait_s_start)
-        # submit task
-        files["jsonPayload"] = json.dumps(jsonPayload)
-        response = requests.post('http://' + hostname + ":" + str(port) +
-                                 '/submit', files=files)
-        if not response.status_code == 200:
-            raise Exception("Failed to submit request.")
+        client = CAOSModuleClient.ModuleClient(hostname, port)
 
-        jsonResponse = json.loads(response.text)
-        taskId = jsonResponse["taskId"]
-
-        # start polling on task state until running
-        state = "RUNNING"
-        while state == "RUNNING":
-            # get state
-            response = requests.get('http://' + hostname + ':' + str(port) +
-                                    '/state/' + taskId)
-            if not response.status_code == 200:
-                raise Exception("Failed to get task state.")
-            jsonResponse = json.loads(response.text)
-            state = jsonResponse["state"]
-
-            # sleep a while before next request
-            time.sleep(1)
+        # submit task and wait for it to leave the running state
+        taskId = client.submit(jsonPayload, files)
+        jsonResponse = client.wait(taskId)
+        state = jsonResponse["state"]
 
         if not state == "COMPLETED":
             stackTrace = ""
@@ -91,18 +78,8 @@ def test(jsonPayload, module_path=None, handle_implementation=True,
 
         # download resulting blobs if needed
         if resultFolder is not None:
-            if not path.isdir(resultFolder):
-                os.makedirs(resultFolder)
-            blobs = jsonResponse["blobs"]
-            for blob in blobs:
-                response = response.get('http://' + hostname + ':' +
-                                        str(port) + '/result/' + taskId + "/" +
-                                        blob)
-                if not response.status_code == 200:
-                    raise Exception("failed to download blob: " + blob)
-                blobPath = path.join(resultFolder, blob)
-                with open(blobPath, "wb") as blobFile:
-                    blobFile.write(response.content)
+            client.download(taskId, jsonResponse["blobs"], resultFolder)
+        client.close()
         if handle_implementation:
             # terminate module
             mod.terminate()
@@ -113,8 +90,11 @@ def test(jsonPayload, module_path=None, handle_implementation=True,
         jsonValidator = {}
         with open(jsonValidator_path) as json_file:
             jsonValidator = json.load(json_file)
-        assert CAOSjsonTester.validate_json(json_response, jsonValidator), \
-            "Failed json response validation. Module output is:\n\n" + \
+        validationError = CAOSjsonTester.compile_validator(
+            jsonValidator).find_error(json_response)
+        assert validationError is None, \
+            "Failed json response validation at " + \
+            str(validationError) + ". Module output is:\n\n" + \
             json.dumps(json_response, sort_keys=True, indent=4) + \
             "\n\nExpected output format is:\n\n" + \
             json.dumps(jsonValidator, sort_keys=True, indent=4)
@@ -138,15 +118,18 @@ def send(jsonPayload, hostname="localhost", port=5000, files = {}, resultFolder=
     parser.add_option("-P", "--port", help="Port for the test [default %s]" % port, default=port)
     options, _ = parser.parse_args()
 
+    client = CAOSModuleClient.ModuleClient(options.host, options.port)
+
     # check that the module is reachable
-    response = _doGet('http://' + options.host + ':' + str(options.port) + '/info')
+    response = _doGet(client, '/info')
     if response.status_code != 200:
         print("ERROR: Unexpected status code: " + str(response.status_code))
         return
 
     # submit task
+    files = dict(files)
     files["jsonPayload"] = json.dumps(jsonPayload)
-    response = _doPost('http://' + options.host + ":" + str(options.port) + '/submit', files=files)
+    response = _doPost(client, '/submit', files=files)
     if response.status_code != 200:
         print("ERROR: Failed to submit request.")
         return
@@ -157,47 +140,259 @@ def send(jsonPayload, hostname="localhost", port=5000, files = {}, resultFolder=
     # start polling on task state and logs
     state = "RUNNING"
     logsOffset = 0
-    while state == "RUNNING":
-        # get state
-        response = _doGet('http://' + options.host + ':' + str(options.port) + '/state/' + taskId)
+    waitSupported = True
+    while state in CAOSModuleClient._PENDING_STATES:
+        # get logs (the module keeps streaming new logs until the task is 
+        # completed, modules without the follow mode send the available ones)
+        received = _doGetStream(client, '/log/' + taskId + "?offset=" + str(logsOffset) + "&follow=true")
+        if received < 0:
+            print("ERROR: Failed to get task logs.")
+            return
+        logsOffset += received
+
+        # get state (waiting up to one second for the task to complete)
+        if waitSupported:
+            response = _doGet(client, '/wait/' + taskId + '?timeout=1')
+            waitSupported = not CAOSModuleClient._isMissingApi(response)
+        if not waitSupported:
+            response = _doGet(client, '/state/' + taskId)
         if response.status_code != 200:
             print("ERROR: Failed to get task state.")
             return
         jsonResponse = json.loads(response.text)
         state = jsonResponse["state"]
 
-        # get logs
-        response = _doGet('http://' + options.host + ':' + str(options.port) + '/log/' + taskId + "?offset=" + str(logsOffset))
-        if response.status_code != 200:
-            print("ERROR: Failed to get task logs.")
-            return
-        logsOffset += int(response.headers["Content-Length"])
-
-        # sleep a while before next request
-        time.sleep(1)
+        # sleep a while before next request (modules without the /wait API
+        # need to be polled)
+        if state in CAOSModuleClient._PENDING_STATES and not waitSupported:
+            time.sleep(1)
 
-    # download resulting blobs if needed
+    # download resulting blobs if needed (concurrently, streaming them to disk)
     if state == "COMPLETED" and resultFolder != None:
         print("# Downlading result blobs to: " + resultFolder)
-        if not path.isdir(resultFolder):
-            os.makedirs(resultFolder)
+        try:
+            for blobPath in client.download(taskId, jsonResponse["blobs"], resultFolder):
+                print("# INFO: Saved blob content to: " + blobPath)
+        except (CAOSModuleClient.RequestError, requests.exceptions.RequestException) as e:
+            print("ERROR: failed to download blobs: " + str(e))
+
+    client.close()
+
+def loadTest(payloads, hostname="localhost", port=5000, numRequests=100,
+             concurrency=10, arrivalRate=0, maxRetries=100, retryDelay=0.1,
+             download=False, outputPath=None, seed=None):
+    """ Fires numRequests submissions to a running module, with up to
+    'concurrency' requests in flight, and reports latencies and errors.
+    Parameters:
+    -----------
+    'payloads' is the request mix, a list of dictionaries with the keys:
+        - jsonPayload: the request json
+        - files: optional dictionary of blob names and their content (bytes)
+            or the path of the file to upload
+        - weight: optional relative frequency of the request (default 1)
+    'arrivalRate' is the number of submissions started per second (open
+        loop), 0 means that a new request is submitted as soon as a previous
+        one completes (closed loop)
+    'maxRetries' and 'retryDelay' control how 503 (capacity limit exceeded)
+        rejections are retried, the delay doubles at each retry up to 5s
+    'download' is true if the result blobs should be downloaded
+    'outputPath' is the path of the json file where the report is stored
+    'seed' initializes the random selection of the payloads
+    The report contains the 50th/95th/99th percentiles of the latency of
+    each phase of the requests (upload: the accepted submit request, queue:
+    time spent being rejected with 503 or queued by the module, run: from
+    start to completion as reported by the module, propagation: from
+    completion to the client noticing it, download: result blobs, total),
+    the throughput in completed tasks per second and the error counts. The propagation phase relies on
+    the module timestamps, hence the module should run on the same host.
+    """
+    # read the blobs once, they are shared by all the requests
+    mix = []
+    for payload in payloads:
+        files = {}
+        for name, content in payload.get("files", {}).items():
+            if not isinstance(content, bytes):
+                with open(content, "rb") as blobFile:
+                    content = blobFile.read()
+            files[name] = content
+        mix.append((payload.get("weight", 1), payload["jsonPayload"], files))
+    totalWeight = float(sum(weight for weight, _, _ in mix))
+
+    rand = random.Random(seed)
+    lock = threading.Lock()
+    nextRequest = [0]
+    samples = []
+    errors = {}
+    retries = [0]
+
+    def selectPayload():
+        choice = rand.uniform(0, totalWeight)
+        for weight, jsonPayload, files in mix:
+            choice -= weight
+            if choice <= 0:
+                break
+        return jsonPayload, files
+
+    def runRequests(client):
+        while True:
+            lock.acquire()
+            try:
+                index = nextRequest[0]
+                if index >= numRequests:
+                    return
+                nextRequest[0] += 1
+                jsonPayload, files = selectPayload()
+            finally:
+                lock.release()
+
+            if arrivalRate > 0:
+                delay = startTime + index / float(arrivalRate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            try:
+                sample, error, numRetries = _runLoadTestRequest(
+                    client, jsonPayload, files, maxRetries,
+                    retryDelay, download)
+            except Exception as e:
+                sample, error, numRetries = None, type(e).__name__, 0
+
+            lock.acquire()
+            retries[0] += numRetries
+            if sample is not None:
+                samples.append(sample)
+            if error is not None:
+                errors[error] = errors.get(error, 0) + 1
+            lock.release()
+
+    def runClient():
+        # each thread keeps its own connection to the module
+        client = CAOSModuleClient.ModuleClient(hostname, port, poolSize=1)
+        try:
+            runRequests(client)
+        finally:
+            client.close()
+
+    startTime = time.time()
+    threads = [threading.Thread(target=runClient)
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - startTime
+
+    report = {
+        "requests": numRequests,
+        "completed": len(samples),
+        "errors": errors,
+        "retries503": retries[0],
+        "concurrency": concurrency,
+        "arrivalRate": arrivalRate,
+        "durationSeconds": duration,
+        "throughput": len(samples) / duration if duration > 0 else 0,
+        "latencySeconds": {}
+    }
+    for phase in ("upload", "queue", "run", "propagation", "download",
+                  "total"):
+        values = sorted(sample[phase] for sample in samples
+                        if sample.get(phase) is not None)
+        if values:
+            report["latencySeconds"][phase] = {
+                "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95),
+                "p99": _percentile(values, 99),
+                "mean": sum(values) / len(values),
+                "max": values[-1]
+            }
+
+    if outputPath is not None:
+        with open(outputPath, "w") as outputFile:
+            json.dump(report, outputFile, sort_keys=True, indent=4)
+
+    return report
+
+
+def _runLoadTestRequest(client, jsonPayload, files, maxRetries,
+                        retryDelay, download):
+    # returns (sample, error, retries), the sample is None for failed
+    # requests
+    sample = {}
+    startTime = time.time()
+
+    # submit the task, retrying while the module is at capacity
+    numRetries = 0
+    delay = retryDelay
+    while True:
+        uploadStart = time.time()
+        requestFiles = dict(files)
+        requestFiles["jsonPayload"] = json.dumps(jsonPayload)
+        response = client.post('/submit', files=requestFiles)
+        submitted = time.time()
+        if response.status_code != 503:
+            break
+        if numRetries >= maxRetries:
+            return None, "rejected", numRetries
+        numRetries += 1
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+    if response.status_code != 200:
+        return None, "submit_" + str(response.status_code), numRetries
+    taskId = json.loads(response.text)["taskId"]
+    sample["upload"] = submitted - uploadStart
+    sample["queue"] = uploadStart - startTime
 
-        blobs = jsonResponse["blobs"]
-        
-        for blob in blobs:
-            response = _doGet('http://' + options.host + ':' + str(options.port) + '/result/' + taskId + "/" + blob, False)
+    # wait for the task completion
+    state = "RUNNING"
+    while state in CAOSModuleClient._PENDING_STATES:
+        response = client.get('/wait/' + taskId + '?timeout=' +
+                              str(CAOSModuleClient._WAIT_TIMEOUT))
+        if CAOSModuleClient._isMissingApi(response):
+            response = client.get('/state/' + taskId)
+            time.sleep(0.1)
+        if response.status_code != 200:
+            return None, "state_" + str(response.status_code), numRetries
+        stateData = json.loads(response.text)
+        state = stateData["state"]
+    noticed = time.time()
+
+    # time spent in the admission queue of the module, if any
+    timestamps = stateData.get("timestamps", {})
+    started = timestamps.get("started")
+    if started is not None and timestamps.get("submitted") is not None:
+        sample["queue"] += max(started - timestamps["submitted"], 0)
+        submitted = max(started, submitted)
+    completed = timestamps.get("completed")
+    if completed is not None:
+        sample["run"] = max(completed - submitted, 0)
+        sample["propagation"] = max(noticed - completed, 0)
+    else:
+        sample["run"] = noticed - submitted
+    if state != "COMPLETED":
+        return None, "task_" + state, numRetries
+
+    if download:
+        downloadStart = time.time()
+        for blob in stateData["blobs"]:
+            response = client.get('/result/' + taskId + '/' + blob)
             if response.status_code != 200:
-                print("ERROR: failed to download blob: " + blob + " got response:")
-                print(response.text)
-            else:
-                blobPath = path.join(resultFolder, blob)
-                print("# INFO: Saving blob content to: " + blobPath)
-                with open(blobPath, "wb") as blobFile:
-                    blobFile.write(response.content)
-
-def _doGet(url, printResponse = True):
-    print("\n#### GET " + url)
-    response = requests.get(url)
+                return None, "download_" + str(response.status_code), \
+                    numRetries
+        sample["download"] = time.time() - downloadStart
+
+    sample["total"] = time.time() - startTime
+    return sample, None, numRetries
+
+
+def _percentile(sortedValues, percent):
+    # nearest-rank percentile
+    rank = int(math.ceil(percent / 100.0 * len(sortedValues))) - 1
+    return sortedValues[min(max(rank, 0), len(sortedValues) - 1)]
+
+
+def _doGet(client, route, printResponse = True):
+    print("\n#### GET " + client.baseUrl + route)
+    response = client.get(route)
     print("status_code: " + str(response.status_code))
     if printResponse:
         print("response: ")
@@ -205,9 +400,35 @@ def _doGet(url, printResponse = True):
 
     return response
 
-def _doPost(url, files={}, printResponse = True):
-    print("\n#### POST " + url)
-    response = requests.post(url, files=files)
+def _doGetStream(client, route):
+    # prints the response while it is received and returns the number of 
+    # received bytes (-1 in case of errors), an interrupted stream can be 
+    # resumed by the caller from the returned position
+    print("\n#### GET " + client.baseUrl + route)
+    response = client.get(route, stream=True)
+    print("status_code: " + str(response.status_code))
+    if response.status_code != 200:
+        return -1
+
+    print("response: ")
+    received = 0
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    try:
+        for chunk in response.iter_content(chunk_size=None):
+            received += len(chunk)
+            sys.stdout.write(decoder.decode(chunk))
+            sys.stdout.flush()
+    except requests.exceptions.RequestException as e:
+        print("\nWARNING: log stream interrupted: " + str(e))
+    finally:
+        response.close()
+    print("")
+
+    return received
+
+def _doPost(client, route, files={}, printResponse = True):
+    print("\n#### POST " + client.baseUrl + route)
+    response = client.post(route, files=files)
     print("status_code: " + str(response.status_code))
     if printResponse:
         print("response: ")
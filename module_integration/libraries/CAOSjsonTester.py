@@ -5,90 +5,280 @@ __LIST_KEYWORDS__ = ["@list@"]
 __DICT_KEYWORDS__ = ["@dict@"]
 __ITEM_KEYWORD__ = "@item@"
 __ANY_KEYWORD__ = "@any@"
+# dictionary key listing the keys that must be present in the json payload
+__REQUIRED_KEYWORD__ = "@required@"
+
+try:
+    __STR_TYPES__ = (str, unicode)
+except NameError:
+    __STR_TYPES__ = (str,)
+__NUMBER_TYPES__ = (int, float)
+__SCALAR_TYPES__ = __NUMBER_TYPES__ + __STR_TYPES__ + (bool,)
 
 
 class InvalidItem(Exception):
-    pass
+    """Raised when a json item does not match the validator
+
+    'path' is the path of the invalid item (e.g. $.functions['main'][0])
+    """
+    def __init__(self, message="invalid item", path="$"):
+        super(InvalidItem, self).__init__(path + ": " + message)
+        self.path = path
+
+
+class JsonValidator(object):
+    """Validator compiled from a template, see compile_validator"""
+
+    def __init__(self, validator):
+        self._root = _compile_container(validator)
+
+    def validate(self, jsonPayload):
+        """Returns True if the json payload matches the validator"""
+        return self._root.check(jsonPayload)
+
+    def find_error(self, jsonPayload):
+        """Returns None if the json payload matches the validator, otherwise
+        an InvalidItem describing the first invalid item and its path"""
+        if self._root.check(jsonPayload):
+            return None
+        error = self._root.explain(jsonPayload, "$")
+        return InvalidItem(error[1], error[0])
+
+
+def compile_validator(validator):
+    """Compiles a validator template (e.g. test_resources/response.json)
+    into a reusable JsonValidator.
+
+    The keywords of the template are resolved once, so validating a json
+    payload is a plain walk of the payload tree. The compiled validator
+    accepts exactly the payloads accepted by validate_json.
+
+    Keys that are missing from a json dictionary are not reported, unless
+    they are listed in the "@required@" key of the template dictionary, e.g.
+    {"@required@": ["functions"], "functions": "@dict@", "@item@": "@any@"}
+    """
+    return JsonValidator(validator)
+
+
+def validate_json(jsonPayload, validator):
+    return compile_validator(validator).validate(jsonPayload)
+
+
+# ---- compiled validator nodes ----
+
+class _Node(object):
+    description = "invalid item"
+
+    def check(self, item):
+        return False
+
+    def explain(self, item, path):
+        # returns None if the item is valid, (path, message) otherwise
+        if self.check(item):
+            return None
+        return path, self.description + ", found: " + _describe(item)
+
+
+class _AnyNode(_Node):
+    def check(self, item):
+        return True
+
+
+class _TypeNode(_Node):
+    def __init__(self, types, description):
+        self.types = frozenset(types)
+        self.description = description
+
+    def check(self, item):
+        return type(item) in self.types
+
+
+class _EqualNode(_Node):
+    def __init__(self, value):
+        self.value = value
+        self.description = "expected " + repr(value)
+
+    def check(self, item):
+        return item == self.value
+
 
+class _DictNode(_Node):
+    description = "expected a dictionary"
 
-def _validate_item(item, validator_item):
-    if type(validator_item) is str or type(validator_item) is unicode:
+    def __init__(self, validator):
+        self.required = list(validator.get(__REQUIRED_KEYWORD__, []))
+        self.keys = dict((key, _compile_item(value))
+                         for key, value in validator.items()
+                         if key != __REQUIRED_KEYWORD__)
+        self.variants = [self.keys[key] for key in validator
+                         if __ITEM_KEYWORD__ in key]
+        # type checks are inlined in check, the other nodes are dispatched
+        # through their check method
+        self.key_checks = dict((key, _inline_check(node))
+                               for key, node in self.keys.items())
+        self.variant_checks = [_inline_check(node) for node in self.variants]
+
+    def _check_value(self, key, item):
+        node = self.keys.get(key)
+        if node is not None:
+            return node.check(item)
+        for variant in self.variants:
+            if variant.check(item):
+                return True
+        return False
+
+    def check(self, item):
+        if type(item) is not dict:
+            return False
+        get_check = self.key_checks.get
+        for key, value in item.items():
+            check = get_check(key)
+            if check is not None:
+                if check.__class__ is frozenset:
+                    if type(value) not in check:
+                        return False
+                elif not check(value):
+                    return False
+                continue
+            for check in self.variant_checks:
+                if check.__class__ is frozenset:
+                    if type(value) in check:
+                        break
+                elif check(value):
+                    break
+            else:
+                return False
+        for key in self.required:
+            if key not in item:
+                return False
+        return True
+
+    def explain(self, item, path):
+        if type(item) is not dict:
+            return _Node.explain(self, item, path)
+        for key, value in item.items():
+            if self._check_value(key, value):
+                continue
+            value_path = path + "[" + repr(key) + "]"
+            node = self.keys.get(key)
+            if node is not None:
+                return node.explain(value, value_path)
+            if len(self.variants) == 1:
+                return self.variants[0].explain(value, value_path)
+            return value_path, "unexpected key, no " + __ITEM_KEYWORD__ + \
+                " variant matches: " + _describe(value)
+        for key in self.required:
+            if key not in item:
+                return path + "[" + repr(key) + "]", "required key is missing"
+        return None
+
+
+class _ListNode(_Node):
+    description = "expected a list"
+
+    def __init__(self, validator):
+        # a list validator contains the alternatives allowed for each item:
+        # type keywords accept any item of that type, other items are
+        # compared with the scalar values or validated by the containers
+        has_list = [i for i in __LIST_KEYWORDS__ if i in validator]
+        has_str = [i for i in __STR_KEYWORDS__ if i in validator]
+        has_int = [i for i in __INT_KEYWORDS__ if i in validator]
+        has_dict = [i for i in __DICT_KEYWORDS__ if i in validator]
+        dicts = [_DictNode(v) for v in validator if type(v) is dict]
+        lists = [_ListNode(v) for v in validator if type(v) is list]
+        scalars = [v for v in validator if type(v) not in (dict, list)]
+
+        self.dispatch = {list: None if has_list else lists,
+                         dict: None if has_dict else dicts}
+        for scalar_type in __STR_TYPES__:
+            self.dispatch[scalar_type] = None if has_str else scalars
+        for scalar_type in __NUMBER_TYPES__:
+            self.dispatch[scalar_type] = None if has_int else scalars
+        self.scalars = set(v for v in scalars if _is_hashable(v))
+
+    def _check_item(self, item):
+        alternatives = self.dispatch.get(type(item))
+        if alternatives is None:
+            return True
+        if type(item) in __SCALAR_TYPES__:
+            return item in self.scalars
+        for alternative in alternatives:
+            if alternative.check(item):
+                return True
+        return False
+
+    def check(self, item):
+        if type(item) is not list:
+            return False
+        check_item = self._check_item
+        for value in item:
+            if not check_item(value):
+                return False
+        return True
+
+    def explain(self, item, path):
+        if type(item) is not list:
+            return _Node.explain(self, item, path)
+        for index, value in enumerate(item):
+            if self._check_item(value):
+                continue
+            value_path = path + "[" + str(index) + "]"
+            alternatives = self.dispatch.get(type(value))
+            if type(value) not in __SCALAR_TYPES__ and \
+                    len(alternatives) == 1:
+                return alternatives[0].explain(value, value_path)
+            return value_path, "no alternative of the list matches: " + \
+                _describe(value)
+        return None
+
+
+def _inline_check(node):
+    # the set of types for type nodes, the check method otherwise
+    if type(node) is _TypeNode:
+        return node.types
+    return node.check
+
+
+def _compile_item(validator_item):
+    if type(validator_item) in __STR_TYPES__:
         if __ANY_KEYWORD__ in validator_item:
-            return
-        if ((validator_item in __LIST_KEYWORDS__ and type(item) is not list) or
-            (validator_item in __STR_KEYWORDS__ and type(item) is not str and type(item) is not unicode) or
-            (validator_item in __INT_KEYWORDS__ and
-             type(item) not in (int, float)) or
-            (validator_item in __BOOL_KEYWORDS__ and type(item) is not bool) or
-            (validator_item in __DICT_KEYWORDS__ and type(item) is not dict) or
-            (validator_item not in (__INT_KEYWORDS__ + __INT_KEYWORDS__ +
-                                    __STR_KEYWORDS__ + __BOOL_KEYWORDS__ +
-                                    __LIST_KEYWORDS__ + __DICT_KEYWORDS__) and
-                validator_item != item)):
-            raise InvalidItem()
+            return _AnyNode()
+        if validator_item in __LIST_KEYWORDS__:
+            return _TypeNode((list,), "expected a list")
+        if validator_item in __STR_KEYWORDS__:
+            return _TypeNode(__STR_TYPES__, "expected a string")
+        if validator_item in __INT_KEYWORDS__:
+            return _TypeNode(__NUMBER_TYPES__, "expected a number")
+        if validator_item in __BOOL_KEYWORDS__:
+            return _TypeNode((bool,), "expected a boolean")
+        if validator_item in __DICT_KEYWORDS__:
+            return _TypeNode((dict,), "expected a dictionary")
+        return _EqualNode(validator_item)
     elif type(validator_item) in (bool, int, float):
-        if item != validator_item:
-            raise InvalidItem()
+        return _EqualNode(validator_item)
     elif type(validator_item) in (dict, list):
-        _validate_json_helper(item, validator_item)
-    else:
-        raise InvalidItem()
-
-
-def _validate_list(item, validator_list):
-    if ((not [i for i in __LIST_KEYWORDS__ if i in validator_list] and
-         type(item) is list) or
-        (not [i for i in __STR_KEYWORDS__ if i in validator_list] and
-         type(item) is str) or
-        (not [i for i in __STR_KEYWORDS__ if i in validator_list] and
-         type(item) is unicode) or
-        (not [i for i in __INT_KEYWORDS__ if i in validator_list] and
-         type(item) in (int, float)) or
-        (not [i for i in __DICT_KEYWORDS__ if i in validator_list] and
-            type(item) is dict)):
-        if type(item) in (float, int, str, unicode, bool):
-            if item not in validator_list:
-                raise InvalidItem()
-        elif type(item) in (dict, list):
-            for v in validator_list:
-                try:
-                    _validate_json_helper(item, v)
-                    break
-                except InvalidItem:
-                    pass
-            else:
-                raise InvalidItem()
-        else:
-            raise InvalidItem()
-
-
-def _validate_json_helper(jsonPayload, validator):
-    if type(validator) is list and type(jsonPayload) is list:
-        for item in jsonPayload:
-            _validate_list(item, validator)
-    elif type(validator) is dict and type(jsonPayload) is dict:
-        for key, item in jsonPayload.items():
-            if key in validator:
-                _validate_item(item, validator[key])
-            else:
-                variants = [v for k, v in validator.items()
-                            if __ITEM_KEYWORD__ in k]
-                for v in variants:
-                    try:
-                        _validate_item(item, v)
-                        break
-                    except InvalidItem:
-                        pass
-                else:
-                    raise InvalidItem()
-    else:
-        raise InvalidItem()
+        return _compile_container(validator_item)
+    return _Node()
 
 
-def validate_json(jsonPayload, validator):
+def _compile_container(validator):
+    if type(validator) is dict:
+        return _DictNode(validator)
+    if type(validator) is list:
+        return _ListNode(validator)
+    return _Node()
+
+
+def _is_hashable(value):
     try:
-        _validate_json_helper(jsonPayload, validator)
+        hash(value)
         return True
-    except InvalidItem:
+    except TypeError:
         return False
-    return False
+
+
+def _describe(item):
+    description = repr(item)
+    if len(description) > 80:
+        description = description[:77] + "..."
+    return description
@@ -21,6 +21,13 @@ import sys
 import os
 from os import path
 import tarfile
+import zipfile
+import fnmatch
+import posixpath
+import shutil
+import hashlib
+import json
+import multiprocessing
 
 import re
 
@@ -30,6 +37,25 @@ import CAOSFlaskModule
 codeArchive_PATH = "codeArchive"
 __supported_templates__ = ['masterslave']
 
+# besides the source files of the accelerated functions, only the files 
+# matching these patterns (e.g. headers) are extracted from the code archive
+__include_patterns__ = ["*.h", "*.hh", "*.hpp", "*.hxx", "*.inc", "*.inl"]
+
+# storage of the module (tasks, blobs and results), kept across restarts
+storage_PATH = path.abspath("./data")
+# estimations are cached on disk within the module storage, so that they 
+# survive module restarts and they are discarded along with the storage
+estimationCache_PATH = path.join(storage_PATH, "estimationCache")
+# change the version whenever computeResourceEstimation changes, so that 
+# estimations computed by the previous implementation are not reused
+__estimator_version__ = "1"
+
+# the (function, device) estimations of a task are computed concurrently by
+# a pool of processes, the cores are split among the tasks that the module
+# runs concurrently
+__max_tasks__ = 2
+__parallelism__ = max(1, multiprocessing.cpu_count() // __max_tasks__)
+
 def runModule(jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
     """Parameters
     -------------
@@ -47,7 +73,9 @@ def runModule(jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
         files that are part of the response
     """
     
-    with open(outLogPath, "wt", buffering=1) as logFile:
+    # the log is opened in append mode, since it is shared with the 
+    # processes that compute the estimations
+    with open(outLogPath, "at", buffering=1) as logFile:
 
         # check if the architectural template is supported by this module
 
@@ -58,32 +86,23 @@ def runModule(jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
           raise Exception("Template '" + template_name + \
               "' appears to be not supported by this implementation of the module\n")
 
-        # --- untar code blob into workdir
+        # --- extract the needed sources from the code blob into workdir
         codeArchive = jsonPayload["codeArchive"]
+        architecturalTemplate = jsonPayload["architecturalTemplate"]
+        functionsIR = jsonPayload["functions"]
         
         srcPath = os.path.join(workDir, codeArchive_PATH)
         log("\nCreate temporary code directory in " + srcPath + "\n", logFile)
         os.mkdir(srcPath)
-        srcTar = tarfile.open(os.path.join(workDir, codeArchive))
-
-        # inspect members
-        invalid_member = False
-        for member in srcTar.getmembers():
-            if os.path.isabs(member.name) or member.name.startswith('..'):
-                invalid_member = True
-                log(member.name + " is absolute or upper path (..), which is not allowed\n", logFile)
-        if invalid_member:
-            log("source archive is invalid, exiting...\n", logFile)
-            return json_response
 
+        requiredPaths = [functionsIR[functionID]["filePath"] for functionID, functionData in \
+            architecturalTemplate["functions"].items() if functionData["hardwareAcceleration"]]
         log("Extracting sources to " + srcPath + "\n", logFile)
-        srcTar.extractall(path=srcPath)
-        srcTar.close()
+        extractCodeArchive(os.path.join(workDir, codeArchive), srcPath, requiredPaths, __include_patterns__, logFile)
 
         # --- retrieve list of devices for hardware estimation 
 
         nodeDefinition = jsonPayload["architecture"]["nodeDefinition"]
-        architecturalTemplate = jsonPayload["architecturalTemplate"]
         deviceInstances = architecturalTemplate["targetConfiguration"]["devices"]
         deviceTypes = set()
         for deviceID in deviceInstances:
@@ -96,8 +115,9 @@ def runModule(jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
         # --- retrieve the list of functions fow which hardware estimation is needed
         # and compute th result
         responseData = {}
-        functionsIR = jsonPayload["functions"]
+        compilerArguments = json.dumps(jsonPayload.get("supportedCompilers", []), sort_keys=True)
 
+        estimationJobs = []
         for functionID,functionData in architecturalTemplate["functions"].items():
             hwAcceleration = functionData["hardwareAcceleration"]
             log("Function ID: '" + functionID + "', hardware acceleration: " + str(hwAcceleration), logFile)
@@ -108,14 +128,129 @@ def runModule(jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
                             
                 for deviceType in deviceTypes:
                     deviceInfo = nodeDefinition["deviceTypes"][deviceType]
-                    log("Computing estimation for function: " + str(functionID) +
-                        " on device: " + str(deviceType), logFile)
-                    # Estimate resources of a specific hardware function
-                    estimation = computeResourceEstimation(functionsIR[functionID], deviceInfo, srcPath, logFile)
-                    responseData[functionID]["resourceEstimation"][deviceType] = estimation
+                    estimationJobs.append((functionID, deviceType, functionsIR[functionID], deviceInfo, \
+                        compilerArguments, srcPath, outLogPath))
+
+        # compute the estimations concurrently
+        results = runEstimations(estimationJobs, __parallelism__, logFile)
+        for functionID, deviceType, estimation in results:
+            responseData[functionID]["resourceEstimation"][deviceType] = estimation
 
         return responseData
 
+def runEstimations(estimationJobs, parallelism, logFile):
+    """Computes the estimations of the jobs (see estimateFunction) with a 
+    pool of at most 'parallelism' processes, returns their results in the 
+    order of the jobs. An exception raised by a job is raised here.
+    """
+    parallelism = min(parallelism, len(estimationJobs))
+    log("Computing " + str(len(estimationJobs)) + " estimations with " + str(max(parallelism, 1)) + \
+        " processes", logFile)
+    if parallelism <= 1:
+        return [estimateFunction(job) for job in estimationJobs]
+
+    pool = multiprocessing.Pool(parallelism)
+    try:
+        results = pool.map(estimateFunction, estimationJobs)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def estimateFunction(estimationJob):
+    """Computes the estimation of a function on a device, it is executed by
+    the processes of the pool. Returns (functionID, deviceType, estimation)
+    """
+    functionID, deviceType, functionIR, deviceInfo, compilerArguments, srcPath, outLogPath = estimationJob
+
+    with open(outLogPath, "at", buffering=1) as sharedLogFile:
+        logFile = PrefixedLog(sharedLogFile, "[" + functionID + " @ " + deviceType + "] ")
+        log("Computing estimation for function: " + str(functionID) +
+            " on device: " + str(deviceType), logFile)
+
+        # Estimate resources of a specific hardware function (unless
+        # the same function has already been estimated for the device)
+        estimationKey = getEstimationKey(functionIR, deviceInfo, compilerArguments, srcPath)
+        estimation = loadCachedEstimation(estimationKey)
+        if estimation != None:
+            log("Reusing cached estimation: " + str(estimation) + "\n", logFile)
+        else:
+            estimation = computeResourceEstimation(functionIR, deviceInfo, srcPath, logFile)
+            storeCachedEstimation(estimationKey, estimation)
+
+    return functionID, deviceType, estimation
+
+class PrefixedLog(object):
+    """Log file wrapper that prefixes every line with the estimation it 
+    belongs to, so that the interleaved lines of concurrent estimations
+    remain attributable
+    """
+
+    def __init__(self, logFile, prefix):
+        self.logFile = logFile
+        self.prefix = prefix
+
+    def write(self, text):
+        lines = text.splitlines(True)
+        self.logFile.write("".join(self.prefix + line if line.strip() else line for line in lines))
+
+#--------------------------[Code Archive]-----------------------------------
+
+def extractCodeArchive(archivePath, srcPath, requiredPaths, includePatterns, logFile):
+    """Extracts from a tar (optionally compressed) or zip code archive only 
+    the required files and the files matching the include patterns.
+
+    Tar archives are read in a single streaming pass, zip archives through
+    their central directory; members are validated while they are read and
+    an exception is raised if a member has an absolute or upper (..) path.
+    Returns the list of extracted paths.
+    """
+    required = set(posixpath.normpath(requiredPath) for requiredPath in requiredPaths)
+    extracted = []
+
+    def extractMember(memberName, openMember):
+        name = posixpath.normpath(memberName)
+        if posixpath.isabs(name) or name == ".." or name.startswith("../"):
+            log(memberName + " is absolute or upper path (..), which is not allowed\n", logFile)
+            raise Exception("source archive is invalid: member '" + memberName + "' is not allowed")
+        if openMember == None or \
+            (name not in required and not [p for p in includePatterns if fnmatch.fnmatch(name, p)]):
+            return
+
+        destPath = os.path.join(srcPath, *name.split("/"))
+        if not os.path.isdir(os.path.dirname(destPath)):
+            os.makedirs(os.path.dirname(destPath))
+        memberFile = openMember()
+        try:
+            with open(destPath, "wb") as destFile:
+                shutil.copyfileobj(memberFile, destFile)
+        finally:
+            memberFile.close()
+        extracted.append(name)
+
+    if zipfile.is_zipfile(archivePath):
+        with zipfile.ZipFile(archivePath) as srcZip:
+            for info in srcZip.infolist():
+                isFile = not info.filename.endswith("/")
+                extractMember(info.filename, (lambda: srcZip.open(info)) if isFile else None)
+    else:
+        srcTar = tarfile.open(archivePath, "r|*")
+        try:
+            for member in srcTar:
+                # links and special files are validated but never extracted
+                extractMember(member.name, (lambda: srcTar.extractfile(member)) if member.isfile() else None)
+        finally:
+            srcTar.close()
+
+    for requiredPath in required - set(extracted):
+        log("WARNING: " + requiredPath + " not found in the source archive\n", logFile)
+    log("Extracted " + str(len(extracted)) + " files: " + str(extracted) + "\n", logFile)
+
+    return extracted
+
 #--------------------------[Hardware Estimation]-----------------------------
 
 def computeResourceEstimation(functionIR, deviceInfo, srcPath, logFile):
@@ -130,6 +265,51 @@ def computeResourceEstimation(functionIR, deviceInfo, srcPath, logFile):
     
     return estimation
 
+#--------------------------[Estimation Cache]--------------------------------
+
+def getEstimationKey(functionIR, deviceInfo, compilerArguments, srcPath):
+    # the key covers the source lines of the function, so estimations are
+    # recomputed only for functions whose code actually changed
+    try:
+        with open(os.path.join(srcPath, functionIR["filePath"]), "rb") as sourceFile:
+            sourceLines = sourceFile.readlines()
+    except (IOError, OSError):
+        return None
+    source = b"".join(sourceLines[functionIR["startLine"] - 1:functionIR["endLine"]])
+
+    key = hashlib.sha256()
+    for field in (__estimator_version__, functionIR["clangName"], deviceInfo["partNumber"], compilerArguments):
+        key.update(field.encode("utf-8") + b"\0")
+    key.update(source)
+    return key.hexdigest()
+
+def loadCachedEstimation(estimationKey):
+    if estimationKey == None:
+        return None
+    try:
+        with open(os.path.join(estimationCache_PATH, estimationKey + ".json"), "rt") as cacheFile:
+            return json.load(cacheFile)
+    except (IOError, OSError, ValueError):
+        return None
+
+def storeCachedEstimation(estimationKey, estimation):
+    if estimationKey == None:
+        return
+    if not os.path.isdir(estimationCache_PATH):
+        try:
+            os.makedirs(estimationCache_PATH)
+        except OSError:
+            # created by a concurrent task
+            pass
+
+    # write a temporary file first, so that concurrent tasks never read 
+    # partial estimations
+    cachePath = os.path.join(estimationCache_PATH, estimationKey + ".json")
+    tmpPath = cachePath + "." + str(os.getpid()) + ".tmp"
+    with open(tmpPath, "wt") as cacheFile:
+        json.dump(estimation, cacheFile)
+    os.rename(tmpPath, cachePath)
+
 def log(text, logFile):
     # print needed only for debugging purposes
     print(text)
@@ -139,13 +319,19 @@ def log(text, logFile):
     logFile.write(text + "\n")
 
 
-# Take a look at CAOSFlaskModule for more info on the parameters
-CAOSFlaskModule.start(
-    runCallback=runModule,
-    apiVersion="1.0",
-    moduleName="hw-estimation",
-    implementationName="fpl",
-    threaded=True,
-    defaultPort=5022,
-    maxTasks=2
-)
+# the module is started only when this file is run, so that its functions 
+# can be imported (e.g. by the tests)
+if __name__ == "__main__":
+    # Take a look at CAOSFlaskModule for more info on the parameters
+    CAOSFlaskModule.start(
+        runCallback=runModule,
+        apiVersion="1.0",
+        moduleName="hw-estimation",
+        implementationName="fpl",
+        threaded=True,
+        defaultPort=5022,
+        maxTasks=__max_tasks__,
+        storagePath=storage_PATH,
+        cacheable=True,
+        requestTemplate=path.join(path.dirname(path.abspath(__file__)), 'test_resources', 'request.json')
+    )
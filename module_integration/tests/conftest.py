@@ -0,0 +1,130 @@
+import sys
+import os
+import json
+import time
+import socket
+import signal
+import subprocess
+from os import path
+
+import pytest
+import requests
+
+current_directory = path.dirname(os.path.abspath(__file__))
+libraries_directory = path.join(current_directory, '..', 'libraries')
+sys.path.append(libraries_directory)
+import CAOSModuleClient
+
+try:
+    import aiohttp  # noqa: F401
+    _SERVERS = ["flask", "asyncio"]
+except ImportError:
+    _SERVERS = ["flask"]
+
+_STARTUP_TIMEOUT = 30
+
+
+def _getFreePort():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class _Process(object):
+    """ A module (or gateway) started in its own process, 'client' is a
+    ModuleClient connected to it """
+
+    def __init__(self, arguments, env=None, cwd=None):
+        self.port = _getFreePort()
+        self.url = "http://localhost:" + str(self.port)
+        self.process = subprocess.Popen(
+            [sys.executable] + arguments + ["-H", "localhost", "-P",
+                                            str(self.port)],
+            env=env, cwd=cwd, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        self.client = CAOSModuleClient.ModuleClient("localhost", self.port)
+
+        deadline = time.time() + _STARTUP_TIMEOUT
+        while True:
+            try:
+                requests.get(self.url + "/info")
+                break
+            except requests.ConnectionError:
+                if self.process.poll() is not None or \
+                        time.time() > deadline:
+                    self.stop()
+                    pytest.fail("the module did not start")
+                time.sleep(0.1)
+
+    def stop(self):
+        self.client.close()
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+@pytest.fixture
+def start_module(tmp_path):
+    """ Returns a function that starts sample_module.py with the given
+    options of CAOSFlaskModule.start (the storage is in tmp_path/data by
+    default, see module.storage), the modules are stopped at the end of
+    the test """
+    started = []
+
+    def startModule(**options):
+        options.setdefault("storagePath", str(tmp_path / "data"))
+        env = dict(os.environ)
+        env["CAOS_TEST_OPTIONS"] = json.dumps(options)
+        module = _Process([path.join(current_directory, "sample_module.py")],
+                          env)
+        module.storage = options["storagePath"]
+        started.append(module)
+        return module
+
+    yield startModule
+
+    for module in started:
+        module.stop()
+
+
+@pytest.fixture
+def start_gateway():
+    """ Returns a function that starts a CAOSModuleGateway in front of the
+    given modules """
+    started = []
+
+    def startGateway(modules):
+        backends = ",".join("localhost:" + str(module.port)
+                            for module in modules)
+        gateway = _Process([path.join(libraries_directory,
+                                      "CAOSModuleGateway.py"),
+                            "-B", backends])
+        started.append(gateway)
+        return gateway
+
+    yield startGateway
+
+    for gateway in started:
+        gateway.stop()
+
+
+@pytest.fixture(params=_SERVERS)
+def server(request):
+    """ The http servers of CAOSFlaskModule """
+    return request.param
+
+
+def wait_for(condition, timeout=10):
+    """ Waits for condition() to return a true value, and returns it """
+    deadline = time.time() + timeout
+    while True:
+        value = condition()
+        if value or time.time() > deadline:
+            return value
+        time.sleep(0.05)
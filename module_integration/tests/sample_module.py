@@ -0,0 +1,84 @@
+# Module used by the tests, its callback behaves as requested by the json
+# payload of each task.
+#
+# The request json may contain:
+#   - log: text appended to the log
+#   - logLines, logInterval: number of lines appended to the log, one every
+#     logInterval seconds (default 0)
+#   - results: dictionary of result blob names and their content (a string,
+#     or the size in bytes of a blob of "x")
+#   - alloc: megabytes of memory allocated (and touched) by the callback
+#   - childAlloc: megabytes of memory allocated by a child process
+#   - burn: seconds of cpu time spent by the callback
+#   - sleep: seconds the callback sleeps before returning
+#   - fail: message of the Error raised by the callback
+#   - crash: the callback kills its own process with SIGKILL
+#   - unserializable: the callback returns a response that is not json
+# The response maps the uploaded blob names to the SHA-256 of their content.
+# The options of CAOSFlaskModule.start are read from the json of the
+# CAOS_TEST_OPTIONS environment variable.
+
+import sys
+import os
+import json
+import time
+import signal
+import hashlib
+import subprocess
+from os import path
+
+current_directory = path.dirname(os.path.abspath(__file__))
+sys.path.append(path.join(current_directory, '..', 'libraries'))
+import CAOSFlaskModule
+
+
+def runModule(jsonPayload, workDir, blobNames, outLogPath, outBlobDir):
+    with open(outLogPath, "at") as log:
+        log.write(jsonPayload.get("log", ""))
+        for line in range(jsonPayload.get("logLines", 0)):
+            log.write("line " + str(line) + "\n")
+            log.flush()
+            time.sleep(jsonPayload.get("logInterval", 0))
+
+    for name, content in jsonPayload.get("results", {}).items():
+        with open(path.join(outBlobDir, name), "wb") as result:
+            if isinstance(content, int):
+                result.write(b"x" * content)
+            else:
+                result.write(content.encode("utf-8"))
+
+    memory = None
+    if jsonPayload.get("alloc"):
+        memory = bytearray(jsonPayload["alloc"] * 1024 * 1024)
+        for offset in range(0, len(memory), 4096):
+            memory[offset] = 1
+    if jsonPayload.get("childAlloc"):
+        subprocess.check_call([sys.executable, "-c", "b'x' * " + str(
+            jsonPayload["childAlloc"] * 1024 * 1024)])
+    end = time.time() + jsonPayload.get("burn", 0)
+    while time.time() < end:
+        pass
+    time.sleep(jsonPayload.get("sleep", 0))
+
+    if jsonPayload.get("crash"):
+        os.kill(os.getpid(), signal.SIGKILL)
+    if jsonPayload.get("fail"):
+        raise CAOSFlaskModule.Error(jsonPayload["fail"], {"pid": os.getpid()})
+    if jsonPayload.get("unserializable"):
+        return {"value": object()}
+
+    blobs = {}
+    for name in blobNames:
+        with open(path.join(workDir, name), "rb") as blob:
+            blobs[name] = hashlib.sha256(blob.read()).hexdigest()
+    return {"blobs": blobs, "pid": os.getpid()}
+
+
+CAOSFlaskModule.start(
+    runModule,
+    apiVersion="1.0",
+    moduleName="test",
+    implementationName="sample",
+    threaded=True,
+    **json.loads(os.environ.get("CAOS_TEST_OPTIONS", "{}"))
+)
@@ -0,0 +1,175 @@
+# Tests of the client side: module client, load-testing harness, json
+# validators and load-balancing gateway.
+
+import gzip
+import http.client
+import os
+
+import pytest
+
+import CAOSjsonTester
+import CAOSModuleTester
+from CAOSModuleClient import RequestError
+from conftest import wait_for
+
+
+def test_client_download(start_module, server, tmp_path):
+    module = start_module(server=server)
+    results = {"a.txt": "first", "b.bin": 3 * 1024 * 1024}
+    taskId = module.client.submit({"results": results})
+    state = module.client.wait(taskId)
+    paths = module.client.download(taskId, state["blobs"], str(tmp_path))
+    assert sorted(os.path.basename(blobPath) for blobPath in paths) == \
+        ["a.txt", "b.bin"]
+    assert (tmp_path / "b.bin").read_bytes() == b"x" * (3 * 1024 * 1024)
+    with pytest.raises(RequestError):
+        module.client.downloadBlob(taskId, "missing",
+                                   str(tmp_path / "missing"))
+
+
+def test_client_resumes_download(start_module, tmp_path):
+    module = start_module()
+    content = "".join(str(i % 10) for i in range(100000))
+    taskId = module.client.submit({"results": {"out.txt": content}})
+    module.client.wait(taskId)
+
+    # a partial download is resumed from its end
+    (tmp_path / "out.txt.part").write_bytes(b"0123456789")
+    module.client.downloadBlob(taskId, "out.txt", str(tmp_path / "out.txt"))
+    assert (tmp_path / "out.txt").read_text() == content
+    # a partial file larger than the blob is downloaded again
+    (tmp_path / "out.txt.part").write_bytes(b"x" * 200000)
+    module.client.downloadBlob(taskId, "out.txt", str(tmp_path / "out.txt"))
+    assert (tmp_path / "out.txt").read_text() == content
+
+
+def test_client_download_archive(start_module, server, tmp_path):
+    module = start_module(server=server)
+    taskId = module.client.submit({"results": {"a.txt": "first",
+                                               "b.bin": 100000}})
+    module.client.wait(taskId)
+    paths = module.client.downloadArchive(taskId, str(tmp_path))
+    assert sorted(os.path.basename(blobPath) for blobPath in paths) == \
+        ["a.txt", "b.bin"]
+    assert (tmp_path / "a.txt").read_bytes() == b"first"
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_load_test(start_module, tmp_path):
+    module = start_module(maxTasks=2)
+    payloads = [{"jsonPayload": {"sleep": 0.1}, "weight": 3},
+                {"jsonPayload": {"results": {"out.txt": "x"}},
+                 "files": {"in.bin": b"blob"}}]
+    report = CAOSModuleTester.loadTest(
+        payloads, port=module.port, numRequests=12, concurrency=4,
+        download=True, seed=1, outputPath=str(tmp_path / "report.json"))
+    assert report["completed"] == 12
+    assert report["errors"] == {}
+    # 4 clients and 2 task slots: some requests are rejected and retried
+    assert report["retries503"] > 0
+    latency = report["latencySeconds"]["total"]
+    assert latency["p50"] <= latency["p95"] <= latency["p99"] <= \
+        latency["max"]
+    assert (tmp_path / "report.json").exists()
+
+
+def test_percentile():
+    values = list(range(1, 11))
+    assert CAOSModuleTester._percentile(values, 50) == 5
+    assert CAOSModuleTester._percentile(values, 95) == 10
+    assert CAOSModuleTester._percentile(values, 0) == 1
+    values = list(range(1, 21))
+    assert CAOSModuleTester._percentile(values, 50) == 10
+    assert CAOSModuleTester._percentile(values, 95) == 19
+    assert CAOSModuleTester._percentile(values, 99) == 20
+
+
+def test_compiled_validator():
+    template = {"@required@": ["functions"],
+                "functions": {"@item@": {"name": "@string@",
+                                         "lines": ["@int@"]}},
+                "enabled": "@bool@"}
+    validator = CAOSjsonTester.compile_validator(template)
+    valid = {"functions": {"main": {"name": "main", "lines": [1, 2]}},
+             "enabled": True}
+    assert validator.validate(valid)
+    assert validator.find_error(valid) is None
+    invalid = {"functions": {"main": {"name": "main", "lines": ["x"]}}}
+    error = validator.find_error(invalid)
+    assert error.path == "$['functions']['main']['lines'][0]"
+    assert not validator.validate({"enabled": True})
+    # the compiled validator matches the interpreted one
+    for payload in (valid, invalid, {"enabled": True}, {"functions": {}}):
+        assert validator.validate(payload) == \
+            CAOSjsonTester.validate_json(payload, template)
+
+
+def test_gateway(start_module, start_gateway, tmp_path):
+    modules = [start_module(maxTasks=1,
+                            storagePath=str(tmp_path / ("data" + str(i))))
+               for i in range(2)]
+    gateway = start_gateway(modules)
+    client = gateway.client
+    info = client.getInfo()
+    assert info["maxTasks"] == 2
+    assert [instance["healthy"] for instance in info["instances"]] == \
+        [True, True]
+
+    # the tasks are spread over the instances, then rejected
+    tasks = [client.submit({"sleep": 1, "results": {"out.txt": str(i)},
+                            "log": "task " + str(i)}) for i in range(2)]
+    assert [module.client.getInfo()["runningTasks"]
+            for module in modules] == [1, 1]
+    with pytest.raises(RequestError) as error:
+        client.submit({})
+    assert error.value.statusCode == 503
+
+    # the task APIs are forwarded to the instance of the task
+    for i, taskId in enumerate(tasks):
+        assert client.wait(taskId)["state"] == "COMPLETED"
+        assert client.get("/log/" + taskId).text == "task " + str(i)
+        assert client.get("/result/" + taskId + "/out.txt").text == str(i)
+        paths = client.downloadArchive(taskId, str(tmp_path / taskId))
+        assert [os.path.basename(blobPath) for blobPath in paths] == \
+            ["out.txt"]
+    assert client.get("/state/t_unknown").status_code == 404
+
+    # the requests are sent to the instances that are still running
+    modules[0].stop()
+    taskId = client.submit({})
+    assert client.wait(taskId)["state"] == "COMPLETED"
+    assert modules[1].client.getState(taskId)["state"] == "COMPLETED"
+    assert wait_for(lambda: not client.getInfo()["instances"][0]["healthy"])
+
+
+def _getWithEncoding(process, route, acceptEncoding):
+    # returns the response headers and the body as sent, without any
+    # Accept-Encoding header if acceptEncoding is None
+    connection = http.client.HTTPConnection("localhost", process.port)
+    connection.putrequest("GET", route, skip_accept_encoding=True)
+    if acceptEncoding is not None:
+        connection.putheader("Accept-Encoding", acceptEncoding)
+    connection.endheaders()
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.headers, body
+
+
+def test_gateway_passes_encoding_through(start_module, start_gateway):
+    module = start_module()
+    gateway = start_gateway([module])
+    result = b"compressible result\n" * 1000
+    taskId = gateway.client.submit({"results": {"out.txt": result.decode(
+        "utf-8")}})
+    gateway.client.wait(taskId)
+
+    for acceptEncoding in (None, "identity", "gzip"):
+        headers, body = _getWithEncoding(
+            gateway, "/result/" + taskId + "/out.txt", acceptEncoding)
+        if acceptEncoding == "gzip":
+            assert headers["Content-Encoding"] == "gzip"
+            body = gzip.decompress(body)
+        else:
+            assert "Content-Encoding" not in headers
+        assert body == result
@@ -0,0 +1,174 @@
+# Tests of the hw resource estimation module of demo_fpl: estimation cache,
+# concurrent estimations and extraction of the code archive.
+
+import importlib.util
+import io
+import os
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                            "m_2.2_hw_resource_estimation", "demo_fpl",
+                            "module.py")
+_SOURCE = b"int x;\nvoid f() {\n  x++;\n}\n"
+_DEVICE = {"partNumber": "xcvu9p-flgb2104-2-i"}
+
+
+@pytest.fixture
+def hw_module(tmp_path, monkeypatch):
+    """ module.py of demo_fpl, imported without starting the module, with
+    its estimation cache in tmp_path """
+    spec = importlib.util.spec_from_file_location("hw_estimation",
+                                                  _MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # the processes of the pool find the estimation functions by module name
+    monkeypatch.setitem(sys.modules, "hw_estimation", module)
+    spec.loader.exec_module(module)
+    module.estimationCache_PATH = str(tmp_path / "estimationCache")
+    return module
+
+
+def _writeSources(srcPath, source=_SOURCE, names=("f",)):
+    os.makedirs(os.path.join(srcPath, "code"))
+    for name in names:
+        with open(os.path.join(srcPath, "code", name + ".c"), "wb") as srcFile:
+            srcFile.write(source)
+
+
+def _functionIR(name="f"):
+    return {"filePath": "code/" + name + ".c", "startLine": 2, "endLine": 4,
+            "clangName": "_Z1" + name + "v"}
+
+
+def test_estimation_cache(hw_module, tmp_path):
+    srcPath = str(tmp_path / "src")
+    _writeSources(srcPath)
+    key = hw_module.getEstimationKey(_functionIR(), _DEVICE, "[]", srcPath)
+    assert hw_module.loadCachedEstimation(key) is None
+    hw_module.storeCachedEstimation(key, {"LUT": 1})
+    assert hw_module.loadCachedEstimation(key) == {"LUT": 1}
+
+    # the key covers the lines of the function, the device and the compilers
+    other = str(tmp_path / "other")
+    _writeSources(other, b"int y;\n" + _SOURCE.split(b"\n", 1)[1])
+    assert hw_module.getEstimationKey(_functionIR(), _DEVICE, "[]",
+                                      other) == key
+    changed = str(tmp_path / "changed")
+    _writeSources(changed, _SOURCE.replace(b"x++", b"x--"))
+    for keyArguments in ((_functionIR(), _DEVICE, "[]", changed),
+                         (_functionIR(), {"partNumber": "other"}, "[]",
+                          srcPath),
+                         (_functionIR(), _DEVICE, '["gcc"]', srcPath)):
+        assert hw_module.getEstimationKey(*keyArguments) != key
+    # a function whose source is missing is not cached
+    assert hw_module.getEstimationKey(_functionIR("g"), _DEVICE, "[]",
+                                      srcPath) is None
+
+    # a corrupted entry is a miss, and it is replaced
+    with open(os.path.join(hw_module.estimationCache_PATH, key + ".json"),
+              "wt") as cacheFile:
+        cacheFile.write('{"LUT": ')
+    assert hw_module.loadCachedEstimation(key) is None
+    hw_module.storeCachedEstimation(key, {"LUT": 2})
+    assert hw_module.loadCachedEstimation(key) == {"LUT": 2}
+
+
+def test_estimation_reuses_cache(hw_module, tmp_path):
+    srcPath = str(tmp_path / "src")
+    _writeSources(srcPath)
+    logPath = str(tmp_path / "log.txt")
+    job = ("f", "fpga", _functionIR(), _DEVICE, "[]", srcPath, logPath)
+    first = hw_module.estimateFunction(job)
+    assert hw_module.estimateFunction(job) == first
+    with open(logPath) as logFile:
+        assert logFile.read().count("Reusing cached estimation") == 1
+
+
+def test_parallel_estimations(hw_module, tmp_path):
+    names = ["f" + str(i) for i in range(4)]
+    srcPath = str(tmp_path / "src")
+    _writeSources(srcPath, names=names)
+    logPath = str(tmp_path / "log.txt")
+    jobs = [(name, device, _functionIR(name), _DEVICE, "[]", srcPath, logPath)
+            for name in names for device in ("fpga0", "fpga1")]
+    with open(logPath, "at", buffering=1) as logFile:
+        results = hw_module.runEstimations(jobs, 3, logFile)
+    # the results are in the order of the jobs
+    assert [result[:2] for result in results] == [job[:2] for job in jobs]
+
+    # the log lines of each estimation are prefixed with its job
+    with open(logPath) as logFile:
+        lines = [line for line in logFile.read().splitlines() if line]
+    assert lines[0] == "Computing 8 estimations with 3 processes"
+    for name, device in (job[:2] for job in jobs):
+        prefix = "[" + name + " @ " + device + "] "
+        assert prefix + "Computing estimation for function: " + name + \
+            " on device: " + device in lines
+    assert all(line.startswith("[") for line in lines[1:])
+
+    # the exception of a job is raised, once the pool is stopped
+    broken = dict(_functionIR("f0"), filePath=None)
+    jobs.insert(1, ("f0", "broken", broken, _DEVICE, "[]", srcPath, logPath))
+    with open(logPath, "at", buffering=1) as logFile:
+        with pytest.raises(TypeError):
+            hw_module.runEstimations(jobs, 3, logFile)
+
+
+def test_prefixed_log(hw_module):
+    output = io.StringIO()
+    hw_module.PrefixedLog(output, "[f] ").write("a\n\nb\n")
+    assert output.getvalue() == "[f] a\n\n[f] b\n"
+
+
+def _writeArchive(archivePath, members):
+    if archivePath.endswith(".zip"):
+        with zipfile.ZipFile(archivePath, "w") as archive:
+            for name, data in members:
+                archive.writestr(name, data)
+    else:
+        with tarfile.open(archivePath, "w:gz") as archive:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+
+@pytest.mark.parametrize("archiveName", ["code.tar.gz", "code.zip"])
+def test_extract_code_archive(hw_module, tmp_path, archiveName):
+    archivePath = str(tmp_path / archiveName)
+    _writeArchive(archivePath, [("./code/f.c", b"f"), ("code/f.h", b"h"),
+                                ("code/other.c", b"other"),
+                                ("doc/readme.txt", b"doc")])
+    srcPath = str(tmp_path / "src")
+    os.mkdir(srcPath)
+    log = io.StringIO()
+    extracted = hw_module.extractCodeArchive(
+        archivePath, srcPath, ["code/f.c", "code/missing.c"],
+        hw_module.__include_patterns__, log)
+    # only the required sources and the headers are extracted
+    assert sorted(extracted) == ["code/f.c", "code/f.h"]
+    assert sorted(os.listdir(os.path.join(srcPath, "code"))) == \
+        ["f.c", "f.h"]
+    assert not os.path.exists(os.path.join(srcPath, "doc"))
+    assert "code/missing.c not found" in log.getvalue()
+
+
+@pytest.mark.parametrize("archiveName", ["code.tar.gz", "code.zip"])
+@pytest.mark.parametrize("memberName", ["../evil.h", "code/../../evil.h",
+                                        "/tmp/evil.h"])
+def test_extract_refuses_unsafe_paths(hw_module, tmp_path, archiveName,
+                                      memberName):
+    archivePath = str(tmp_path / archiveName)
+    _writeArchive(archivePath, [("code/f.c", b"f"), (memberName, b"evil")])
+    srcPath = str(tmp_path / "work" / "src")
+    os.makedirs(srcPath)
+    with pytest.raises(Exception) as error:
+        hw_module.extractCodeArchive(archivePath, srcPath, ["code/f.c"],
+                                     hw_module.__include_patterns__,
+                                     io.StringIO())
+    assert "is not allowed" in str(error.value)
+    assert not os.path.exists(str(tmp_path / "work" / "evil.h"))
+    assert not os.path.exists(str(tmp_path / "evil.h"))
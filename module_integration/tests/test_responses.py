@@ -0,0 +1,159 @@
+# Tests of the responses of the module: metrics and timings, profiles,
+# compression of results, logs and json responses, result archives.
+
+import gzip
+import io
+import pstats
+import tarfile
+
+import pytest
+
+import CAOSFlaskModule
+from CAOSModuleClient import RequestError
+
+_RESULT = b"compressible result\n" * 1000
+_MB = 1024 * 1024
+
+
+def _getRaw(module, route, acceptEncoding, headers={}):
+    # returns the response and its body as it is sent by the module
+    requestHeaders = {"Accept-Encoding": acceptEncoding}
+    requestHeaders.update(headers)
+    response = module.client.get(route, headers=requestHeaders, stream=True)
+    return response, response.raw.read(decode_content=False)
+
+
+def test_metrics_and_timings(start_module, server):
+    module = start_module(server=server)
+    state = module.client.wait(module.client.submit({"sleep": 0.2}))
+    assert set(state["timings"]) >= set(["store", "spawn", "callback",
+                                         "move", "collect"])
+    assert state["timings"]["callback"] >= 0.2
+    assert state["peakRssBytes"] > 0
+    module.client.wait(module.client.submit({"fail": "broken"}))
+
+    response = module.client.get("/metrics")
+    assert response.headers["Content-Type"].startswith("text/plain")
+    metrics = response.text
+    assert 'caos_tasks_completed_total{state="COMPLETED"} 1' in metrics
+    assert 'caos_tasks_completed_total{state="FAILED"} 1' in metrics
+    assert 'caos_http_requests_total{route="/submit",code="200"} 2' in \
+        metrics
+    assert "caos_task_callback_seconds_count 2" in metrics
+    assert "caos_running_tasks 0" in metrics
+
+
+def test_peak_memory_per_task(start_module, tmp_path):
+    module = start_module()
+    state = module.client.wait(module.client.submit({"childAlloc": 200}))
+    # the peak of the children of the task is included
+    assert state["peakRssBytes"] > 200 * _MB
+
+    module = start_module(workerPool=True, maxTasks=1,
+                          storagePath=str(tmp_path / "pool"))
+    heavy = module.client.wait(module.client.submit({"childAlloc": 200}))
+    light = module.client.wait(module.client.submit({}))
+    assert heavy["response"]["pid"] == light["response"]["pid"]
+    # the peak of a worker of the pool is measured per task
+    assert light["peakRssBytes"] < 100 * _MB
+
+
+@pytest.mark.parametrize("profiler", ["cprofile", "sampling"])
+def test_profiling(start_module, profiler, tmp_path):
+    module = start_module()
+    taskId = module.client.submit({"burn": 0.2}, profile=profiler)
+    state = module.client.wait(taskId)
+    profileBlob = CAOSFlaskModule._PROFILERS[profiler]
+    assert profileBlob in state["blobs"]
+    assert "profile of the task" in module.client.get("/log/" + taskId).text
+    module.client.download(taskId, [profileBlob], str(tmp_path))
+    if profiler == "cprofile":
+        pstats.Stats(str(tmp_path / profileBlob))
+    else:
+        with open(str(tmp_path / profileBlob)) as profileFile:
+            assert "runModule" in profileFile.read()
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, profile="unknown")
+    assert error.value.statusCode == 400
+
+
+def test_profiling_of_every_task(start_module):
+    module = start_module(profile="sampling")
+    state = module.client.wait(module.client.submit({}))
+    assert "profile.folded" in state["blobs"]
+    state = module.client.wait(module.client.submit({}, profile="none"))
+    assert state["blobs"] == []
+
+
+def test_result_compression(start_module, server):
+    module = start_module(server=server)
+    taskId = module.client.submit({"results": {"out.txt": _RESULT.decode(
+        "utf-8")}, "log": _RESULT.decode("utf-8")})
+    module.client.wait(taskId)
+
+    for route in ("/result/" + taskId + "/out.txt", "/log/" + taskId):
+        response, body = _getRaw(module, route, "gzip")
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(body) == _RESULT
+        response, body = _getRaw(module, route, "identity")
+        assert "Content-Encoding" not in response.headers
+        assert body == _RESULT
+        # byte ranges refer to the uncompressed content
+        response, body = _getRaw(module, route, "gzip",
+                                 {"Range": "bytes=0-9"})
+        assert response.status_code == 206
+        assert body == _RESULT[:10]
+
+
+def test_json_compression(start_module, server):
+    module = start_module(server=server)
+    state = {"results": dict(("out" + str(i), "x") for i in range(100))}
+    taskId = module.client.submit(state)
+    module.client.wait(taskId)
+    response, body = _getRaw(module, "/state/" + taskId, "gzip")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert b"out99" in gzip.decompress(body)
+    response, body = _getRaw(module, "/info", "gzip")
+    assert "Content-Encoding" not in response.headers
+
+
+def test_negotiate_encoding():
+    negotiate = CAOSFlaskModule._negotiateEncoding
+    assert negotiate(None) is None
+    assert negotiate("identity") is None
+    assert negotiate("gzip, deflate") == "gzip"
+    assert negotiate("gzip;q=0") is None
+    assert negotiate("*") == ("zstd" if CAOSFlaskModule.zstandard
+                              else "gzip")
+
+
+@pytest.mark.parametrize("archive", [".tar", ".tar.gz"])
+def test_result_archive(start_module, server, archive):
+    module = start_module(server=server)
+    results = {"a.txt": "first", "b.bin": 300000}
+    taskId = module.client.submit({"results": results})
+    module.client.wait(taskId)
+
+    response, body = _getRaw(module, "/results/" + taskId + archive,
+                             "identity")
+    assert response.status_code == 200
+    assert taskId + archive in response.headers["Content-Disposition"]
+    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+        assert sorted(tar.getnames()) == ["a.txt", "b.bin"]
+        assert tar.extractfile("a.txt").read() == b"first"
+        assert tar.extractfile("b.bin").read() == b"x" * 300000
+    assert module.client.get("/results/" + taskId + ".zip").status_code \
+        == 404
+    assert module.client.get("/results/t_unknown.tar").status_code == 404
+
+
+def test_result_archive_size(tmp_path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "nested.txt").write_bytes(b"n" * 513)
+    (tmp_path / "empty").write_bytes(b"")
+    archive = CAOSFlaskModule._ResultArchive(str(tmp_path))
+    data = b"".join(archive.read())
+    assert len(data) == archive.size
+    assert len(data) % tarfile.RECORDSIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert sorted(tar.getnames()) == ["dir", "dir/nested.txt", "empty"]
@@ -0,0 +1,132 @@
+# Tests of the admission of the tasks: request validation, admission queue
+# (priorities, fair share, deadlines) and resource budgets.
+
+import time
+
+import pytest
+
+import CAOSFlaskModule
+from CAOSModuleClient import RequestError
+from conftest import wait_for
+
+_MB = 1024 * 1024
+
+
+def test_request_template(start_module, server):
+    template = {"@required@": ["name"], "name": "@string@",
+                "@item@": "@any@"}
+    module = start_module(server=server, requestTemplate=template)
+    with pytest.raises(RequestError) as error:
+        module.client.submit({"other": 1})
+    assert error.value.statusCode == 400
+    assert "name" in error.value.response["message"]
+    with pytest.raises(RequestError) as error:
+        module.client.submit({"name": 1})
+    assert error.value.statusCode == 400
+    assert module.client.wait(module.client.submit(
+        {"name": "task"}))["state"] == "COMPLETED"
+
+
+def test_admission_queue(start_module, server):
+    module = start_module(server=server, maxTasks=1, queueMaxLength=2)
+    running = module.client.submit({"sleep": 1})
+    queued = [module.client.submit({}) for _ in range(2)]
+    state = module.client.getState(queued[1])
+    assert state["state"] == "QUEUED"
+    assert state["position"] == 2
+    assert module.client.getInfo()["queue"]["length"] == 2
+    with pytest.raises(RequestError) as error:
+        module.client.submit({})
+    assert error.value.statusCode == 503
+    for taskId in [running] + queued:
+        assert module.client.wait(taskId)["state"] == "COMPLETED"
+    timings = module.client.getState(queued[1])["timings"]
+    assert timings["queue"] > 0.5
+
+
+def test_queue_deadline_and_cancel(start_module, server):
+    module = start_module(server=server, maxTasks=1, queueMaxLength=5)
+    running = module.client.submit({"sleep": 2})
+    expiring = module.client.submit({}, deadline=0.5)
+    cancelled = module.client.submit({})
+    module.client.kill(cancelled)
+    state = module.client.getState(cancelled)
+    assert state["state"] == "FAILED"
+    assert state["stackTrace"] == "Task cancelled by user"
+    state = module.client.wait(expiring)
+    assert state["state"] == "FAILED"
+    assert "Deadline" in state["stackTrace"]
+    assert module.client.wait(running)["state"] == "COMPLETED"
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, deadline=-1)
+    assert error.value.statusCode == 400
+
+
+def test_queue_priority_and_fair_share():
+    queue = CAOSFlaskModule._AdmissionQueue(10)
+    for guid, priority, clientId in (("a1", 0, "a"), ("a2", 0, "a"),
+                                     ("a3", 0, "a"), ("b1", 0, "b"),
+                                     ("urgent", 1, "a")):
+        queue.push(guid, priority, clientId)
+        queue.setReady(guid, ())
+    order = []
+    while True:
+        entry = queue.pop()
+        if entry is None:
+            break
+        order.append(entry["guid"])
+    # the higher priority first, then the clients take turns
+    assert order == ["urgent", "b1", "a1", "a2", "a3"]
+
+
+def test_queue_waits_for_ready_tasks():
+    queue = CAOSFlaskModule._AdmissionQueue(10)
+    queue.push("a", 0, "client", deadline=0.01)
+    assert queue.pop() is None
+    queue.setReady("a", ())
+    assert queue.pop(lambda guid: False) is None
+    assert queue.expire(time.time() + 1) == ["a"]
+    assert queue.getLength() == 0
+
+
+def test_memory_budget(start_module, server):
+    module = start_module(server=server, memoryBudget=400)
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, memory=500)
+    assert error.value.statusCode == 400
+    taskId = module.client.submit({"alloc": 100, "sleep": 2}, memory=300)
+    # the resident memory of the task is sampled
+    assert wait_for(lambda: module.client.getInfo()["resources"][
+        "residentMemory"] > 100 * _MB)
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, memory=200)
+    assert error.value.statusCode == 503
+    assert module.client.wait(taskId)["state"] == "COMPLETED"
+    assert module.client.getInfo()["resources"]["usedMemory"] == 0
+    assert module.client.wait(module.client.submit(
+        {}, memory=200))["state"] == "COMPLETED"
+
+
+def test_cpu_budget_queue(start_module):
+    module = start_module(cpuBudget=1, queueMaxLength=5)
+    first = module.client.submit({"burn": 1})
+    second = module.client.submit({}, cpus=1)
+    assert module.client.getState(second)["state"] == "QUEUED"
+    assert module.client.wait(second)["state"] == "COMPLETED"
+    assert module.client.getState(first)["state"] == "COMPLETED"
+    metrics = module.client.get("/metrics").text
+    assert "\ncaos_task_cpu_budget 1" in metrics
+
+
+@pytest.mark.parametrize("workerPool", [False, True])
+def test_enforced_memory_limit(start_module, workerPool):
+    module = start_module(memoryBudget=1000, enforceLimits=True,
+                          workerPool=workerPool, maxTasks=1)
+    state = module.client.wait(module.client.submit({"alloc": 300},
+                                                    memory=100))
+    assert state["state"] == "FAILED"
+    assert "MemoryError" in state["stackTrace"]
+    # the limit of a worker of the pool is restored after the task
+    state = module.client.wait(module.client.submit({"alloc": 300},
+                                                    memory=400))
+    assert state["state"] == "COMPLETED"
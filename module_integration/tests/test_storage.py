@@ -0,0 +1,233 @@
+# Tests of the local storage of the module: blob store, upload limits,
+# result cache, retention of the completed tasks and task index.
+
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+import CAOSFlaskModule
+from CAOSModuleClient import RequestError
+from conftest import wait_for
+
+
+def _listBlobs(module):
+    blobsDir = os.path.join(module.storage, "blobs")
+    return sorted(name for name in os.listdir(blobsDir) if name != "tmp")
+
+
+def test_blob_deduplication(start_module, server):
+    module = start_module(server=server)
+    blob = os.urandom(256 * 1024)
+    blobHash = hashlib.sha256(blob).hexdigest()
+    assert module.client.head("/blob/" + blobHash).status_code == 404
+
+    for _ in range(2):
+        state = module.client.wait(module.client.submit(
+            {}, files={"in.bin": blob}))
+        assert state["response"]["blobs"] == {"in.bin": blobHash}
+    assert _listBlobs(module) == [blobHash]
+    assert module.client.head("/blob/" + blobHash).status_code == 200
+
+    # a stored blob is referenced by its hash instead of being uploaded
+    state = module.client.wait(module.client.submit(
+        {}, blobHashes={"again.bin": blobHash}))
+    assert state["response"]["blobs"] == {"again.bin": blobHash}
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, blobHashes={"missing.bin": "0" * 64})
+    assert error.value.statusCode == 400
+
+
+def test_invalid_blob_names(start_module, server):
+    module = start_module(server=server)
+    blobHash = module.client.wait(module.client.submit(
+        {}, files={"in.bin": b"blob"}))["response"]["blobs"]["in.bin"]
+    for name in ("../in.bin", "dir/in.bin", "..", "."):
+        with pytest.raises(RequestError) as error:
+            module.client.submit({}, blobHashes={name: blobHash})
+        assert error.value.statusCode == 400
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, files={"../../in.bin": b"blob"})
+    assert error.value.statusCode == 400
+    assert not os.path.exists(os.path.join(module.storage, "in.bin"))
+
+
+def test_upload_limits(start_module, server):
+    module = start_module(server=server, maxBlobBytes=1024,
+                          maxRequestBytes=64 * 1024)
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, files={"in.bin": b"x" * 2048})
+    assert error.value.statusCode == 413
+    with pytest.raises(RequestError) as error:
+        module.client.submit({}, files=dict(("in" + str(i), b"x" * 1000)
+                                            for i in range(100)))
+    assert error.value.statusCode == 413
+    assert module.client.wait(module.client.submit(
+        {}, files={"in.bin": b"x" * 1024}))["state"] == "COMPLETED"
+
+
+def test_blob_writer_spills_to_file(tmp_path):
+    blobStore = CAOSFlaskModule._BlobStore(str(tmp_path))
+    data = os.urandom(CAOSFlaskModule._BLOB_MEMORY_SIZE * 3)
+    blobHash = blobStore.store(io.BytesIO(data))
+    assert blobHash == hashlib.sha256(data).hexdigest()
+    with open(str(tmp_path / blobHash), "rb") as blobFile:
+        assert blobFile.read() == data
+    # the second copy is not stored again
+    assert blobStore.store(io.BytesIO(data)) == blobHash
+    assert os.listdir(str(tmp_path / "tmp")) == []
+    writer = blobStore.open(maxBytes=10)
+    with pytest.raises(CAOSFlaskModule._BlobTooLarge):
+        writer.write(b"x" * 11)
+
+
+def test_blob_store_keeps_pinned_blobs(tmp_path):
+    blobStore = CAOSFlaskModule._BlobStore(str(tmp_path))
+    blobHash = blobStore.store(io.BytesIO(b"pinned"), pin=True)
+    lastUse = time.time() - 100
+    os.utime(str(tmp_path / blobHash), (lastUse, lastUse))
+    assert blobStore.list() == [(blobHash, lastUse, 6)]
+    assert not blobStore.removeUnused(blobHash, lastUse)
+    blobStore.unpin([blobHash])
+    # a blob used after it has been listed is not removed
+    assert blobStore.has(blobHash)
+    assert not blobStore.removeUnused(blobHash, lastUse)
+    assert blobStore.removeUnused(blobHash, time.time() + 10)
+    assert not blobStore.has(blobHash, pin=True)
+    assert blobStore.pins == {}
+
+
+def test_result_cache(start_module, server):
+    module = start_module(server=server, cacheable=True)
+    request = {"results": {"out.txt": "cached"}, "log": "computed\n"}
+    first = module.client.wait(module.client.submit(request))
+    taskId = module.client.submit(request)
+    second = module.client.wait(taskId, timeout=0)
+    assert second["state"] == "COMPLETED"
+    assert second["response"] == first["response"]
+    assert module.client.get("/result/" + taskId + "/out.txt").content == \
+        b"cached"
+    assert "cache" in module.client.get("/log/" + taskId).text
+
+    # failed tasks and profiled requests are not served from the cache
+    failed = {"fail": "broken"}
+    module.client.wait(module.client.submit(failed))
+    assert module.client.wait(module.client.submit(failed))["state"] == \
+        "FAILED"
+    taskId = module.client.submit(request, profile="cprofile")
+    assert "profile.prof" in module.client.wait(taskId)["blobs"]
+    stats = module.client.getInfo()["cache"]
+    assert stats["hits"] == 1
+    assert stats["entries"] == 1
+
+
+def test_result_cache_eviction(start_module):
+    module = start_module(cacheable=True, cacheMaxEntries=1)
+    for value in ("a", "b", "a"):
+        module.client.wait(module.client.submit({"log": value}))
+    stats = module.client.getInfo()["cache"]
+    assert stats["hits"] == 0
+    assert stats["entries"] == 1
+    assert stats["evictions"] == 2
+
+
+def test_retention_max_tasks(start_module):
+    module = start_module(retentionMaxTasks=1, retentionInterval=0.2)
+    first = module.client.submit({"results": {"out.txt": "1"}})
+    module.client.wait(first)
+    second = module.client.submit({})
+    module.client.wait(second)
+    # the least recently accessed task is evicted (the task APIs are not
+    # polled, since they update the last access of the task)
+    assert wait_for(lambda: module.client.getInfo()["retention"][
+        "evictedTasks"] == 1)
+    assert module.client.get("/state/" + first).status_code == 404
+    assert module.client.get("/log/" + first).status_code == 404
+    assert module.client.getState(second)["state"] == "COMPLETED"
+
+
+def test_retention_max_age(start_module):
+    module = start_module(retentionMaxAge=1, retentionInterval=0.2)
+    taskId = module.client.submit({}, files={"in.bin": b"old blob"})
+    module.client.wait(taskId)
+    blobHash = hashlib.sha256(b"old blob").hexdigest()
+    assert wait_for(lambda: module.client.getInfo()["retention"][
+        "evictedBlobs"] == 1, timeout=5)
+    assert module.client.getInfo()["retention"]["evictedTasks"] == 1
+    assert module.client.get("/state/" + taskId).status_code == 404
+    assert module.client.head("/blob/" + blobHash).status_code == 404
+
+
+def test_retention_max_bytes_evicts_blobs(start_module):
+    module = start_module(retentionMaxBytes=1, retentionInterval=0.2)
+    taskId = module.client.submit({}, files={"in.bin": b"blob"})
+    module.client.wait(taskId)
+    assert wait_for(lambda: module.client.getInfo()["retention"][
+        "evictedBlobs"] == 1, timeout=5)
+    assert _listBlobs(module) == []
+
+
+def test_retention_survives_stale_trash(start_module):
+    module = start_module(retentionMaxTasks=1, retentionInterval=0.2)
+    first = module.client.submit({})
+    module.client.wait(first)
+    # left by an eviction of the task that failed
+    os.mkdir(os.path.join(module.storage, "trash", first))
+    module.client.wait(module.client.submit({}))
+    assert wait_for(lambda: module.client.getInfo()["retention"][
+        "evictedTasks"] == 1)
+    assert module.client.get("/state/" + first).status_code == 404
+
+
+def test_restart_readopts_tasks(start_module, server):
+    module = start_module(server=server)
+    completed = module.client.submit({"results": {"out.txt": "kept"}})
+    module.client.wait(completed)
+    running = module.client.submit({"sleep": 30})
+    module.stop()
+
+    module = start_module(server=server)
+    state = module.client.getState(completed)
+    assert state["state"] == "COMPLETED"
+    assert module.client.get("/result/" + completed + "/out.txt").content \
+        == b"kept"
+    state = module.client.getState(running)
+    assert state["state"] == "FAILED"
+    assert "restarted" in state["message"]
+    module.stop()
+
+    module = start_module(server=server, cleanStorage=True)
+    assert module.client.get("/state/" + completed).status_code == 404
+
+
+def test_task_index_replay(tmp_path):
+    journalPath = str(tmp_path / "index.journal")
+    index = CAOSFlaskModule._TaskIndex(journalPath)
+    for guid in ("a", "b", "c"):
+        index.addTask(guid, {"state": "COMPLETED", "response": {}})
+    index.removeTask("b")
+    index.addResult("x", {"guid": "a"})
+    index.addResult("y", {"guid": "c"})
+    index.addResult("x", {"guid": "a"})
+    index.removeResult("z")
+    index.journal.close()
+    # a record left incomplete by a crash is ignored
+    with open(journalPath, "ab") as journalFile:
+        journalFile.write(b'{"task":"d","sta')
+
+    index = CAOSFlaskModule._TaskIndex(journalPath)
+    index.addTask("e", {"state": "FAILED", "stackTrace": "error"})
+    tasks, results = index.load()
+    assert list(tasks) == ["a", "c", "e"]
+    assert tasks["e"]["stackTrace"] == "error"
+    # the results are in least recently used order
+    assert list(results) == ["y", "x"]
+
+    # the journal is compacted
+    with open(journalPath, "rb") as journalFile:
+        assert len(journalFile.readlines()) == 5
+    index.removeTask("a")
+    tasks, _ = CAOSFlaskModule._TaskIndex(journalPath).load()
+    assert list(tasks) == ["c", "e"]
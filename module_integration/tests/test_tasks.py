@@ -0,0 +1,208 @@
+# Tests of the life cycle of the tasks: execution (in a process per task or
+# in the worker pool), task registry, /wait, /events, /kill and /log.
+
+import hashlib
+import json
+import threading
+import time
+
+import pytest
+
+import CAOSFlaskModule
+from CAOSModuleClient import RequestError
+
+
+def test_submit_and_complete(start_module, server):
+    module = start_module(server=server)
+    blob = b"blob content"
+    taskId = module.client.submit({"results": {"out.txt": "result"},
+                                   "log": "hello\n"},
+                                  files={"in.bin": blob})
+    state = module.client.wait(taskId)
+    assert state["state"] == "COMPLETED"
+    assert state["blobs"] == ["out.txt"]
+    assert state["response"]["blobs"] == \
+        {"in.bin": hashlib.sha256(blob).hexdigest()}
+    timestamps = state["timestamps"]
+    assert timestamps["submitted"] <= timestamps["started"] <= \
+        timestamps["completed"]
+    assert module.client.get("/log/" + taskId).text == "hello\n"
+    assert module.client.get("/result/" + taskId + "/out.txt").content == \
+        b"result"
+
+
+def test_failed_task(start_module, server):
+    module = start_module(server=server)
+    state = module.client.wait(module.client.submit({"fail": "broken"}))
+    assert state["state"] == "FAILED"
+    assert state["message"] == "broken"
+    assert "pid" in state["errorData"]
+    assert "Error: broken" in state["stackTrace"]
+
+
+def test_unknown_task(start_module, server):
+    module = start_module(server=server)
+    for route in ("/state/", "/wait/", "/log/", "/kill/"):
+        assert module.client.get(route + "t_unknown").status_code == 404
+    response = module.client.post("/submit", files={"other": b"{}"})
+    assert response.status_code == 400
+
+
+def test_capacity_limit(start_module, server):
+    module = start_module(server=server, maxTasks=1)
+    taskId = module.client.submit({"sleep": 1})
+    assert module.client.getInfo()["runningTasks"] == 1
+    with pytest.raises(RequestError) as error:
+        module.client.submit({})
+    assert error.value.statusCode == 503
+    module.client.wait(taskId)
+    assert module.client.getInfo()["runningTasks"] == 0
+    assert module.client.wait(module.client.submit({}))["state"] == \
+        "COMPLETED"
+
+
+def test_worker_pool_reuses_workers(start_module):
+    module = start_module(workerPool=True, maxTasks=1)
+    pids = [module.client.wait(module.client.submit({}))["response"]["pid"]
+            for _ in range(3)]
+    assert len(set(pids)) == 1
+
+
+def test_worker_pool_recycles_workers(start_module):
+    module = start_module(workerPool=True, maxTasks=1, workerMaxTasks=1)
+    pids = [module.client.wait(module.client.submit({}))["response"]["pid"]
+            for _ in range(3)]
+    assert len(set(pids)) == 3
+
+
+@pytest.mark.parametrize("workerPool", [False, True])
+def test_kill_running_task(start_module, server, workerPool):
+    module = start_module(server=server, workerPool=workerPool, maxTasks=1)
+    taskId = module.client.submit({"sleep": 30})
+    assert module.client.getState(taskId)["state"] == "RUNNING"
+    module.client.kill(taskId)
+    state = module.client.getState(taskId)
+    assert state["state"] == "FAILED"
+    assert state["stackTrace"] == "Task cancelled by user"
+    assert module.client.getInfo()["runningTasks"] == 0
+    # the slot of the killed task (and the killed worker) can be reused
+    assert module.client.wait(module.client.submit({}))["state"] == \
+        "COMPLETED"
+    with pytest.raises(RequestError) as error:
+        module.client.kill(taskId)
+    assert error.value.statusCode == 404
+
+
+def test_kill_racing_completion(start_module):
+    module = start_module(cacheable=True)
+    completed = 0
+    for i in range(20):
+        taskId = module.client.submit({"sleep": 0.1, "log": str(i)})
+        time.sleep(0.08 + 0.002 * i)
+        try:
+            module.client.kill(taskId)
+            killed = True
+        except RequestError as error:
+            assert error.statusCode == 404
+            killed = False
+        state = module.client.wait(taskId)
+        # a task is either cancelled or completed, never both
+        assert state["state"] == ("FAILED" if killed else "COMPLETED")
+        completed += not killed
+    info = module.client.getInfo()
+    assert info["runningTasks"] == 0
+    assert info["cache"]["entries"] == completed
+
+
+def test_wait_timeout(start_module, server):
+    module = start_module(server=server)
+    taskId = module.client.submit({"sleep": 1})
+    start = time.time()
+    assert module.client.wait(taskId, timeout=0.2)["state"] == "RUNNING"
+    assert time.time() - start < 1
+    response = module.client.get("/wait/" + taskId + "?timeout=x")
+    assert response.status_code == 400
+    assert module.client.wait(taskId)["state"] == "COMPLETED"
+
+
+def test_events_stream(start_module, server):
+    module = start_module(server=server)
+    taskId = module.client.submit({"sleep": 0.5})
+    response = module.client.get("/events/" + taskId, stream=True)
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    events = []
+    for line in response.iter_lines():
+        if line.startswith(b"data: "):
+            events.append(json.loads(line[6:].decode("utf-8"))["state"])
+    assert events == ["RUNNING", "COMPLETED"]
+
+
+def test_log_range(start_module, server):
+    module = start_module(server=server)
+    taskId = module.client.submit({"log": "0123456789"})
+    module.client.wait(taskId)
+    assert module.client.get("/log/" + taskId + "?offset=4").text == \
+        "456789"
+    response = module.client.get("/log/" + taskId,
+                                 headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.text == "2345"
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+    response = module.client.get("/log/" + taskId,
+                                 headers={"Range": "bytes=20-"})
+    assert response.status_code == 416
+
+
+def test_log_follow(start_module, server):
+    module = start_module(server=server)
+    taskId = module.client.submit({"logLines": 5, "logInterval": 0.1})
+    chunks = []
+    received = module.client.streamLog(taskId, chunks.append)
+    log = b"".join(chunks).decode("utf-8")
+    assert log == "".join("line " + str(i) + "\n" for i in range(5))
+    assert received == len(log)
+    assert module.client.getState(taskId)["state"] == "COMPLETED"
+
+
+@pytest.mark.parametrize("workerPool", [False, True])
+def test_dead_task_process(start_module, server, workerPool):
+    module = start_module(server=server, workerPool=workerPool, maxTasks=1,
+                          memoryBudget=400)
+    # the process of the task is killed, or it can not store the result
+    for request, error in (({"crash": True}, "killed by signal 9"),
+                           ({"unserializable": True}, "exited with code")):
+        state = module.client.wait(module.client.submit(request, memory=300))
+        assert state["state"] == "FAILED"
+        assert error in state["stackTrace"]
+        info = module.client.getInfo()
+        assert info["runningTasks"] == 0
+        assert info["resources"]["usedMemory"] == 0
+    # the slot (and the worker) of the dead task can be reused
+    assert module.client.wait(module.client.submit(
+        {}, memory=300))["state"] == "COMPLETED"
+
+
+def test_registry_states():
+    registry = CAOSFlaskModule._TaskRegistry()
+    notified = []
+    registry.addListener(notified.append)
+    assert registry.add("a", maxTasks=1) == 1
+    assert registry.add("b", maxTasks=1) == -1
+    registry.addQueued("b")
+    assert registry.get("b")["state"] == "QUEUED"
+    assert registry.complete("a", {}, [])
+    # a task is completed only once
+    assert not registry.complete("a", {}, [], "late")
+    assert registry.get("a")["state"] == "COMPLETED"
+    registry.start("b")
+    assert registry.getNumRunning() == 1
+    assert notified == ["a", "b"]
+
+
+def test_registry_wait():
+    registry = CAOSFlaskModule._TaskRegistry()
+    registry.add("a")
+    assert registry.wait("a", 0.05)["state"] == "RUNNING"
+    threading.Timer(0.1, registry.complete, ("a", {}, [])).start()
+    assert registry.wait("a", 5)["state"] == "COMPLETED"
+    assert registry.wait("unknown", 0.05) is None